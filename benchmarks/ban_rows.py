@@ -0,0 +1,131 @@
+"""
+Benchmark loading and formatting ban rows.
+
+Compares the old rows (plain tuples, with every time converted to a
+tz-aware datetime by a registered sqlite3 converter) against BanRow (times
+left as seconds since the epoch, converted only when asked for), for
+memory per row, load time, and the time to format every row's dates the
+way bans.html does.
+
+Usage: python benchmarks/ban_rows.py [rows] [repeat]
+"""
+import datetime
+import os
+import sqlite3
+import sys
+import tempfile
+import timeit
+
+from infobob.database import BanRow, local, localtime
+from infobob.http import DATE_FORMAT, formatTime
+
+
+SCHEMA_PATH = os.path.join(os.path.dirname(__file__), os.pardir, 'db.schema')
+
+_OLD_COLUMNS = """
+    channel, mask, mode, set_at as "set_at [datetime]", set_by,
+    expire_at as "expire_at [datetime]", reason,
+    unset_at as "unset_at [datetime]", unset_by
+"""
+
+_NEW_COLUMNS = """
+    channel, mask, mode, set_at, set_by, expire_at, reason, unset_at, unset_by
+"""
+
+
+def makeDatabase(path, count):
+    conn = sqlite3.connect(path)
+    with open(SCHEMA_PATH) as schemaFile:
+        conn.executescript(schemaFile.read())
+    start = 1521040166
+    conn.executemany("""
+        INSERT INTO bans (channel, mask, mode, set_at, set_by, expire_at,
+                          reason, unset_at, unset_by)
+        VALUES (?, ?, 'b', ?, 'someop!op@ops.example.com', ?, ?, ?, ?)
+    """, [
+        ('#channel%d' % (i // 500,), '*!*@spam%d.example.com' % (i,),
+         start + i * 60, start + i * 60 + 7 * 86400, 'spam bot #%d' % (i,),
+         start + i * 60 + 86400 if i % 3 == 0 else None,
+         'otherop!op@ops.example.com' if i % 3 == 0 else None)
+        for i in xrange(count)])
+    conn.commit()
+    conn.close()
+
+
+def loadOld(path):
+    conn = sqlite3.connect(path, detect_types=sqlite3.PARSE_COLNAMES)
+    sqlite3.register_converter('datetime',
+        lambda x: datetime.datetime.fromtimestamp(float(x)).replace(
+            tzinfo=local))
+    try:
+        return conn.execute('SELECT %s FROM bans' % (_OLD_COLUMNS,)).fetchall()
+    finally:
+        conn.close()
+
+
+def loadNew(path):
+    conn = sqlite3.connect(path)
+    try:
+        return map(BanRow._make, conn.execute(
+            'SELECT %s FROM bans' % (_NEW_COLUMNS,)).fetchall())
+    finally:
+        conn.close()
+
+
+def rowBytes(rows):
+    """
+    The memory taken by the rows themselves and their times; the strings
+    are the same either way.
+    """
+    total = 0
+    for row in rows:
+        total += sys.getsizeof(row)
+        for i in (3, 5, 7):
+            if row[i] is not None:
+                total += sys.getsizeof(row[i])
+    return total
+
+
+def formatOld(rows):
+    for row in rows:
+        row[3].strftime(DATE_FORMAT)
+        if row[5]:
+            row[5].strftime(DATE_FORMAT)
+        if row[7]:
+            row[7].strftime(DATE_FORMAT)
+
+
+def formatNew(rows):
+    for row in rows:
+        formatTime(row.set_at)
+        if row.expire_at:
+            formatTime(row.expire_at)
+        if row.unset_at:
+            formatTime(row.unset_at)
+
+
+def main(rows=100000, repeat=3):
+    fd, path = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    try:
+        makeDatabase(path, rows)
+        for name, load, format in [
+            ('tuples of datetimes', loadOld, formatOld),
+            ('BanRow, epoch times', loadNew, formatNew),
+        ]:
+            loaded = load(path)
+            loadTime = min(timeit.repeat(
+                lambda: load(path), number=1, repeat=repeat))
+            formatSeconds = min(timeit.repeat(
+                lambda: format(loaded), number=1, repeat=repeat))
+            print '%-22s %6d rows  %5.1f MB  load %7.1f ms  format %7.1f ms' % (
+                name, rows, rowBytes(loaded) / 1e6, loadTime * 1000,
+                formatSeconds * 1000)
+        # Sanity check: both come out the same.
+        assert localtime(loadNew(path)[0].set_at) == loadOld(path)[0][3]
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
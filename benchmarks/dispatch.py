@@ -0,0 +1,132 @@
+"""
+Benchmark dispatching channel messages in Infobob.privmsg.
+
+Replays a channel log through the old dispatch (channel config and command
+permissions looked up per message, and the address pattern rebuilt from
+the nickname every time) and the current one (per-channel policies and a
+pattern compiled once per nickname).
+
+The log has one message per line, as "<nick> message"; without one, a
+synthetic log of a busy channel is generated.
+
+Usage: python benchmarks/dispatch.py [log file] [repeat]
+"""
+import io
+import json
+import random
+import re
+import sys
+import timeit
+
+from infobob.config import InfobobConfig
+from infobob.irc import Infobob, _lol_regex
+
+
+CONFIG = {
+    'irc': {'nickname': 'infobob', 'autojoin': ['#python']},
+    'channels': {
+        'defaults': {'commands': [['allow', 'all'], ['deny', 'divine']]},
+        '#python': {'commands': [['deny', 'lol']]},
+    },
+}
+
+_LINE_REGEX = re.compile(r'^<([^>]+)> (.*)$')
+
+
+class OldDispatchInfobob(Infobob):
+    """
+    Infobob, with privmsg as it was before dispatch was precompiled.
+    """
+    def privmsg(self, user, channel, message):
+        user = user.split('!', 1)[0]
+        target = channel
+        channel_obj = self._conf.channel(channel)
+        _ = channel_obj.translate
+        if (channel_obj.is_usable('lol') and not self._shedding('lol')
+                and _lol_regex.search(message)):
+            self.do_lol(user, channel, _)
+        if channel_obj.is_usable('repaste') and not self._shedding('repaste'):
+            to_repaste = self._repaster.extractBadPasteSpecs(message)
+            if to_repaste:
+                self.repaste(target, user, to_repaste, _)
+
+        m = re.match(
+            r'^s*%s\s*[,:> ]+(\S?.*?)[.!?]?\s*$' % self.nickname, message,
+            re.I)
+        if m:
+            command, = m.groups()
+        else:
+            command = None
+
+        if command:
+            s_command = command.split(' ')
+            command_func = getattr(self, 'infobob_' + s_command[0], None)
+            if command_func is not None and channel_obj.is_usable(
+                    s_command[0]):
+                command_func(target, channel_obj, *s_command[1:])
+
+
+class NullRepaster(object):
+    def extractBadPasteSpecs(self, message):
+        return []
+
+
+def makeBot(cls):
+    conf = InfobobConfig()
+    conf.load(io.BytesIO(json.dumps(CONFIG)))
+    conf.dbpool = None
+    bot = cls(conf, paster=object(), repaster=NullRepaster())
+    bot.do_lol = lambda *a: None
+    bot.infobob_redent = lambda *a: None
+    bot.infobob_stop = lambda *a: None
+    return bot
+
+
+def syntheticLog(count=20000, seed=0):
+    rng = random.Random(seed)
+    nicks = ['user%d' % (i,) for i in xrange(200)]
+    chatter = [
+        'has anyone used asyncio with sqlite?',
+        'you want a list comprehension there',
+        'lol that traceback',
+        'see https://docs.python.org/3/library/functools.html',
+        'infobob: redent paste def f(): return 1',
+        'infobob, stop',
+        'infobob: nonsense',
+        'def f(x):     return x',
+    ]
+    weights = [30, 30, 5, 10, 2, 1, 2, 20]
+    population = [line for line, weight in zip(chatter, weights)
+                  for _ in xrange(weight)]
+    return [(rng.choice(nicks), rng.choice(population))
+            for _ in xrange(count)]
+
+
+def readLog(path):
+    messages = []
+    with open(path) as logFile:
+        for line in logFile:
+            m = _LINE_REGEX.match(line.rstrip('\n'))
+            if m:
+                messages.append(m.groups())
+    return messages
+
+
+def replay(bot, messages):
+    for nick, message in messages:
+        bot.privmsg(nick + '!user@host', '#python', message)
+
+
+def main(path=None, repeat=5):
+    messages = readLog(path) if path else syntheticLog()
+    for name, cls in [('old dispatch', OldDispatchInfobob),
+                      ('policy table', Infobob)]:
+        bot = makeBot(cls)
+        best = min(timeit.repeat(
+            lambda: replay(bot, messages), number=1, repeat=int(repeat)))
+        print '%-16s %6d messages  %8.1f ms  %6.2f us/message' % (
+            name, len(messages), best * 1000, best * 1e6 / len(messages))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
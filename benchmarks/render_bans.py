@@ -0,0 +1,128 @@
+"""
+Benchmark rendering a page of bans.html.
+
+Compares the old way of rendering (an auto-reloading loader, with every
+row's cells and strftime calls in template expressions) against the
+production setup (templates parsed once at startup, and each row's text
+and dates preformatted by infobob.http.presentBans).
+
+Usage: python benchmarks/render_bans.py [rows] [repeat]
+"""
+import itertools
+import operator
+import os.path
+import shutil
+import sys
+import tempfile
+import timeit
+
+from genshi.template import TemplateLoader
+
+from infobob.database import BanRow
+from infobob.http import DEFAULT_TEMPLATES_DIR, presentBans
+
+
+# The table rows of bans.html as they were before being preformatted.
+_INLINE_ROW_TEMPLATE = """\
+<html xmlns="http://www.w3.org/1999/xhtml"
+      xmlns:py="http://genshi.edgewall.org/"
+      xmlns:xi="http://www.w3.org/2001/XInclude">
+  <py:match path="content">
+    <py:for each="channel, channel_bans in bans">
+      <h2>$channel</h2>
+      <table>
+	<tr py:for="_, mask, mode, set_at, set_by, expire_at, reason, unset_at, unset_by in channel_bans">
+	  <td class="set-by">${set_by.partition('!')[0]}</td>
+	  <td class="tt">+${mode} ${mask}</td>
+	  <td class="date">${set_at.strftime('%A, %e %B %Y at %R %p %Z')}</td>
+	  <py:choose test="">
+	    <py:when test="expire_at">
+	      <td class="date">${expire_at.strftime('%A, %e %B %Y at %R %p %Z')}</td>
+	    </py:when><py:otherwise>
+	      <td class="center">never</td>
+	    </py:otherwise>
+	  </py:choose>
+	  <td class="reason">${reason}</td>
+	  <py:if test="show_unset" py:choose="">
+	    <py:when test="unset_by">
+	      <td class="set-by">${unset_by.partition('!')[0]}</td>
+	      <td class="date">${unset_at.strftime('%A, %e %B %Y at %R %p %Z')}</td>
+	    </py:when><py:otherwise>
+	      <td colspan="2" class="center">not ${"yet" if expire_at else "ever"}</td>
+	    </py:otherwise>
+	  </py:if>
+	</tr>
+      </table>
+    </py:for>
+  </py:match>
+  <xi:include href="base.html" />
+</html>
+"""
+
+
+def makeBans(count):
+    start = 1521040166
+    bans = []
+    for i in xrange(count):
+        set_at = start + i * 60
+        unset = i % 3 == 0
+        bans.append(BanRow(
+            '#channel%d' % (i // 500,), '*!*@spam%d.example.com' % (i,), 'b',
+            set_at, 'someop!op@ops.example.com', set_at + 7 * 86400,
+            'spam bot #%d' % (i,), set_at + 86400 if unset else None,
+            'otherop!op@ops.example.com' if unset else None,
+        ))
+    return bans
+
+
+def withDatetimes(bans):
+    # The rows as the database used to return them.
+    return [ban[:3] + (ban.set_at_datetime, ban.set_by,
+                       ban.expire_at_datetime, ban.reason,
+                       ban.unset_at_datetime, ban.unset_by)
+            for ban in bans]
+
+
+def makeInlineTemplatesDir():
+    templatesDir = tempfile.mkdtemp()
+    shutil.copy(os.path.join(DEFAULT_TEMPLATES_DIR, 'base.html'), templatesDir)
+    with open(os.path.join(templatesDir, 'bans.html'), 'w') as f:
+        f.write(_INLINE_ROW_TEMPLATE)
+    return templatesDir
+
+
+def renderInline(loader, bans):
+    # Loaded per render, as every request used to.
+    tmpl = loader.load('bans.html')
+    grouped = itertools.groupby(bans, operator.itemgetter(0))
+    return tmpl.generate(
+        bans=grouped, show_unset=True, show_recent_expiration=False,
+        next_url=None).render('html', doctype='html5', encoding='utf-8')
+
+
+def renderPreformatted(tmpl, bans):
+    return tmpl.generate(
+        bans=presentBans(bans, show_unset=True), show_unset=True,
+        show_recent_expiration=False, next_url=None).render('html', doctype='html5', encoding='utf-8')
+
+
+def main(rows=2000, repeat=5):
+    bans = makeBans(rows)
+    oldBans = withDatetimes(bans)
+    inlineDir = makeInlineTemplatesDir()
+    devLoader = TemplateLoader(inlineDir, auto_reload=True)
+    prodLoader = TemplateLoader(DEFAULT_TEMPLATES_DIR, auto_reload=False)
+    prodTemplate = prodLoader.load('bans.html')
+
+    for name, render in [
+        ('inline strftime, auto-reload', lambda: renderInline(devLoader, oldBans)),
+        ('preformatted, precompiled',
+            lambda: renderPreformatted(prodTemplate, bans)),
+    ]:
+        best = min(timeit.repeat(render, number=1, repeat=repeat))
+        print '%-32s %6d rows  %8.1f ms' % (name, rows, best * 1000)
+    shutil.rmtree(inlineDir)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,152 @@
+"""
+Benchmark how long a freshly started bot takes to get onto IRC.
+
+Starts ``twistd -n infobob`` against a fake IRC server on localhost, and
+measures the time from spawning the process to the bot's first JOIN,
+which it sends as soon as it's signed on. Also reports how long the
+bot's modules take to import in a fresh interpreter, on top of the
+reactor, which everything needs anyway.
+
+Usage: python benchmarks/startup.py [repeat]
+"""
+import json
+import os
+import os.path
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from twisted.internet import defer, protocol, reactor, task
+from twisted.protocols import basic
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+SCHEMA_PATH = os.path.join(ROOT, 'db.schema')
+
+MODULES = [
+    'infobob.irc',
+    'infobob.pastebin',
+    'infobob.redent',
+    'infobob.http',
+    'infobob.service',
+]
+
+_TWISTD = 'from twisted.scripts.twistd import run; run()'
+
+
+class FakeIRCServer(basic.LineReceiver):
+    def lineReceived(self, line):
+        command = line.split(' ', 1)[0].upper()
+        if command == 'USER':
+            self.sendLine(':fake.example 001 infobob :Welcome')
+        elif command == 'JOIN':
+            self.factory.joined(self)
+
+
+class FakeIRCServerFactory(protocol.ServerFactory):
+    protocol = FakeIRCServer
+
+    def __init__(self):
+        self.waiting = None
+
+    def joined(self, proto):
+        waiting, self.waiting = self.waiting, None
+        if waiting is not None:
+            waiting.callback(time.time())
+        proto.transport.loseConnection()
+
+
+class TwistdProcess(protocol.ProcessProtocol):
+    def __init__(self, server):
+        self.server = server
+        self.ended = defer.Deferred()
+
+    def processEnded(self, reason):
+        waiting, self.server.waiting = self.server.waiting, None
+        if waiting is not None:
+            waiting.errback(RuntimeError(
+                'twistd exited before joining; see twistd.log'))
+        self.ended.callback(None)
+
+
+def makeConfig(workDir, ircPort):
+    dbFile = os.path.join(workDir, 'infobob.sqlite')
+    conn = sqlite3.connect(dbFile)
+    with open(SCHEMA_PATH) as schemaFile:
+        conn.executescript(schemaFile.read())
+    conn.close()
+    config = {
+        'irc': {
+            'nickname': 'infobob',
+            'server': '127.0.0.1',
+            'port': ircPort,
+            'ssl': False,
+            'nickserv_pw': None,
+            'autojoin': ['#bench'],
+        },
+        'database': {'sqlite': {'db_file': dbFile}},
+        'web': {'port': 0},
+        'misc': {'manhole': {'socket': None}},
+    }
+    configFile = os.path.join(workDir, 'infobob.cfg')
+    with open(configFile, 'w') as f:
+        json.dump(config, f)
+    return configFile
+
+
+@defer.inlineCallbacks
+def timeSignon(server, workDir, configFile):
+    server.waiting = defer.Deferred()
+    proc = TwistdProcess(server)
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    started = time.time()
+    transport = reactor.spawnProcess(
+        proc, sys.executable,
+        [sys.executable, '-c', _TWISTD, '-n', '--pidfile=',
+         '--logfile', os.path.join(workDir, 'twistd.log'),
+         'infobob', configFile],
+        env=env, path=workDir)
+    joined = yield server.waiting
+    transport.signalProcess('TERM')
+    yield proc.ended
+    defer.returnValue(joined - started)
+
+
+def importTime(module):
+    code = ('import time; from twisted.internet import reactor; '
+            't = time.time(); import %s; print time.time() - t' % (module,))
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    output = subprocess.check_output(
+        [sys.executable, '-W', 'ignore', '-c', code], env=env)
+    return float(output.split()[-1])
+
+
+@defer.inlineCallbacks
+def run(reactor, repeat=5):
+    for module in MODULES:
+        print '%-24s imported in  %8.1f ms' % (
+            module, importTime(module) * 1000)
+
+    server = FakeIRCServerFactory()
+    listening = reactor.listenTCP(0, server, interface='127.0.0.1')
+    workDir = tempfile.mkdtemp()
+    try:
+        configFile = makeConfig(workDir, listening.getHost().port)
+        timings = []
+        for _ in xrange(int(repeat)):
+            timing = yield timeSignon(server, workDir, configFile)
+            timings.append(timing)
+    finally:
+        yield listening.stopListening()
+        shutil.rmtree(workDir)
+    timings.sort()
+    print '%-24s best %8.1f ms  median %8.1f ms' % (
+        'spawn to JOIN', timings[0] * 1000,
+        timings[len(timings) // 2] * 1000)
+
+
+if __name__ == '__main__':
+    task.react(run, sys.argv[1:])
@@ -0,0 +1,296 @@
+"""
+Online backups of the bot's database.
+
+Snapshots are taken with SQLite's backup API, a few pages per step, with a
+pause between steps, so the bot's writers are only ever locked out for the
+length of one step. A write by the bot between steps starts the copy over,
+so after a few restarts the rest is copied in a single step instead. Each
+snapshot is written next to its final name and renamed into place once
+complete, and only the newest few are kept.
+
+The sqlite3 module in Python 2 doesn't expose the backup API, so
+:class:`OnlineBackup` calls it through ctypes, on connections of its own.
+"""
+import ctypes
+import ctypes.util
+import glob
+import os
+import os.path
+import time
+
+from twisted.internet import defer, reactor, task
+from twisted.application import service
+from twisted.python import failure
+from twisted import logger
+
+log = logger.Logger()
+
+SQLITE_OK = 0
+SQLITE_BUSY = 5
+SQLITE_LOCKED = 6
+SQLITE_DONE = 101
+SQLITE_OPEN_READONLY = 0x1
+SQLITE_OPEN_READWRITE = 0x2
+SQLITE_OPEN_CREATE = 0x4
+
+_lib = None
+
+def _sqlite():
+    global _lib
+    if _lib is not None:
+        return _lib
+    lib = ctypes.CDLL(ctypes.util.find_library('sqlite3'))
+    lib.sqlite3_open_v2.argtypes = [
+        ctypes.c_char_p, ctypes.POINTER(ctypes.c_void_p), ctypes.c_int,
+        ctypes.c_char_p]
+    lib.sqlite3_close.argtypes = [ctypes.c_void_p]
+    lib.sqlite3_errmsg.argtypes = [ctypes.c_void_p]
+    lib.sqlite3_errmsg.restype = ctypes.c_char_p
+    lib.sqlite3_backup_init.argtypes = [
+        ctypes.c_void_p, ctypes.c_char_p, ctypes.c_void_p, ctypes.c_char_p]
+    lib.sqlite3_backup_init.restype = ctypes.c_void_p
+    lib.sqlite3_backup_step.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    lib.sqlite3_backup_remaining.argtypes = [ctypes.c_void_p]
+    lib.sqlite3_backup_pagecount.argtypes = [ctypes.c_void_p]
+    lib.sqlite3_backup_finish.argtypes = [ctypes.c_void_p]
+    _lib = lib
+    return lib
+
+
+class BackupError(Exception):
+    pass
+
+
+class BackupInProgress(Exception):
+    pass
+
+
+class OnlineBackup(object):
+    """
+    A copy of the SQLite database at ``source`` being made at
+    ``destination``, one :meth:`step` at a time.
+
+    Steps are blocking, and are meant to be run on a database thread. If
+    another connection writes to the source between steps, SQLite starts
+    the copy over; ``remaining`` going back up shows it.
+    """
+    def __init__(self, source, destination):
+        self._lib = lib = _sqlite()
+        self._source = self._open(source, SQLITE_OPEN_READONLY)
+        try:
+            self._destination = self._open(
+                destination, SQLITE_OPEN_READWRITE | SQLITE_OPEN_CREATE)
+        except BackupError:
+            lib.sqlite3_close(self._source)
+            raise
+        self._backup = lib.sqlite3_backup_init(
+            self._destination, b'main', self._source, b'main')
+        if not self._backup:
+            error = BackupError(lib.sqlite3_errmsg(self._destination))
+            self._closeConnections()
+            raise error
+        self.remaining = self.pagecount = None
+
+    def _open(self, path, flags):
+        db = ctypes.c_void_p()
+        rc = self._lib.sqlite3_open_v2(path, ctypes.byref(db), flags, None)
+        if rc != SQLITE_OK:
+            message = self._lib.sqlite3_errmsg(db)
+            self._lib.sqlite3_close(db)
+            raise BackupError('opening %s: %s' % (path, message))
+        return db
+
+    def step(self, pages):
+        """
+        Copy up to ``pages`` more pages, or all of them if ``pages`` is
+        negative, and return whether the copy is complete. A step that
+        finds the source locked copies nothing, to be retried later.
+        """
+        rc = self._lib.sqlite3_backup_step(self._backup, pages)
+        self.remaining = self._lib.sqlite3_backup_remaining(self._backup)
+        self.pagecount = self._lib.sqlite3_backup_pagecount(self._backup)
+        if rc == SQLITE_DONE:
+            return True
+        if rc in (SQLITE_OK, SQLITE_BUSY, SQLITE_LOCKED):
+            return False
+        raise BackupError(self._lib.sqlite3_errmsg(self._destination))
+
+    def close(self):
+        """
+        Release the backup and its connections. A copy closed before it's
+        complete leaves a partial file behind.
+        """
+        if self._backup is None:
+            return
+        rc = self._lib.sqlite3_backup_finish(self._backup)
+        self._backup = None
+        error = None
+        if rc != SQLITE_OK:
+            error = BackupError(self._lib.sqlite3_errmsg(self._destination))
+        self._closeConnections()
+        if error is not None:
+            raise error
+
+    def _closeConnections(self):
+        self._lib.sqlite3_close(self._destination)
+        self._lib.sqlite3_close(self._source)
+
+
+class BackupService(service.Service):
+    """
+    Take snapshots of the database into ``directory``, every ``interval``
+    seconds if that's not None, or whenever :meth:`backup` is called.
+
+    Each step copies ``pagesPerStep`` pages on a database thread, and the
+    next one runs ``stepPause`` seconds later. Once the copy has restarted
+    ``maxRestarts`` times, the rest is copied in one step, holding the
+    source's read lock until it's done. The newest ``keep`` snapshots are
+    kept. Stopping abandons a copy in progress after its current step or
+    pause, and ``dbpool`` isn't closed until it has been.
+    """
+    name = 'backup'
+    prefix = 'infobob-'
+    suffix = '.sqlite'
+
+    def __init__(self, dbpool, source, directory, interval=None, keep=7,
+                 pagesPerStep=64, stepPause=0.05, maxRestarts=3,
+                 clock=reactor):
+        self.dbpool = dbpool
+        self.source = source
+        self.directory = directory
+        self.keep = keep
+        self.pagesPerStep = pagesPerStep
+        self.stepPause = stepPause
+        self.maxRestarts = maxRestarts
+        self.current = None
+        self.last = None
+        self._clock = clock
+        self._interval = interval
+        self._running = None
+        self._stopWaiters = []
+        self._looper = task.LoopingCall(self._scheduledBackup)
+        self._looper.clock = clock
+
+    def startService(self):
+        service.Service.startService(self)
+        if self._interval is not None:
+            self._looper.start(self._interval, now=False)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self._looper.running:
+            self._looper.stop()
+        if self._running is not None:
+            # The copy stops after its current step.
+            stopped = defer.Deferred()
+            self._stopWaiters.append(stopped)
+            return stopped
+
+    def progress(self):
+        """
+        Return the state of the backup in progress, or of the last one, as
+        a dict; or None if there hasn't been one.
+        """
+        return self.current or self.last
+
+    def backup(self):
+        """
+        Take a snapshot, returning a Deferred that fires with its path. A
+        backup already in progress fails this one with
+        :exc:`BackupInProgress`.
+        """
+        if self._running is not None:
+            return defer.fail(BackupInProgress())
+        # Stopping the database waits for the whole copy, not just the
+        # step in progress, so that it can still close the backup.
+        self._running = d = self.dbpool.holdOpenUntil(self._backup())
+        d.addBoth(self._finished)
+        return d
+
+    def _finished(self, result):
+        self._running = None
+        self.last, self.current = self.current, None
+        waiters, self._stopWaiters = self._stopWaiters, []
+        for waiter in waiters:
+            waiter.callback(None)
+        return result
+
+    def _scheduledBackup(self):
+        d = self.backup()
+        d.addErrback(
+            lambda f: log.failure(u'error taking scheduled backup', f))
+        return d
+
+    def snapshots(self):
+        """
+        Return the paths of the finished snapshots, oldest first.
+        """
+        return sorted(glob.glob(os.path.join(
+            self.directory, self.prefix + '*' + self.suffix)))
+
+    @defer.inlineCallbacks
+    def _backup(self):
+        started = self._clock.seconds()
+        path = os.path.join(self.directory, '%s%s%s' % (
+            self.prefix, time.strftime('%Y%m%dT%H%M%S', time.gmtime(started)),
+            self.suffix))
+        partial = path + '.partial'
+        self.current = progress = dict(
+            path=path, started=started, finished=None, state='copying',
+            pages=None, remaining=None, restarts=0, error=None)
+        log.info(u'backing up the database to {path}', path=path)
+        if os.path.exists(partial):
+            os.remove(partial)
+        backup = None
+        try:
+            backup = yield self.dbpool.runInThread(
+                OnlineBackup, self.source, partial)
+            done = False
+            while not done:
+                pages = self.pagesPerStep
+                if progress['restarts'] >= self.maxRestarts:
+                    pages = -1
+                done = yield self.dbpool.runInThread(backup.step, pages)
+                if (progress['remaining'] is not None
+                        and backup.remaining > progress['remaining']):
+                    progress['restarts'] += 1
+                progress.update(
+                    pages=backup.pagecount, remaining=backup.remaining)
+                if not done:
+                    if pages < 0:
+                        raise BackupError(
+                            'restarted %d times, then found the database '
+                            'locked' % (progress['restarts'],))
+                    if not self.running:
+                        raise BackupError('stopped before finishing')
+                    yield task.deferLater(
+                        self._clock, self.stepPause, lambda: None)
+                    if not self.running:
+                        raise BackupError('stopped before finishing')
+        except Exception as e:
+            # Yielding below would lose the exception being handled.
+            f = failure.Failure()
+            progress.update(state='failed', error=str(e),
+                            finished=self._clock.seconds())
+            if backup is not None:
+                try:
+                    yield self.dbpool.runInThread(backup.close)
+                except BackupError:
+                    pass
+            if os.path.exists(partial):
+                os.remove(partial)
+            f.raiseException()
+        yield self.dbpool.runInThread(backup.close)
+        os.rename(partial, path)
+        progress.update(state='done', finished=self._clock.seconds())
+        log.info(u'backed up {pages} pages to {path} in {elapsed:.1f}s',
+                 pages=backup.pagecount, path=path,
+                 elapsed=progress['finished'] - started)
+        self._rotate()
+        defer.returnValue(path)
+
+    def _rotate(self):
+        snapshots = self.snapshots()
+        for old in snapshots[:max(0, len(snapshots) - self.keep)]:
+            log.info(u'removing old backup {path}', path=old)
+            os.remove(old)
@@ -0,0 +1,318 @@
+"""
+Export and import bans, for moving them between channels or networks or
+seeding a new deployment.
+
+Bans are written and read as NDJSON (one object per line) or CSV (with a
+header row), with times in seconds since the epoch and each ban's edit link
+codes. Both directions stream: exports are written a batch at a time as the
+query runs, and imports are read a batch at a time, each batch added in one
+transaction while the next is being read. Importing the same bans twice is
+harmless; see ``InfobobDatabaseRunner.import_bans``.
+
+Usage: infobob-bantool <export|import> [options] <config file>
+"""
+from __future__ import with_statement
+import csv
+import json
+import sys
+import time
+
+from twisted.internet import defer, task
+from twisted.python import failure, usage
+
+from infobob.config import InfobobConfig
+from infobob.database import BanRow, InfobobDatabaseRunner
+
+FIELDS = list(BanRow._fields) + ['auth']
+_TIMES = frozenset(['set_at', 'expire_at', 'unset_at'])
+_REQUIRED = frozenset(['channel', 'mask', 'mode', 'set_at', 'set_by'])
+
+
+class Progress(object):
+    """
+    Count the bans handled, reporting the count and rate to ``out`` at most
+    every ``interval`` seconds.
+    """
+    def __init__(self, verb, out, interval=5, clock=time.time):
+        self.verb = verb
+        self.count = 0
+        self._out = out
+        self._interval = interval
+        self._clock = clock
+        self._started = self._reported = clock()
+
+    def add(self, count):
+        self.count += count
+        now = self._clock()
+        if now - self._reported >= self._interval:
+            self._reported = now
+            self.report()
+
+    def report(self, suffix=''):
+        elapsed = self._clock() - self._started
+        rate = self.count / elapsed if elapsed > 0 else 0.0
+        self._out.write('%s %d bans in %.1fs (%.0f/s)%s\n' % (
+            self.verb, self.count, elapsed, rate, suffix))
+
+
+def _text(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def _number(value):
+    if value is None or value == '':
+        return None
+    value = float(value)
+    return int(value) if value.is_integer() else value
+
+
+def ndjsonWriter(out):
+    def write(ban, codes):
+        record = dict(zip(BanRow._fields, ban), auth=codes)
+        for key, value in record.items():
+            if isinstance(value, str):
+                record[key] = value.decode('utf-8', 'replace')
+        out.write(json.dumps(record, sort_keys=True, separators=(',', ':')))
+        out.write('\n')
+    return write
+
+
+def csvWriter(out):
+    writer = csv.writer(out)
+    writer.writerow(FIELDS)
+
+    def write(ban, codes):
+        writer.writerow(
+            ['' if value is None else value for value in ban]
+            + [' '.join(codes)])
+    return write
+
+
+def ndjsonRecords(lines):
+    for line in lines:
+        if line.strip():
+            yield json.loads(line)
+
+
+def csvRecords(lines):
+    reader = csv.DictReader(lines)
+    for record in reader:
+        if record.get('auth') is not None:
+            record['auth'] = record['auth'].split()
+        yield record
+
+
+WRITERS = {'ndjson': ndjsonWriter, 'csv': csvWriter}
+READERS = {'ndjson': ndjsonRecords, 'csv': csvRecords}
+
+
+def parseRecord(record, channelMap=None):
+    """
+    Convert a record read from an export to a ``(ban, codes)`` pair, as
+    taken by ``import_bans``, moving it to another channel if
+    ``channelMap`` says to. Raise ValueError if it isn't a ban.
+    """
+    missing = [field for field in _REQUIRED if not record.get(field)]
+    if missing:
+        raise ValueError('missing %s' % (', '.join(sorted(missing)),))
+    values = []
+    for field in BanRow._fields:
+        value = record.get(field)
+        if field in _TIMES:
+            value = _number(value)
+        elif value == '':
+            value = None
+        values.append(_text(value))
+    ban = BanRow._make(values)
+    if channelMap:
+        ban = ban._replace(channel=channelMap.get(ban.channel, ban.channel))
+    return ban, [_text(code) for code in record.get('auth') or []]
+
+
+def _batches(records, size, channelMap):
+    batch = []
+    for number, record in enumerate(records, 1):
+        try:
+            batch.append(parseRecord(record, channelMap))
+        except ValueError as e:
+            raise ValueError('record %d: %s' % (number, e))
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+@defer.inlineCallbacks
+def exportBans(dbpool, out, format='ndjson', which='all', channels=None,
+               batchSize=5000, progress=None):
+    """
+    Write the bans of the ``which`` ban list to ``out`` in ``format``,
+    and return how many were written.
+    """
+    write = WRITERS[format](out)
+
+    def deliver(bans):
+        for ban, codes in bans:
+            write(ban, codes)
+        if progress is not None:
+            progress.add(len(bans))
+    count = yield dbpool.stream_bans(
+        deliver, which, batch_size=batchSize, channels=channels,
+        with_auth=True)
+    defer.returnValue(count)
+
+
+@defer.inlineCallbacks
+def importBans(dbpool, lines, format='ndjson', batchSize=5000,
+               channelMap=None, progress=None):
+    """
+    Import the bans in ``lines``, read as ``format``, a batch at a time,
+    and return how many were added and how many were changed.
+
+    While one batch is being written, the next is read and parsed.
+    """
+    added = changed = 0
+    writing = writingCount = None
+    batches = _batches(READERS[format](lines), batchSize, channelMap)
+    while True:
+        error = None
+        try:
+            batch = next(batches, None)
+        except ValueError:
+            # Still wait for the batch being written, which stays written.
+            error, batch = failure.Failure(), None
+        if writing is not None:
+            batchAdded, batchChanged = yield writing
+            added, changed = added + batchAdded, changed + batchChanged
+            if progress is not None:
+                progress.add(writingCount)
+        if error is not None:
+            error.raiseException()
+        if batch is None:
+            break
+        writing, writingCount = dbpool.import_bans(batch), len(batch)
+    defer.returnValue((added, changed))
+
+
+class _CommonOptions(usage.Options):
+    optParameters = [
+        ['format', 'f', 'ndjson', 'ndjson or csv.'],
+        ['batch-size', 'b', 5000, 'Bans per batch.', int],
+    ]
+
+    def parseArgs(self, config):
+        self['config'] = config
+
+    def postOptions(self):
+        if self['format'] not in WRITERS:
+            raise usage.UsageError('unknown format %r' % (self['format'],))
+
+
+class ExportOptions(_CommonOptions):
+    synopsis = '[options] <config file>'
+    optParameters = [
+        ['output', 'o', '-', 'File to write to, or - for stdout.'],
+        ['state', 's', 'all', 'Ban list to export: all, active or unset.'],
+    ]
+
+    def __init__(self):
+        _CommonOptions.__init__(self)
+        self['channels'] = []
+
+    def opt_channel(self, channel):
+        """Only export this channel's bans (repeatable)."""
+        self['channels'].append(channel)
+
+    def postOptions(self):
+        _CommonOptions.postOptions(self)
+        if self['state'] not in ('all', 'active', 'unset'):
+            raise usage.UsageError('unknown state %r' % (self['state'],))
+
+
+class ImportOptions(_CommonOptions):
+    synopsis = '[options] <config file>'
+    optParameters = [
+        ['input', 'i', '-', 'File to read from, or - for stdin.'],
+    ]
+
+    def __init__(self):
+        _CommonOptions.__init__(self)
+        self['channelMap'] = {}
+
+    def opt_move(self, move):
+        """Import OLD's bans into NEW, given as OLD=NEW (repeatable)."""
+        old, sep, new = move.partition('=')
+        if not sep or not old or not new:
+            raise usage.UsageError('--move takes OLD=NEW')
+        self['channelMap'][old] = new
+
+
+class BanToolOptions(usage.Options):
+    synopsis = 'Usage: infobob-bantool <export|import> [options] <config file>'
+    subCommands = [
+        ['export', None, ExportOptions, 'Write bans to a file.'],
+        ['import', None, ImportOptions, 'Add or update bans from a file.'],
+    ]
+
+    def postOptions(self):
+        if self.subCommand is None:
+            raise usage.UsageError('export or import?')
+
+
+def _open(path, mode, default):
+    if path == '-':
+        return default
+    return open(path, mode)
+
+
+@defer.inlineCallbacks
+def run(reactor, options, stderr=sys.stderr):
+    command = options.subOptions
+    conf = InfobobConfig()
+    with open(command['config']) as cfgFile:
+        conf.load(cfgFile)
+    dbpool = InfobobDatabaseRunner(conf)
+    dbpool.startService()
+    try:
+        if options.subCommand == 'export':
+            progress = Progress('exported', stderr)
+            out = _open(command['output'], 'wb', sys.stdout)
+            try:
+                yield exportBans(
+                    dbpool, out, command['format'], command['state'],
+                    command['channels'] or None, command['batch-size'],
+                    progress)
+            finally:
+                if out is not sys.stdout:
+                    out.close()
+            progress.report()
+        else:
+            progress = Progress('imported', stderr)
+            lines = _open(command['input'], 'rb', sys.stdin)
+            try:
+                added, changed = yield importBans(
+                    dbpool, lines, command['format'], command['batch-size'],
+                    command['channelMap'], progress)
+            finally:
+                if lines is not sys.stdin:
+                    lines.close()
+            progress.report(': %d added, %d changed' % (added, changed))
+    except (ValueError, IOError) as e:
+        # Batches already imported stay imported.
+        stderr.write('infobob-bantool: %s\n' % (e,))
+        raise SystemExit(1)
+    finally:
+        yield dbpool.stopService()
+
+
+def main(argv=None):
+    options = BanToolOptions()
+    try:
+        options.parseOptions(sys.argv[1:] if argv is None else argv)
+    except usage.UsageError as e:
+        sys.stderr.write('%s\n%s: %s\n' % (options, sys.argv[0], e))
+        sys.exit(2)
+    task.react(run, [options])
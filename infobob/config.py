@@ -14,6 +14,7 @@ _channel_defaults = dict(
     flood_control=None,
     key=None,
     default_ban_time=28800,
+    lol_kick_after=None,
 )
 
 class Channel(object):
@@ -51,6 +52,8 @@ class Channel(object):
             encoding=self.encoding)
 
 class InfobobConfig(object):
+    lagMonitor = banEvents = lolTracker = backupService = None
+
     def __init__(self):
         self.config = {}
         self.channels = {}
@@ -63,14 +66,62 @@ class InfobobConfig(object):
         self.setdefault('irc.ssl', False)
         self.setdefault('irc.port', 6667)
         self.setdefault('irc.password', None)
+        self.setdefault('irc.sync.join_batch_size', 10)
+        self.setdefault('irc.sync.interval', 1)
+        self.setdefault('irc.sync.timeout', 60)
+        self.setdefault('irc.ping.interval', 60)
+        self.setdefault('irc.ping.rtt_multiplier', 20)
+        self.setdefault('irc.ping.min_timeout', 30)
+        self.setdefault('irc.ping.max_timeout', 360)
+        self.setdefault('irc.ops_timeout', 60)
         self.setdefault('misc.magic8_file', None)
         self.setdefault('misc.manhole.socket_prefix', None)
         self.setdefault('misc.manhole.passwd_file', None)
         self.setdefault('channels.defaults', {})
+        self.setdefault('channel_groups', {})
+        self.setdefault('database.sqlite.slow_interaction_threshold', 0.5)
+        self.setdefault('database.sqlite.max_streams', 2)
+        self.setdefault('maintenance.interval', 600)
+        self.setdefault('maintenance.slice_seconds', 0.05)
+        self.setdefault('maintenance.batch_size', 500)
+        self.setdefault('maintenance.archive_after_days', 365)
+        self.setdefault('maintenance.auth_token_days', 30)
+        self.setdefault('maintenance.vacuum_pages', 100)
+        self.setdefault('backup.directory', None)
+        self.setdefault('backup.interval', None)
+        self.setdefault('backup.keep', 7)
+        self.setdefault('backup.pages_per_step', 64)
+        self.setdefault('backup.step_pause', 0.05)
+        self.setdefault('backup.max_restarts', 3)
+        self.setdefault('backup.admin_token', None)
         self.setdefault('misc.locale.dir',
             os.path.join(os.path.dirname(__file__), 'locale'))
         self.setdefault('misc.locale.default_lang', 'en')
         self.setdefault('misc.locale.default_encoding', 'utf-8')
+        self.setdefault('web.page_size', 100)
+        self.setdefault('web.max_page_size', 1000)
+        self.setdefault('web.stream_templates', True)
+        self.setdefault('web.auto_reload_templates', False)
+        self.setdefault('web.cache.max_entries', 200)
+        self.setdefault('web.cache.gzip_level', 6)
+        self.setdefault('web.stats.weeks', 12)
+        self.setdefault('web.stats.top_setters', 5)
+        self.setdefault('web.events.history', 1000)
+        self.setdefault('web.events.max_buffered', 65536)
+        self.setdefault('web.events.heartbeat', 15)
+        self.setdefault('web.export.write_timeout', 60)
+        self.setdefault('misc.lol.window', 120)
+        self.setdefault('misc.lol.buckets', 12)
+        self.setdefault('misc.lol.flush_interval', 30)
+        self.setdefault('misc.lol.retention_days', 7)
+        self.setdefault('misc.lag.interval', 0.5)
+        self.setdefault('misc.lag.window', 20)
+        self.setdefault('misc.lag.shed', {
+            'lol': 1.0,
+            'redent': 1.0,
+            'repaste': 2.0,
+            'web': 2.0,
+        })
 
     def __getitem__(self, item):
         obj = self.config
@@ -92,11 +143,43 @@ class InfobobConfig(object):
             section = section.setdefault(part, {})
         return section.setdefault(item[-1], value)
 
+    def reload(self, fobj):
+        """
+        Replace the configuration with the one in ``fobj``, and return the
+        old configuration's structure.
+
+        The new configuration is parsed in full before anything is
+        replaced, so a broken file leaves the old one in effect. The
+        channel objects already handed out are rebuilt from the new
+        configuration and swapped in along with it.
+        """
+        new = InfobobConfig()
+        new.load(fobj)
+        old, self.config = self.config, new.config
+        names = set(self.channels) | set(self.config.get('channels', {}))
+        names.discard('defaults')
+        self.channels = dict(
+            (name, self._makeChannel(name)) for name in names)
+        return old
+
     def channel(self, name):
         ret = self.channels.get(name)
-        if ret is not None:
-            return ret
-        ret = self.channels[name] = Channel(name, _channel_defaults, conf=self)
+        if ret is None:
+            ret = self.channels[name] = self._makeChannel(name)
+        return ret
+
+    def channel_group(self, name):
+        """
+        Return the channels in the channel group ``name`` is in, ``name``
+        first, or just ``name`` if it isn't in one.
+        """
+        for channels in self['channel_groups'].itervalues():
+            if name in channels:
+                return [name] + [other for other in channels if other != name]
+        return [name]
+
+    def _makeChannel(self, name):
+        ret = Channel(name, _channel_defaults, conf=self)
         channels = self['channels']
         ret.update(channels.get('defaults', {}))
         ret.update(channels.get(name, {}))
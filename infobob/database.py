@@ -1,15 +1,24 @@
+from twisted.application import service
 from twisted.enterprise import adbapi
-from functools import partial
+from twisted.internet import defer, reactor, threads
+from twisted import logger
+from functools import wraps
+import collections
 import dateutil.tz
 import datetime
+import itertools
 import sqlite3
 import time
 import uuid
 
+from infobob.util import Histogram
+
+log = logger.Logger()
+
 
 # TODO: Clarify the semantics of the bans table.
 #       Currently they are quite unclear, and are not symmetric between
-#       `get_expired_bans` and `get_recently_expired_bans`.
+#       `get_expired_bans` and the "expired" list of `get_bans_page`.
 #       Note that "ban is expired" and "ban has been unset" do NOT
 #       imply the other. The database should be the single source of
 #       truth for the *intention* of the chanops regarding the state of
@@ -19,15 +28,124 @@ import uuid
 local = dateutil.tz.tzlocal()
 sqlite3.register_adapter(datetime.datetime,
     lambda x: time.mktime(x.astimezone(local).timetuple()))
-sqlite3.register_converter('datetime',
-    lambda x: datetime.datetime.fromtimestamp(float(x)).replace(
-        tzinfo=local))
+
+def localtime(seconds):
+    """
+    Convert seconds since the epoch to a local datetime, or None to None.
+    """
+    if seconds is None:
+        return None
+    return datetime.datetime.fromtimestamp(seconds, local)
+
+class BanRow(collections.namedtuple('BanRow', [
+        'channel', 'mask', 'mode', 'set_at', 'set_by', 'expire_at', 'reason',
+        'unset_at', 'unset_by'])):
+    """
+    A ban, as returned by the ban queries.
+
+    Times are left as seconds since the epoch, as they're stored: most rows
+    are only ever formatted or serialized, so building a datetime for every
+    time of every row was most of what loading a page of bans allocated.
+    The ``*_datetime`` properties convert them for the rows that need it.
+    """
+    __slots__ = ()
+
+    set_at_datetime = property(lambda self: localtime(self.set_at))
+    expire_at_datetime = property(lambda self: localtime(self.expire_at))
+    unset_at_datetime = property(lambda self: localtime(self.unset_at))
+
+_ban_row = BanRow._make
 
 def interaction(func):
+    @wraps(func)
     def wrap(self, *a, **kw):
-        return self.dbpool.runInteraction(partial(func, self), *a, **kw)
+        return self.runInteraction(func, *a, **kw)
     return wrap
 
+_EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'WITH')
+
+class _RecordingTransaction(object):
+    """
+    Wrap an adbapi transaction, remembering every statement passed to
+    ``execute`` or ``executemany`` (with its first set of parameters) so
+    that slow interactions can have their query plans explained afterward.
+    """
+    def __init__(self, txn):
+        self._txn = txn
+        self.statements = []
+        # Time spent blocked on the reactor, which isn't the database's.
+        self.waited = 0.0
+
+    def execute(self, sql, params=()):
+        self.statements.append((sql, params))
+        return self._txn.execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        seq_of_params = iter(seq_of_params)
+        first = next(seq_of_params, None)
+        if first is not None:
+            self.statements.append((sql, first))
+            seq_of_params = itertools.chain([first], seq_of_params)
+        return self._txn.executemany(sql, seq_of_params)
+
+    def __getattr__(self, attr):
+        return getattr(self._txn, attr)
+
+    def __iter__(self):
+        return iter(self._txn)
+
+def _explain(conn, statements):
+    """
+    Return the query plans of ``statements``, as recorded by
+    :class:`_RecordingTransaction`, explained on ``conn``.
+    """
+    cursor = conn.cursor()
+    plans = []
+    for sql, params in statements:
+        if not sql.lstrip().upper().startswith(_EXPLAINABLE):
+            continue
+        try:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            plan = [row[-1] for row in cursor.fetchall()]
+        except sqlite3.Error as e:
+            plan = ['(could not explain: %s)' % (e,)]
+        plans.append((' '.join(sql.split()), plan))
+    return plans
+
+class InteractionStats(object):
+    """
+    Per-method timings of database interactions.
+
+    Queue wait (time spent waiting for a pool thread) and execution time
+    are kept in separate histograms. The most recent slow interactions
+    are kept along with the query plans of their statements.
+    """
+    def __init__(self, slow_log_size=50):
+        self.wait = collections.defaultdict(Histogram)
+        self.execution = collections.defaultdict(Histogram)
+        self.slow = collections.deque(maxlen=slow_log_size)
+
+    def record(self, name, wait, elapsed, plans=None):
+        self.wait[name].record(wait)
+        self.execution[name].record(elapsed)
+        if plans is None:
+            return
+        self.slow.append((time.time(), name, wait, elapsed, plans))
+        log.warn(
+            u'slow database interaction {name}: {elapsed:.3f}s '
+            u'(queued {wait:.3f}s)\n{explained}',
+            name=name, elapsed=elapsed, wait=wait,
+            explained=u'\n'.join(
+                u'  %s\n%s' % (sql, u''.join(u'    %s\n' % (p,) for p in plan))
+                for sql, plan in plans),
+        )
+
+    def summary(self):
+        return dict(
+            (name, dict(wait=self.wait[name].summary(),
+                        execution=hist.summary()))
+            for name, hist in self.execution.iteritems())
+
 class TooSoonError(Exception):
     pass
 
@@ -46,34 +164,373 @@ _ADD_HOST_TO_USER = """
     VALUES     (?, ?)
 """
 
-class InfobobDatabaseRunner(object):
+# The columns of a BanRow.
+_BAN_COLUMNS = """
+    channel, mask, mode, set_at, set_by, expire_at, reason, unset_at, unset_by
+"""
+
+# Each ban list is paged by keyset on (channel, <time column>, rowid): by
+# channel, then most recent first. The exception is the expired list, which
+# is the most recently expired bans across every channel, paged on
+# (<time column>, rowid) alone; its cursors still carry a channel, which is
+# ignored. The partial indexes in db.schema match these conditions and
+# orderings.
+_BAN_LISTS = {
+    'active': ('unset_at IS NULL', 'set_at', True),
+    'all': ('1', 'set_at', True),
+    'expired': (
+        "expire_at IS NOT NULL AND unset_at IS NOT NULL AND reason != ''",
+        'unset_at', False),
+    'unset': ('unset_at IS NOT NULL', 'unset_at', True),
+}
+
+# Relative weights of the bans_fts columns (reason, mask, set_by) when
+# ranking search results.
+_SEARCH_WEIGHTS = (1.0, 2.0, 0.5)
+
+def fts_query(text):
+    """
+    Turn whitespace-separated search terms into an FTS5 query matching bans
+    with all of them. Each term is quoted, so FTS5 syntax in it is matched
+    literally, except that a trailing ``*`` makes the term a prefix.
+    Return None if there are no terms.
+    """
+    phrases = []
+    for term in text.split():
+        prefix = term.endswith('*')
+        term = term.rstrip('*')
+        if not term:
+            continue
+        phrases.append('"%s"%s' % (term.replace('"', '""'),
+                                   '*' if prefix else ''))
+    return ' '.join(phrases) or None
+
+# What each bucket of ban_duration_buckets (in db.schema) holds.
+BAN_DURATION_BUCKETS = [
+    'under an hour', '1-6 hours', '6-24 hours', '1-3 days', '3-7 days',
+    '1-4 weeks', '1-3 months', '3-12 months', 'over a year',
+]
+
+_DAY = 24 * 60 * 60
+_WEEK = 7 * _DAY
+
+def current_week(now=None):
+    """
+    Return the number of the week holding ``now`` (by default, the current
+    time), as ban_stats_weekly numbers them.
+    """
+    if now is None:
+        now = time.time()
+    return int(now // _WEEK)
+
+def median_bucket(counts):
+    """
+    Return the index of the bucket holding the median of a histogram given
+    as a list of counts, or None if it's empty.
+    """
+    total = sum(counts)
+    seen = 0
+    for bucket, count in enumerate(counts):
+        seen += count
+        if total and seen * 2 >= total:
+            return bucket
+    return None
+
+def _in_slices(txn, batch, batch_size, budget):
+    """
+    Call ``batch(txn, batch_size)``, which handles up to ``batch_size`` rows
+    and returns how many it handled, until a batch comes up short or
+    ``budget`` seconds have passed. Return the number of rows handled, and
+    whether there are none left.
+    """
+    deadline = time.time() + budget
+    total = 0
+    while True:
+        count = batch(txn, batch_size)
+        total += count
+        if count < batch_size:
+            return total, True
+        if time.time() >= deadline:
+            return total, False
+
+def _archive_batch(before):
+    def batch(txn, batch_size):
+        txn.execute("""
+            SELECT rowid
+            FROM   bans
+            WHERE  unset_at < ?
+            LIMIT  ?
+        """, (before, batch_size))
+        rowids = [rowid for rowid, in txn.fetchall()]
+        if not rowids:
+            return 0
+        in_batch = ', '.join('?' * len(rowids))
+        # The archive row has to exist before the ban is deleted, so that
+        # the ban statistics keep counting it.
+        txn.execute("""
+            INSERT INTO bans_archive
+                        (ban, channel, mask, mode, set_at, set_by, expire_at,
+                         unset_at, unset_by, reason)
+            SELECT rowid, channel, mask, mode, set_at, set_by, expire_at,
+                   unset_at, unset_by, reason
+            FROM   bans
+            WHERE  rowid IN (%s)
+        """ % (in_batch,), rowids)
+        txn.execute("""
+            DELETE FROM ban_authorizations
+            WHERE       ban IN (%s)
+        """ % (in_batch,), rowids)
+        txn.execute("""
+            DELETE FROM bans
+            WHERE       rowid IN (%s)
+        """ % (in_batch,), rowids)
+        return len(rowids)
+    return batch
+
+def _expire_auth_batch(before):
+    def batch(txn, batch_size):
+        txn.execute("""
+            DELETE FROM ban_authorizations
+            WHERE       rowid IN (
+                SELECT authz.rowid
+                FROM   ban_authorizations authz
+                       LEFT JOIN bans
+                              ON bans.rowid = authz.ban
+                WHERE  (bans.set_at < ? AND bans.unset_at IS NOT NULL)
+                       OR bans.rowid IS NULL
+                LIMIT  ?)
+        """, (before, batch_size))
+        return txn.rowcount
+    return batch
+
+def _prune_user_hosts_batch(txn, batch_size):
+    txn.execute("""
+        DELETE FROM user_hosts
+        WHERE       rowid IN (
+            SELECT rowid
+            FROM   user_hosts
+            WHERE  NOT EXISTS (SELECT 1
+                               FROM   channel_users
+                               WHERE  channel_users.nick = user_hosts.nick)
+            LIMIT  ?)
+    """, (batch_size,))
+    return txn.rowcount
+
+def _ban_list_filter(which, channels, mode, mask, set_by, since, until):
+    """
+    Return the time column of the ``which`` ban list, whether it's ordered
+    by channel first, and the conditions and named parameters selecting its
+    bans that match the filters, as described for ``get_bans_page``.
+    """
+    condition, at_column, by_channel = _BAN_LISTS[which]
+    conditions = [condition]
+    params = {}
+    if channels:
+        conditions.append('channel IN (%s)' % ', '.join(
+            ':channel%d' % (i,) for i in xrange(len(channels))))
+        params.update(
+            ('channel%d' % (i,), channel)
+            for i, channel in enumerate(channels))
+    for value, clause in [
+            (mode, 'mode = :mode'),
+            (mask, 'mask GLOB :mask'),
+            (set_by, 'set_by GLOB :set_by'),
+            (since, '%s >= :since' % (at_column,)),
+            (until, '%s < :until' % (at_column,))]:
+        if value is not None:
+            conditions.append(clause)
+    params.update(mode=mode, mask=mask, set_by=set_by, since=since,
+                  until=until)
+    return at_column, by_channel, conditions, params
+
+def _ban_list_order(at_column, by_channel):
+    """
+    Return the ORDER BY clause of a ban list, and the condition selecting
+    the bans after the ``:after_channel``, ``:after_at`` and
+    ``:after_rowid`` cursor in that order.
+    """
+    after = ('(%(at)s < :after_at'
+             ' OR (%(at)s = :after_at AND rowid > :after_rowid))'
+             % dict(at=at_column))
+    if not by_channel:
+        return '%s DESC, rowid' % (at_column,), after
+    return ('channel, %s DESC, rowid' % (at_column,),
+            '(channel > :after_channel'
+            ' OR (channel = :after_channel AND %s))' % (after,))
+
+class InfobobDatabaseRunner(service.Service):
+    """
+    Run interactions against the bot's database.
+
+    The connection pool belongs to the service hierarchy rather than to any
+    IRC connection, so it stays open (and its connections warm) across
+    reconnects. Stopping the service abandons any streams in progress (see
+    ``stream_bans``), then waits for every interaction already queued to
+    finish before closing the pool.
+    """
+    name = 'database'
+
     def __init__(self, conf):
         self._conf = conf
         self.dbpool = adbapi.ConnectionPool(
             'sqlite3', self._conf['database.sqlite.db_file'],
             check_same_thread=False,
-            cp_openfun=self._setup_connection,
-            detect_types=sqlite3.PARSE_COLNAMES)
+            cp_openfun=self._setup_connection)
+        self.slow_threshold = self._conf[
+            'database.sqlite.slow_interaction_threshold']
+        self.stats = InteractionStats()
+        # Part of every ETag along with the bans_version counter, so that
+        # tags handed out before a restart (or before a backup was restored)
+        # are never mistaken for current ones.
+        self.epoch = uuid.uuid4().hex[:8]
+        self._pending = set()
+        self._closed = False
+        # Each stream holds a pool thread until its consumer is done, so
+        # only a few may run at once, leaving the rest for the bot.
+        self.streams = defer.DeferredSemaphore(
+            self._conf['database.sqlite.max_streams'])
+        self._delivering = set()
+        self._stopping = False
+
+    def startService(self):
+        service.Service.startService(self)
+        self.dbpool.start()
+
+    def stopService(self):
+        service.Service.stopService(self)
+        self._stopping = True
+        for wanted in list(self._delivering):
+            wanted.callback(False)
+        if self._pending:
+            log.info(u'waiting on {count} database interactions',
+                     count=len(self._pending))
+        return self.drain().addCallback(lambda ignored: self.close())
+
+    def drain(self):
+        """
+        Return a Deferred that fires once every interaction queued so far
+        has finished.
+        """
+        return defer.gatherResults(list(self._pending))
+
+    def runInteraction(self, func, *a, **kw):
+        """
+        Run ``func(self, txn, *a, **kw)`` in a transaction on a pool thread,
+        timing it, and return a Deferred that fires with its result.
+        """
+        done = defer.Deferred()
+        self._pending.add(done)
+        d = self.dbpool.runInteraction(
+            self._timedInteraction, func, time.time(), *a, **kw)
+        return d.addBoth(self._interactionDone, done)
+
+    def runInThread(self, func, *a, **kw):
+        """
+        Run ``func(*a, **kw)`` on one of the pool's threads, outside of any
+        transaction, and return a Deferred that fires with its result. It's
+        waited for on stop like any interaction.
+        """
+        done = defer.Deferred()
+        self._pending.add(done)
+        d = threads.deferToThreadPool(
+            reactor, self.dbpool.threadpool, func, *a, **kw)
+        return d.addBoth(self._interactionDone, done)
+
+    def holdOpenUntil(self, d):
+        """
+        Keep stopping from closing the pool until ``d`` fires, for work
+        made of several interactions or threaded calls in a row, whose
+        later steps would otherwise find the pool closed under them.
+        Returns ``d``.
+        """
+        done = defer.Deferred()
+        self._pending.add(done)
+        return d.addBoth(self._interactionDone, done)
+
+    def _interactionDone(self, result, done):
+        self._pending.discard(done)
+        done.callback(None)
+        return result
+
+    def _auth_valid_since(self):
+        days = self._conf['maintenance.auth_token_days']
+        if days is None:
+            return float('-inf')
+        return time.time() - days * _DAY
 
     def _setup_connection(self, conn):
         conn.text_factory = str
+        # Readers don't block the bot's writes in WAL mode, which matters
+        # for streams held open by slow clients.
+        conn.execute('PRAGMA journal_mode = WAL')
+
+    def _timedInteraction(self, txn, func, queued_at, *a, **kw):
+        started_at = time.time()
+        recorder = _RecordingTransaction(txn)
+        try:
+            return func(self, recorder, *a, **kw)
+        finally:
+            elapsed = time.time() - started_at - recorder.waited
+            statements = None
+            if (self.slow_threshold is not None
+                    and elapsed >= self.slow_threshold):
+                statements = recorder.statements
+            reactor.callFromThread(
+                self._recordInteraction, func.__name__,
+                started_at - queued_at, elapsed, statements)
+
+    def _recordInteraction(self, name, wait, elapsed, statements):
+        # A slow interaction's statements are explained once it's been
+        # committed, in an interaction of their own, so as not to hold
+        # its transaction (and any write lock) open for longer still.
+        if statements is None:
+            self.stats.record(name, wait, elapsed)
+            return
+        if self._closed:
+            self.stats.record(name, wait, elapsed, [])
+            return
+        d = self.dbpool.runWithConnection(_explain, statements)
+        d.addErrback(lambda f: [('(could not explain: %s)' % (
+            f.getErrorMessage(),), [])])
+        d.addCallback(
+            lambda plans: self.stats.record(name, wait, elapsed, plans))
+        self.holdOpenUntil(d)
 
     def close(self):
+        if self._closed:
+            return
+        self._closed = True
         self.dbpool.close()
 
     @interaction
-    def add_lol(self, txn, nick):
+    def add_lols(self, txn, offenses):
+        txn.executemany("""
+            INSERT OR IGNORE INTO lol_offenses
+                                  (username, time_of)
+            VALUES                (?, ?)
+        """, offenses)
+
+    @interaction
+    def roll_up_lols(self, txn, before):
+        """
+        Fold the offenses from before ``before`` into daily totals per nick,
+        and return how many were folded.
+        """
         txn.execute("""
-            INSERT INTO lol_offenses
-            VALUES     (?, ?)
-        """, (nick, time.time()))
+            INSERT INTO lol_offenses_daily
+                        (username, day, offenses)
+            SELECT   username, CAST(time_of / 86400 AS INTEGER), COUNT(*)
+            FROM     lol_offenses
+            WHERE    time_of < ?
+            GROUP BY 1, 2
+            ON CONFLICT (username, day)
+            DO UPDATE SET offenses = offenses + excluded.offenses
+        """, (before,))
         txn.execute("""
-            SELECT COUNT(*)
-            FROM   lol_offenses
-            WHERE  username = ?
-                   AND time_of >= ?
-        """, (nick, time.time() - 120))
-        return txn.fetchall()[0][0]
+            DELETE FROM lol_offenses
+            WHERE       time_of < ?
+        """, (before,))
+        return txn.rowcount
 
     @interaction
     def set_users_in_channel(self, txn, nicks, channel):
@@ -85,6 +542,17 @@ class InfobobDatabaseRunner(object):
         txn.executemany(_ADD_USER_TO_CHANNEL,
             ((nick, channel) for nick in nicks))
 
+    @interaction
+    def sync_users_in_channel(self, txn, channel, joined, left):
+        txn.executemany("""
+            DELETE FROM channel_users
+            WHERE       nick = ?
+                        AND channel = ?
+        """, ((nick, channel) for nick in left))
+        txn.executemany(_ADD_HOST_TO_USER, joined.iteritems())
+        txn.executemany(_ADD_USER_TO_CHANNEL,
+            ((nick, channel) for nick in joined))
+
     @interaction
     def add_user_to_channel(self, txn, nick, host, channel):
         txn.execute(_ADD_HOST_TO_USER, (nick, host))
@@ -117,6 +585,16 @@ class InfobobDatabaseRunner(object):
             WHERE  nick = ?
         """, (newnick, oldnick))
 
+    @interaction
+    def get_bans_version(self, txn):
+        """
+        Return the bans table's version, which goes up with every change to
+        it from any process; see bans_version in db.schema.
+        """
+        txn.execute('SELECT version FROM bans_version')
+        [(version,)] = txn.fetchall()
+        return version
+
     @interaction
     def ensure_active_bans(self, txn, channel, mode, bans):
         bans = [(mask, set_by, set_at) for mask, set_by, set_at in bans
@@ -169,6 +647,67 @@ class InfobobDatabaseRunner(object):
         """, (channel, mask, mode, now, host, expire_at))
         return txn.lastrowid
 
+    @interaction
+    def import_bans(self, txn, bans):
+        """
+        Add or update ``bans``, a list of ``(ban, codes)`` pairs of a
+        BanRow and its edit link codes, and return how many bans were
+        added and how many were changed.
+
+        A ban is the same ban as one already in the table if it has the
+        same channel, mask, mode and time set, so importing the same bans
+        again changes nothing.
+        """
+        rows = [tuple(ban) for ban, codes in bans]
+        txn.executemany("""
+            UPDATE bans
+            SET    set_by = ?5, expire_at = ?6, reason = ?7, unset_at = ?8,
+                   unset_by = ?9
+            WHERE  channel = ?1 AND mask = ?2 AND mode = ?3 AND set_at = ?4
+                   AND (set_by IS NOT ?5 OR expire_at IS NOT ?6
+                        OR reason IS NOT ?7 OR unset_at IS NOT ?8
+                        OR unset_by IS NOT ?9)
+        """, rows)
+        changed = txn.rowcount
+        txn.executemany("""
+            INSERT INTO bans
+                   (channel, mask, mode, set_at, set_by, expire_at, reason,
+                    unset_at, unset_by)
+            SELECT ?1, ?2, ?3, ?4, ?5, ?6, ?7, ?8, ?9
+            WHERE  NOT EXISTS (
+                SELECT 1
+                FROM   bans
+                WHERE  channel = ?1 AND mask = ?2 AND mode = ?3
+                       AND set_at = ?4)
+        """, rows)
+        added = txn.rowcount
+        txn.executemany("""
+            INSERT OR IGNORE INTO ban_authorizations
+                   (ban, code)
+            SELECT rowid, ?5
+            FROM   bans
+            WHERE  channel = ?1 AND mask = ?2 AND mode = ?3 AND set_at = ?4
+        """, [tuple(ban[:4]) + (code,) for ban, codes in bans
+              for code in codes])
+        return added, changed
+
+    @interaction
+    def add_ban_copy(self, txn, rowid, channel):
+        """
+        Add a copy of the ban ``rowid`` to ``channel``, with the same mask,
+        mode, setter, reason, and times set and expiring, and return the
+        copy's rowid.
+        """
+        txn.execute("""
+            INSERT INTO bans
+                        (channel, mask, mode, set_at, set_by, expire_at,
+                         reason)
+            SELECT ?, mask, mode, set_at, set_by, expire_at, reason
+            FROM   bans
+            WHERE  rowid = ?
+        """, (channel, rowid))
+        return txn.lastrowid
+
     @interaction
     def add_ban_auth(self, txn, rowid):
         auth = uuid.uuid4().hex
@@ -205,23 +744,254 @@ class InfobobDatabaseRunner(object):
         return not_expired
 
     @interaction
-    def get_all_bans(self, txn):
+    def get_bans_page(self, txn, which, after=None, limit=100, channels=None,
+                      mode=None, mask=None, set_by=None, since=None,
+                      until=None):
+        """
+        Return a page of bans from the ``which`` ban list (one of
+        ``_BAN_LISTS``) and the cursor for the page after it, or None if
+        this is the last page.
+
+        ``after`` is a cursor from a previous page, and ``channels``
+        optionally limits the bans to those channels. Rather than using an
+        OFFSET, each page starts from the cursor's position in the index,
+        so fetching a page costs the same wherever it is in the history.
+        Bans come by channel, then most recent first, except on the
+        expired list, which is most recent first across all channels.
+
+        The bans can be further filtered by ``mode``, by GLOB patterns for
+        ``mask`` and ``set_by``, and by a ``since`` (inclusive) and
+        ``until`` (exclusive) range of the list's time column, in seconds
+        since the epoch.
+        """
+        at_column, by_channel, conditions, params = _ban_list_filter(
+            which, channels, mode, mask, set_by, since, until)
+        params['limit'] = limit + 1
+        order, after_cursor = _ban_list_order(at_column, by_channel)
+        query = """
+            SELECT   rowid, %(at)s, %(columns)s
+            FROM     bans
+            WHERE    %%s
+            ORDER BY %(order)s
+            LIMIT    :limit
+        """ % dict(at=at_column, columns=_BAN_COLUMNS, order=order)
+
+        rows = []
+        if after is not None:
+            after_channel, after_at, after_rowid = after
+            params.update(after_channel=after_channel, after_at=after_at,
+                          after_rowid=after_rowid)
+            if not by_channel:
+                conditions.append(after_cursor)
+            else:
+                # The rest of the cursor's channel, then the channels after
+                # it; keeping these apart lets each one walk the index.
+                txn.execute(query % ' AND '.join(conditions + [
+                    'channel = :after_channel',
+                    '%s <= :after_at' % (at_column,),
+                    '(%s < :after_at OR rowid > :after_rowid)' % (at_column,),
+                ]), params)
+                rows = txn.fetchall()
+                conditions.append('channel > :after_channel')
+        if len(rows) <= limit:
+            params['limit'] = limit + 1 - len(rows)
+            txn.execute(query % ' AND '.join(conditions), params)
+            rows.extend(txn.fetchall())
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            rowid, at = rows[-1][:2]
+            next_cursor = (rows[-1][2], at, rowid)
+        return [_ban_row(row[2:]) for row in rows], next_cursor
+
+    def stream_bans(self, deliver, which, **kwargs):
+        """
+        Fetch the ``which`` ban list, filtered and ordered as for
+        ``get_bans_page``, and hand the bans to ``deliver`` in lists of up
+        to ``batch_size`` as they're fetched, rather than collecting them
+        all first. Return how many bans were delivered.
+
+        ``deliver`` is called in the reactor thread, and may return a
+        Deferred; the next batch isn't fetched until it fires. If it
+        returns, or its Deferred fires with, False, the rest of the bans
+        are abandoned. This keeps one of the pool's threads and a read
+        transaction for as long as the consumer takes, so only
+        ``streams`` (``database.sqlite.max_streams``) run at once and the
+        rest wait their turn. Stopping the runner abandons them all.
+
+        If ``with_auth`` is true, each ban is delivered as a ``(ban,
+        codes)`` pair, with the ban's edit link codes.
+        """
+        def stream():
+            if self._stopping:
+                return 0
+            return self._stream_bans(deliver, which, **kwargs)
+        return self.streams.run(stream)
+
+    def _deliver(self, deliver, bans):
+        if self._stopping:
+            return False
+        wanted = defer.Deferred()
+        self._delivering.add(wanted)
+
+        def delivered(result):
+            self._delivering.discard(wanted)
+            if not wanted.called:
+                wanted.callback(result)
+        defer.maybeDeferred(deliver, bans).addBoth(delivered)
+        return wanted
+
+    @interaction
+    def _stream_bans(self, txn, deliver, which, after=None, batch_size=500,
+                     channels=None, mode=None, mask=None, set_by=None,
+                     since=None, until=None, with_auth=False):
+        at_column, by_channel, conditions, params = _ban_list_filter(
+            which, channels, mode, mask, set_by, since, until)
+        order, after_cursor = _ban_list_order(at_column, by_channel)
+        if after is not None:
+            (params['after_channel'], params['after_at'],
+             params['after_rowid']) = after
+            conditions.append(after_cursor)
+        columns = _BAN_COLUMNS
+        make_row = _ban_row
+        if with_auth:
+            columns += """,
+                (SELECT group_concat(code, ' ')
+                 FROM   ban_authorizations
+                 WHERE  ban = bans.rowid)"""
+            make_row = lambda row: (
+                _ban_row(row[:-1]), row[-1].split() if row[-1] else [])
         txn.execute("""
-            SELECT channel, mask, mode, set_at as "set_at [datetime]", set_by, expire_at as "expire_at [datetime]", reason, unset_at as "unset_at [datetime]", unset_by
-            FROM   bans
-            ORDER BY channel, set_at DESC
-        """)
-        return txn.fetchall()
+            SELECT   %s
+            FROM     bans
+            WHERE    %s
+            ORDER BY %s
+        """ % (columns, ' AND '.join(conditions), order), params)
+        delivered = 0
+        while True:
+            rows = txn.fetchmany(batch_size)
+            if not rows:
+                break
+            delivered += len(rows)
+            waiting_since = time.time()
+            wanted = threads.blockingCallFromThread(
+                reactor, self._deliver, deliver, map(make_row, rows))
+            txn.waited += time.time() - waiting_since
+            if wanted is False:
+                break
+        return delivered
 
     @interaction
-    def get_active_bans(self, txn):
+    def search_bans(self, txn, text, after=None, limit=100, channels=None):
+        """
+        Return a page of the bans matching the search terms in ``text``,
+        best matches first, and the cursor for the page after it, or None
+        if this is the last page.
+
+        See :func:`fts_query` for how ``text`` is interpreted. As with
+        ``get_bans_page``, ``after`` is a cursor from a previous page and
+        ``channels`` optionally limits the bans to those channels.
+        """
+        query = fts_query(text)
+        if query is None:
+            return [], None
+        conditions = ['1']
+        params = {'query': query, 'limit': limit + 1}
+        if channels:
+            conditions.append('channel IN (%s)' % ', '.join(
+                ':channel%d' % (i,) for i in xrange(len(channels))))
+            params.update(
+                ('channel%d' % (i,), channel)
+                for i, channel in enumerate(channels))
+        if after is not None:
+            params['after_score'], params['after_rowid'] = after
+            conditions.append(
+                '(score > :after_score'
+                ' OR (score = :after_score AND bans.rowid > :after_rowid))')
         txn.execute("""
-            SELECT channel, mask, mode, set_at as "set_at [datetime]", set_by, expire_at as "expire_at [datetime]", reason, unset_at as "unset_at [datetime]", unset_by
-            FROM   bans
-            WHERE  unset_at IS NULL
-            ORDER BY channel, set_at DESC
+            SELECT   bans.rowid, score, %s
+            FROM     (SELECT rowid, bm25(bans_fts, %s) AS score
+                      FROM   bans_fts
+                      WHERE  bans_fts MATCH :query) AS matches
+                     JOIN bans ON bans.rowid = matches.rowid
+            WHERE    %s
+            ORDER BY score, bans.rowid
+            LIMIT    :limit
+        """ % (_BAN_COLUMNS, ', '.join(map(repr, _SEARCH_WEIGHTS)),
+               ' AND '.join(conditions)), params)
+        rows = txn.fetchall()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            rowid, score = rows[-1][:2]
+            next_cursor = (score, rowid)
+        return [_ban_row(row[2:]) for row in rows], next_cursor
+
+    @interaction
+    def get_ban_stats(self, txn, weeks=12, top_setters=5, week=None):
+        """
+        Return statistics for each channel with bans, in channel order.
+
+        Each channel's dict has its ``active``, ``total`` and
+        ``account_masks`` ban counts; ``weekly``, the bans set in each of
+        the ``weeks`` weeks up to ``week`` (by default, the current week;
+        see :func:`current_week`), oldest first; ``setters``, the
+        ``top_setters`` most prolific setters and their counts; and
+        ``durations``, the unset bans in each of BAN_DURATION_BUCKETS.
+
+        Only the aggregate tables maintained by db.schema's triggers are
+        read, never bans itself.
+        """
+        txn.execute("""
+            SELECT   channel, active, total, account_masks
+            FROM     ban_stats_channels
+            WHERE    total > 0
+            ORDER BY channel
         """)
-        return txn.fetchall()
+        stats = collections.OrderedDict(
+            (channel, dict(
+                channel=channel, active=active, total=total,
+                account_masks=account_masks, weekly=[0] * weeks,
+                setters=[], durations=[0] * len(BAN_DURATION_BUCKETS)))
+            for channel, active, total, account_masks in txn.fetchall())
+
+        if week is None:
+            week = current_week()
+        first_week = week - weeks + 1
+        txn.execute("""
+            SELECT channel, week, bans
+            FROM   ban_stats_weekly
+            WHERE  week >= ?
+        """, (first_week,))
+        for channel, week, bans in txn.fetchall():
+            if channel in stats and week - first_week < weeks:
+                stats[channel]['weekly'][week - first_week] = bans
+
+        txn.execute("""
+            SELECT channel, setter, bans
+            FROM   (SELECT channel, setter, bans,
+                           row_number() OVER (
+                               PARTITION BY channel
+                               ORDER BY bans DESC, setter) AS place
+                    FROM   ban_stats_setters
+                    WHERE  bans > 0)
+            WHERE  place <= ?
+            ORDER BY channel, place
+        """, (top_setters,))
+        for channel, setter, bans in txn.fetchall():
+            if channel in stats:
+                stats[channel]['setters'].append((setter, bans))
+
+        txn.execute("""
+            SELECT channel, bucket, bans
+            FROM   ban_stats_durations
+        """)
+        for channel, bucket, bans in txn.fetchall():
+            if channel in stats:
+                stats[channel]['durations'][bucket] = bans
+        return stats.values()
 
     @interaction
     def get_expired_bans(self, txn):
@@ -234,34 +1004,22 @@ class InfobobDatabaseRunner(object):
         """, (time.time(),))
         return txn.fetchall()
 
-    @interaction
-    def get_recently_expired_bans(self, txn, count=10):
-        txn.execute("""
-            SELECT channel, mask, mode, set_at as "set_at [datetime]", set_by, expire_at as "expire_at [datetime]", reason, unset_at as "unset_at [datetime]", unset_by
-            FROM bans
-            WHERE expire_at IS NOT NULL
-                  AND unset_at IS NOT NULL
-                  AND reason != ''
-            ORDER BY unset_at DESC
-            LIMIT ?
-        """, (count,))
-        return txn.fetchall()
-
     @interaction
     def get_ban_with_auth(self, txn, rowid, auth):
         txn.execute("""
-            SELECT channel, mask, mode, set_at as "set_at [datetime]", set_by, expire_at as "expire_at [datetime]", reason, unset_at as "unset_at [datetime]", unset_by
+            SELECT %s
             FROM   bans
             JOIN   ban_authorizations authz
                    ON bans.rowid = authz.ban
             WHERE  authz.ban = ?
                    AND authz.code = ?
+                   AND (bans.unset_at IS NULL OR bans.set_at >= ?)
             LIMIT  1
-        """, (rowid, auth))
+        """ % (_BAN_COLUMNS,), (rowid, auth, self._auth_valid_since()))
         res = txn.fetchall()
         if not res:
             raise NoSuchBan()
-        return res[0]
+        return _ban_row(res[0])
 
     @interaction
     def check_mask(self, txn, channel, mask):
@@ -300,10 +1058,98 @@ class InfobobDatabaseRunner(object):
         """, (reason, channel, mask, mode))
 
     @interaction
-    def update_ban_by_rowid(self, txn, rowid, expire_at, reason):
+    def update_ban_by_rowid(self, txn, rowid, expire_at, reason, group=()):
+        """
+        Set a ban's expiry and reason. The same ban, still set, in each of
+        the ``group`` channels (one set at the same time, as copied by
+        ``add_ban_copy``) is updated along with it.
+
+        Return the channels of the bans that were changed, leaving out any
+        that already had that expiry and reason.
+        """
+        params = dict(expire_at=expire_at, reason=reason, rowid=rowid)
+        query = """
+            SELECT rowid, channel
+            FROM   bans
+            WHERE  rowid = :rowid
+        """
+        if group:
+            params.update(
+                ('channel%d' % (i,), channel)
+                for i, channel in enumerate(group))
+            query += """
+                UNION
+                SELECT rowid, channel
+                FROM   bans
+                WHERE  channel IN (%s)
+                       AND unset_at IS NULL
+                       AND (mask, mode, set_at) = (
+                           SELECT mask, mode, set_at
+                           FROM   bans
+                           WHERE  rowid = :rowid)
+            """ % (', '.join(
+                ':channel%d' % (i,) for i in xrange(len(group))),)
         txn.execute("""
+            SELECT   rowid, channel
+            FROM     bans
+            WHERE    rowid IN (SELECT rowid FROM (%s))
+                     AND (expire_at IS NOT :expire_at
+                          OR reason IS NOT :reason)
+            ORDER BY rowid
+        """ % (query,), params)
+        changed = txn.fetchall()
+        txn.executemany("""
             UPDATE bans
             SET    expire_at = ?,
                    reason = ?
             WHERE  rowid = ?
-        """, (expire_at, reason, rowid))
+        """, [(expire_at, reason, ban_rowid)
+              for ban_rowid, _ in changed])
+        return [channel for _, channel in changed]
+
+    # Maintenance. Each of these does as much as it can in ``budget``
+    # seconds, and returns how many rows it handled along with whether it
+    # finished, so that infobob.maintenance can run it in slices.
+
+    @interaction
+    def archive_bans(self, txn, before, batch_size, budget):
+        """
+        Move bans unset before ``before`` into bans_archive, deleting their
+        edit authorizations.
+        """
+        return _in_slices(txn, _archive_batch(before), batch_size, budget)
+
+    @interaction
+    def expire_ban_authorizations(self, txn, before, batch_size, budget):
+        """
+        Delete the edit authorizations of bans set before ``before`` that
+        have since been unset, and of bans that no longer exist. Bans still
+        in place keep theirs, however long they've been set.
+        """
+        return _in_slices(
+            txn, _expire_auth_batch(before), batch_size, budget)
+
+    @interaction
+    def prune_user_hosts(self, txn, batch_size, budget):
+        """
+        Delete the hosts of nicks that aren't in any channel.
+        """
+        return _in_slices(txn, _prune_user_hosts_batch, batch_size, budget)
+
+    @interaction
+    def incremental_vacuum(self, txn, pages):
+        """
+        Return up to ``pages`` free pages to the filesystem, if the
+        database uses incremental auto-vacuum. Return how many pages were
+        freed, and whether there are none left.
+        """
+        txn.execute('PRAGMA auto_vacuum')
+        if txn.fetchall()[0][0] != 2:
+            return 0, True
+        txn.execute('PRAGMA freelist_count')
+        before = txn.fetchall()[0][0]
+        txn.execute('PRAGMA incremental_vacuum(%d)' % (pages,))
+        txn.fetchall()
+        txn.execute('PRAGMA freelist_count')
+        after = txn.fetchall()[0][0]
+        return before - after, after == 0
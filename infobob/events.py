@@ -0,0 +1,180 @@
+"""
+Live ban changes, pushed to web clients as server-sent events.
+
+The bot publishes each ban change to the :class:`BanEventHub` once, where
+it's encoded to a single SSE frame that's written as-is to every
+subscriber. Recent frames are kept so that a client reconnecting with the
+``Last-Event-ID`` of the last event it saw misses nothing.
+"""
+import collections
+import itertools
+import json
+import uuid
+
+from twisted.internet import defer, reactor, task
+from twisted.application import service
+from twisted.web.iweb import IPushProducer
+from twisted import logger
+from zope.interface import implementer
+
+from infobob.util import decode_text
+
+log = logger.Logger()
+
+
+def encodeEvent(eventId, kind, fields):
+    data = json.dumps(
+        dict((key, decode_text(value))
+             for key, value in fields.iteritems()),
+        separators=(',', ':'), sort_keys=True)
+    return 'id: %s\nevent: %s\ndata: %s\n\n' % (eventId, kind, data)
+
+# Tells a client that events it missed are gone, so it should reload
+# whatever it built from them.
+RESET_FRAME = 'event: reset\ndata: {}\n\n'
+HEARTBEAT_FRAME = ':\n\n'
+
+
+class BanEventHub(service.Service):
+    """
+    Fan ban events out to subscribed requests.
+
+    The last ``history`` events are kept for replay. A subscriber whose
+    client stops reading has its frames buffered up to ``maxBuffered``
+    bytes, after which it's disconnected and left to reconnect and replay.
+    While running, a comment is written to every subscriber every
+    ``heartbeat`` seconds so that idle connections aren't dropped by
+    proxies.
+    """
+    name = 'ban-events'
+
+    def __init__(self, history=1000, maxBuffered=65536, heartbeat=15,
+                 clock=reactor):
+        self.history = collections.deque(maxlen=history)
+        self.maxBuffered = maxBuffered
+        self.subscribers = set()
+        # Event IDs are only meaningful within one process.
+        self.epoch = uuid.uuid4().hex[:8]
+        self._counter = itertools.count(1)
+        self._last = 0
+        self._heartbeat = task.LoopingCall(self._beat)
+        self._heartbeat.clock = clock
+        self._heartbeatInterval = heartbeat
+
+    def startService(self):
+        service.Service.startService(self)
+        self._heartbeat.start(self._heartbeatInterval, now=False)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self._heartbeat.running:
+            self._heartbeat.stop()
+        for subscriber in list(self.subscribers):
+            subscriber.close()
+
+    def publish(self, kind, **fields):
+        """
+        Send an event of type ``kind``, with ``fields`` as its JSON data, to
+        every subscriber.
+        """
+        self._last = next(self._counter)
+        frame = encodeEvent(
+            '%s-%d' % (self.epoch, self._last), kind, fields)
+        self.history.append((self._last, frame))
+        for subscriber in list(self.subscribers):
+            subscriber.send(frame)
+
+    def since(self, lastEventId):
+        """
+        Return the frames of the events after ``lastEventId``, or None if
+        some of them are no longer available.
+        """
+        epoch, _, number = lastEventId.partition('-')
+        try:
+            number = int(number)
+        except ValueError:
+            return None
+        if epoch != self.epoch or number > self._last:
+            return None
+        if self.history and number < self.history[0][0] - 1:
+            return None
+        return [frame for n, frame in self.history if n > number]
+
+    def subscribe(self, request, lastEventId=None):
+        """
+        Stream events to ``request``, starting with any after
+        ``lastEventId``. Return a Deferred that fires when the stream ends.
+        """
+        subscriber = _Subscriber(self, request)
+        subscriber.send(HEARTBEAT_FRAME)
+        if lastEventId is not None:
+            frames = self.since(lastEventId)
+            if frames is None:
+                frames = [RESET_FRAME]
+            for frame in frames:
+                subscriber.send(frame)
+        if not subscriber.closed:
+            self.subscribers.add(subscriber)
+        return subscriber.done
+
+    def _beat(self):
+        for subscriber in list(self.subscribers):
+            subscriber.send(HEARTBEAT_FRAME)
+
+
+@implementer(IPushProducer)
+class _Subscriber(object):
+    def __init__(self, hub, request):
+        self.hub = hub
+        self.request = request
+        self.closed = False
+        self.done = defer.Deferred()
+        self._paused = False
+        self._pending = []
+        self._pendingSize = 0
+        request.registerProducer(self, True)
+        request.notifyFinish().addBoth(self._finished)
+
+    def send(self, frame):
+        if self.closed:
+            return
+        if not self._paused:
+            self.request.write(frame)
+            return
+        self._pendingSize += len(frame)
+        if self._pendingSize > self.hub.maxBuffered:
+            log.info(u'disconnecting an event subscriber that fell behind')
+            self.close()
+            return
+        self._pending.append(frame)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.request.unregisterProducer()
+        self.request.finish()
+        self._end()
+
+    def _end(self):
+        self.closed = True
+        self._pending = []
+        self.hub.subscribers.discard(self)
+        if not self.done.called:
+            self.done.callback(None)
+
+    def _finished(self, ignored):
+        self._end()
+
+    def pauseProducing(self):
+        self._paused = True
+
+    def resumeProducing(self):
+        self._paused = False
+        if self._pending and not self.closed:
+            pending, self._pending = self._pending, []
+            self._pendingSize = 0
+            self.request.write(''.join(pending))
+
+    def stopProducing(self):
+        self._end()
@@ -1,18 +1,39 @@
 import os.path
+import calendar
+import collections
+import gzip
+import hashlib
+import hmac
 import itertools
+import json
 import operator
+import time
+import urllib
+from cStringIO import StringIO
+from functools import wraps
 
-from twisted.internet.defer import inlineCallbacks
-from twisted.web import server
+from twisted.internet.defer import (
+    Deferred, inlineCallbacks, returnValue, succeed)
+from twisted.internet import reactor, task
+from twisted.web import server, http
+from twisted.web.iweb import IPushProducer
 from twisted import logger
 from genshi.template import TemplateLoader
+from zope.interface import implementer
 import klein
 
-from infobob.database import NoSuchBan
-from infobob.util import parse_time_string
+from infobob.config import InfobobConfig
+from infobob.database import (
+    BAN_DURATION_BUCKETS, NoSuchBan, current_week, median_bucket)
+from infobob.util import decode_text, parse_time_string
 
 
 DEFAULT_TEMPLATES_DIR = os.path.join(os.path.dirname(__file__), 'templates')
+TEMPLATES = [
+    'base.html', 'bans.html', 'edit_ban.html', 'search.html', 'stats.html']
+DATE_FORMAT = '%A, %e %B %Y at %R %p %Z'
+
+log = logger.Logger()
 
 
 def renderTemplate(request, tmpl, **kwargs):
@@ -22,58 +43,724 @@ def renderTemplate(request, tmpl, **kwargs):
                   .render('html', doctype='html5', encoding='utf-8'))
     request.finish()
 
+def streamTemplate(request, tmpl, chunkSize=16384, **kwargs):
+    """
+    Like :func:`renderTemplate`, but write the page to ``request`` in
+    chunks of about ``chunkSize`` bytes as it's serialized, instead of
+    building the whole document first.
+
+    Returns a Deferred that fires with True once the whole page has been
+    written and the request finished, or with False if the page was cut
+    short (by the client going away, or an error while serializing).
+    """
+    request.setHeader('Content-type', 'text/html; charset=utf-8')
+    serialized = tmpl.generate(**kwargs).serialize('html', doctype='html5')
+    return _TemplateProducer(request, _encodedChunks(serialized, chunkSize)
+        ).start()
+
+def _encodedChunks(serialized, chunkSize):
+    pending, size = [], 0
+    for text in serialized:
+        encoded = text.encode('utf-8')
+        pending.append(encoded)
+        size += len(encoded)
+        if size >= chunkSize:
+            yield ''.join(pending)
+            pending, size = [], 0
+    if pending:
+        yield ''.join(pending)
+
+@implementer(IPushProducer)
+class _TemplateProducer(object):
+    """
+    Write chunks to a request cooperatively, pausing while the transport
+    asks us to (i.e. while a slow client's buffer is full).
+    """
+    def __init__(self, request, chunks):
+        self._request = request
+        self._chunks = chunks
+        self._task = None
+        self._paused = False
+
+    def start(self):
+        # Registering with a client that's already gone stops us straight
+        # away, so the task has to exist first.
+        self._task = task.cooperate(self._write())
+        d = self._task.whenDone()
+        self._request.registerProducer(self, True)
+        d.addCallbacks(self._finished, self._failed)
+        return d
+
+    def _write(self):
+        for chunk in self._chunks:
+            self._request.write(chunk)
+            yield None
+
+    def _finished(self, ignored):
+        self._request.unregisterProducer()
+        self._request.finish()
+        return True
+
+    def _failed(self, f):
+        if f.check(task.TaskStopped):
+            # The client went away; there's nobody left to finish for.
+            return False
+        log.failure(u'error streaming template', f)
+        self._request.unregisterProducer()
+        self._request.finish()
+        return False
+
+    def pauseProducing(self):
+        if not self._paused:
+            self._paused = True
+            self._task.pause()
+
+    def resumeProducing(self):
+        if self._paused:
+            self._paused = False
+            self._task.resume()
+
+    def stopProducing(self):
+        try:
+            self._task.stop()
+        except task.TaskDone:
+            pass
+
+class _TeeRequest(object):
+    """
+    Wrap a request, keeping a copy of everything written to it, and
+    noting whether it was finished (rather than abandoned partway).
+    """
+    def __init__(self, request):
+        self._request = request
+        self.written = []
+        self.complete = False
+
+    def write(self, data):
+        self.written.append(data)
+        self._request.write(data)
+
+    def finish(self):
+        self.complete = True
+        self._request.finish()
+
+    def __getattr__(self, attr):
+        return getattr(self._request, attr)
+
+_CachedPage = collections.namedtuple(
+    '_CachedPage', 'headers body gzipped')
+
+class ResponseCache(object):
+    """
+    Rendered pages, keyed on request URI, for a single version of the
+    database's bans.
+
+    Every ban page is a function of the bans table and its URI, so a page
+    rendered at one version can be served again until the version changes;
+    the first lookup at a new version drops everything. At most
+    ``maxEntries`` pages are kept, least recently used first out. If
+    ``gzipLevel`` is nonzero, a gzipped copy of each page is kept too.
+    """
+    def __init__(self, maxEntries=200, gzipLevel=6):
+        self.maxEntries = maxEntries
+        self.gzipLevel = gzipLevel
+        self.version = None
+        self._pages = collections.OrderedDict()
+
+    def _at(self, version):
+        if version != self.version:
+            self._pages.clear()
+            self.version = version
+
+    def get(self, key, version):
+        self._at(version)
+        page = self._pages.pop(key, None)
+        if page is not None:
+            self._pages[key] = page
+        return page
+
+    def put(self, key, version, headers, body):
+        self._at(version)
+        gzipped = None
+        if self.gzipLevel:
+            buf = StringIO()
+            with gzip.GzipFile(
+                    fileobj=buf, mode='wb', compresslevel=self.gzipLevel,
+                    mtime=0) as f:
+                f.write(body)
+            gzipped = buf.getvalue()
+        self._pages[key] = _CachedPage(headers, body, gzipped)
+        while len(self._pages) > self.maxEntries:
+            self._pages.popitem(last=False)
+
+def _acceptsGzip(request):
+    for coding in (request.getHeader('accept-encoding') or '').split(','):
+        params = coding.split(';')
+        if params[0].strip().lower() != 'gzip':
+            continue
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+PresentedBan = collections.namedtuple(
+    'PresentedBan',
+    'channel set_by what set_at expire_at reason unset_by unset_at')
+
+def presentBans(bans, show_unset=True):
+    """
+    Group ban rows by channel for bans.html, each row as a
+    :class:`PresentedBan` of text ready to be put in the template.
+
+    The strftime calls and expressions in the template used to be the
+    bulk of rendering a ban page, so they're done here instead (see
+    benchmarks/render_bans.py).
+    """
+    for channel, rows in itertools.groupby(bans, operator.itemgetter(0)):
+        yield channel, (_presentBan(ban) for ban in rows)
+
+def presentSearchResults(bans):
+    """
+    Present ban rows for search.html, which shows them in one table in
+    order of relevance rather than grouped by channel.
+    """
+    return (_presentBan(ban) for ban in bans)
+
+def formatTime(seconds):
+    return time.strftime(DATE_FORMAT, time.localtime(seconds))
+
+def _presentBan(ban):
+    (channel, mask, mode, set_at, set_by, expire_at, reason, unset_at,
+     unset_by) = ban
+    return PresentedBan(
+        channel=decode_text(channel),
+        set_by=decode_text(set_by.partition('!')[0]),
+        what=decode_text('+%s %s' % (mode, mask)),
+        set_at=formatTime(set_at),
+        expire_at=formatTime(expire_at) if expire_at else None,
+        reason=decode_text(reason or ''),
+        unset_by=(decode_text(unset_by.partition('!')[0]) if unset_by
+                  else None),
+        unset_at=formatTime(unset_at) if unset_by else None,
+    )
+
+def encodeCursor(cursor):
+    channel, at, rowid = cursor
+    return '%s,%r,%d' % (channel, at, rowid)
+
+def decodeCursor(raw):
+    channel, at, rowid = raw.rsplit(',', 2)
+    return channel, float(at), int(rowid)
+
+def encodeSearchCursor(cursor):
+    score, rowid = cursor
+    return '%r,%d' % (score, rowid)
+
+def decodeSearchCursor(raw):
+    score, rowid = raw.split(',')
+    return float(score), int(rowid)
+
+def sheddable(func):
+    """
+    Reply with 503 instead of rendering while the reactor is lagging.
+    """
+    @wraps(func)
+    def wrap(self, request, *a, **kw):
+        lagMonitor = self.lagMonitor
+        if lagMonitor is not None and lagMonitor.shedding('web'):
+            request.setResponseCode(503)
+            request.setHeader('Retry-After', '%d' % (lagMonitor.lag + 1,))
+            request.setHeader('Content-type', 'text/plain; charset=utf-8')
+            return 'infobob is busy; try again shortly.\n'
+        return func(self, request, *a, **kw)
+    return wrap
+
+# The JSON API's ban rows are arrays of these, with times in seconds since
+# the epoch.
+API_COLUMNS = ['channel', 'mask', 'mode', 'set_at', 'set_by', 'expire_at',
+               'reason', 'unset_at', 'unset_by']
+
+# The API's ``state`` values, and the ban lists they select; an expired ban
+# is one that has been lifted.
+_API_STATES = {'active': 'active', 'expired': 'unset', 'all': 'all'}
+
+def dumpBanRow(row):
+    return json.dumps([decode_text(value) for value in row],
+                      separators=(',', ':'))
+
+def parseTime(raw):
+    """
+    Parse seconds since the epoch, or anything parse_time_string accepts,
+    to seconds since the epoch. Times without a zone are local.
+    """
+    try:
+        return float(raw)
+    except ValueError:
+        pass
+    return toEpoch(parse_time_string(raw))
+
+def toEpoch(when):
+    if when.tzinfo is None:
+        return time.mktime(when.timetuple())
+    return calendar.timegm(when.utctimetuple())
+
+def parseBanQuery(args):
+    """
+    Return the ban list and the filtering keyword arguments for
+    ``get_bans_page`` described by the query string ``args``. Raise
+    ValueError if any of them are invalid.
+    """
+    def last(name, convert=str):
+        values = args.get(name)
+        if not values:
+            return None
+        return convert(values[-1])
+
+    state = last('state') or 'all'
+    if state not in _API_STATES:
+        raise ValueError('unknown state %r' % (state,))
+    return _API_STATES[state], dict(
+        after=last('after', decodeCursor),
+        channels=args.get('channel'),
+        mode=last('mode'),
+        mask=last('mask'),
+        set_by=last('set_by'),
+        since=last('since', parseTime),
+        until=last('until', parseTime),
+    )
+
+@implementer(IPushProducer)
+class _PageProducer(object):
+    """
+    Track whether a request's transport wants more written, for responses
+    written a batch at a time as the bans come out of the database.
+
+    A client that stays paused for ``timeout`` seconds is given up on, as
+    if it had gone away, with ``timedOut`` set.
+    """
+    def __init__(self, request, timeout=None, clock=reactor):
+        self.stopped = False
+        self.timedOut = False
+        self._resumed = None
+        self._timeout = timeout
+        self._timeoutCall = None
+        self._clock = clock
+        request.registerProducer(self, True)
+
+    def whenResumed(self):
+        if self._resumed is None:
+            return succeed(None)
+        return self._resumed
+
+    def pauseProducing(self):
+        if self._resumed is None:
+            self._resumed = Deferred()
+            if self._timeout is not None:
+                self._timeoutCall = self._clock.callLater(
+                    self._timeout, self._timedOut)
+
+    def resumeProducing(self):
+        if self._timeoutCall is not None and self._timeoutCall.active():
+            self._timeoutCall.cancel()
+        self._timeoutCall = None
+        resumed, self._resumed = self._resumed, None
+        if resumed is not None:
+            resumed.callback(None)
+
+    def stopProducing(self):
+        self.stopped = True
+        self.resumeProducing()
+
+    def _timedOut(self):
+        self._timeoutCall = None
+        self.timedOut = True
+        self.stopProducing()
+
 class InfobobWebUI(object):
     app = klein.Klein()
 
-    def __init__(self, loader, dbpool):
+    def __init__(self, loader, dbpool, conf):
         self.loader = loader
         self.dbpool = dbpool
+        self.conf = conf
+        self.lagMonitor = conf.lagMonitor
+        self.banEvents = conf.banEvents
+        self.backupService = conf.backupService
+        self.cache = None
+        if conf['web.cache.max_entries']:
+            self.cache = ResponseCache(
+                conf['web.cache.max_entries'], conf['web.cache.gzip_level'])
+        self._templates = None
+        if not loader.auto_reload:
+            # Parse everything (inlining base.html) up front, so requests
+            # never touch the filesystem.
+            self._templates = dict(
+                (name, loader.load(name)) for name in TEMPLATES)
+
+    def template(self, name):
+        if self._templates is None:
+            return self.loader.load(name)
+        return self._templates[name]
+
+    def etag(self, key, version, gzipped=False):
+        """
+        Return the strong entity tag of the page cached under ``key`` as of
+        the bans table's ``version``.
+        """
+        return '"%s-%d-%s%s"' % (
+            self.dbpool.epoch, version,
+            hashlib.sha1(key).hexdigest()[:16],
+            '-gz' if gzipped else '')
+
+    def renderCached(self, request, render, *a, **kw):
+        """
+        Serve a ban page from the response cache if it's there, otherwise
+        call ``render(request, *a, **kw)`` and cache what was written.
+
+        Either way the page gets an ETag for the current version of the
+        bans table, so that a client already holding the page gets a 304
+        without anything being rendered at all.
+        """
+        return self.renderCachedAs(
+            request, request.uri, render, *a, **kw)
 
-    @app.route('/bans')
     @inlineCallbacks
+    def renderCachedAs(self, request, key, render, *a, **kw):
+        """
+        Like :meth:`renderCached`, for a page cached under ``key``, which
+        must also tell apart anything besides the URI the page depends on.
+        """
+        version = yield self.dbpool.get_bans_version()
+        page = None
+        if self.cache is not None:
+            page = self.cache.get(key, version)
+        gzipped = (page is not None and page.gzipped is not None
+                   and _acceptsGzip(request))
+        request.setHeader('Vary', 'Accept-Encoding')
+        if request.setETag(self.etag(key, version, gzipped)) == \
+                http.CACHED:
+            request.finish()
+            return
+        if page is not None:
+            for name, value in page.headers:
+                request.setHeader(name, value)
+            if gzipped:
+                request.setHeader('Content-Encoding', 'gzip')
+                request.write(page.gzipped)
+            else:
+                request.write(page.body)
+            request.finish()
+            return
+
+        if self.cache is None:
+            yield render(request, *a, **kw)
+            return
+        tee = _TeeRequest(request)
+        yield render(tee, *a, **kw)
+        # Don't cache errors, pages cut short by the client going away, or
+        # a page whose bans changed while rendering.
+        if request.code != http.OK or not tee.complete:
+            return
+        current = yield self.dbpool.get_bans_version()
+        if current == version:
+            headers = [
+                (name, request.responseHeaders.getRawHeaders(name)[0])
+                for name in ['Content-type']
+                if request.responseHeaders.hasHeader(name)]
+            self.cache.put(key, version, headers, ''.join(tee.written))
+
+    def renderBanList(self, request, which, limit=None, **kwargs):
+        """
+        Render one page of the ``which`` ban list.
+
+        The query string may hold ``channel`` (repeatable) to show only
+        those channels, ``limit`` for the page size, and ``after`` for the
+        cursor of the page to show, as found in the next page link.
+        """
+        return self.renderCached(
+            request, self._renderBanList, which, limit=limit, **kwargs)
+
+    @inlineCallbacks
+    def _renderBanList(self, request, which, limit=None, **kwargs):
+        args = request.args
+        try:
+            if limit is None:
+                limit = int(
+                    args.get('limit', [self.conf['web.page_size']])[0])
+            after = args.get('after', [None])[0]
+            if after is not None:
+                after = decodeCursor(after)
+        except ValueError:
+            request.setResponseCode(400)
+            request.setHeader('Content-type', 'text/plain; charset=utf-8')
+            request.write('invalid limit or cursor\n')
+            request.finish()
+            return
+        limit = max(1, min(limit, self.conf['web.max_page_size']))
+        channels = args.get('channel')
+
+        bans, next_cursor = yield self.dbpool.get_bans_page(
+            which, after=after, limit=limit, channels=channels)
+        if which == 'expired':
+            # Paged most recent first across channels; shown by channel.
+            bans.sort(key=operator.itemgetter(0))
+        next_url = None
+        if next_cursor is not None:
+            query = [(key, value) for key, values in sorted(args.items())
+                     if key != 'after' for value in values]
+            query.append(('after', encodeCursor(next_cursor)))
+            next_url = '%s?%s' % (request.path, urllib.urlencode(query))
+        bans = presentBans(bans, kwargs['show_unset'])
+        tmpl = self.template('bans.html')
+        if self.conf['web.stream_templates']:
+            yield streamTemplate(request, tmpl, bans=bans, next_url=next_url,
+                                 **kwargs)
+        else:
+            renderTemplate(request, tmpl, bans=bans, next_url=next_url,
+                           **kwargs)
+
+    @app.route('/bans')
+    @sheddable
     def bans(self, request):
-        bans = yield self.dbpool.get_active_bans()
-        bans = itertools.groupby(bans, operator.itemgetter(0))
-        renderTemplate(request, self.loader.load('bans.html'),
-            bans=bans, show_unset=False, show_recent_expiration=False)
+        return self.renderBanList(request, 'active',
+            show_unset=False, show_recent_expiration=False)
 
     @app.route('/bans/expired')
     @app.route('/bans/expired/<int:count>')
-    @inlineCallbacks
+    @sheddable
     def expiredBans(self, request, count=10):
-        bans = yield self.dbpool.get_recently_expired_bans(count)
-        bans.sort(key=operator.itemgetter(0, 7))
-        bans = itertools.groupby(bans, operator.itemgetter(0))
-        renderTemplate(request, self.loader.load('bans.html'),
-            bans=bans, show_unset=True, show_recent_expiration=True)
+        return self.renderBanList(request, 'expired', limit=count,
+            show_unset=True, show_recent_expiration=True)
 
     @app.route('/bans/all')
-    @inlineCallbacks
+    @sheddable
     def allBans(self, request):
-        bans = yield self.dbpool.get_all_bans()
-        bans = itertools.groupby(bans, operator.itemgetter(0))
-        renderTemplate(request, self.loader.load('bans.html'),
-            bans=bans, show_unset=True, show_recent_expiration=False)
+        return self.renderBanList(request, 'all',
+            show_unset=True, show_recent_expiration=False)
+
+    def apiError(self, request, code, message):
+        request.setResponseCode(code)
+        request.setHeader('Content-type', 'application/json')
+        return json.dumps({'error': message}) + '\n'
+
+    @app.route('/bans/search')
+    @sheddable
+    def searchBans(self, request):
+        """
+        Search ban reasons, masks and setters for the terms in ``q``.
+
+        Results are ranked by relevance and paginated like the ban lists,
+        with ``limit``, ``after`` and ``channel`` (repeatable).
+        """
+        return self.renderCached(request, self._renderSearch)
+
+    @inlineCallbacks
+    def _renderSearch(self, request):
+        args = request.args
+        text = args.get('q', [''])[0].decode('utf-8', 'replace')
+        try:
+            limit = int(args.get('limit', [self.conf['web.page_size']])[0])
+            after = args.get('after', [None])[0]
+            if after is not None:
+                after = decodeSearchCursor(after)
+        except ValueError:
+            request.setResponseCode(400)
+            request.setHeader('Content-type', 'text/plain; charset=utf-8')
+            request.write('invalid limit or cursor\n')
+            request.finish()
+            return
+        limit = max(1, min(limit, self.conf['web.max_page_size']))
+
+        bans, next_cursor = yield self.dbpool.search_bans(
+            text, after=after, limit=limit, channels=args.get('channel'))
+        next_url = None
+        if next_cursor is not None:
+            query = [(key, value) for key, values in sorted(args.items())
+                     if key != 'after' for value in values]
+            query.append(('after', encodeSearchCursor(next_cursor)))
+            next_url = '%s?%s' % (request.path, urllib.urlencode(query))
+        renderTemplate(request, self.template('search.html'), q=text,
+                       bans=presentSearchResults(bans), next_url=next_url)
+
+    @app.route('/bans/stats')
+    @sheddable
+    def banStats(self, request):
+        """
+        Show per-channel ban statistics, read from the aggregates that
+        db.schema's triggers keep up to date.
+        """
+        # The weekly counts shift along each week without any ban changing.
+        week = current_week()
+        return self.renderCachedAs(
+            request, '%s#week=%d' % (request.uri, week),
+            self._renderStats, week)
+
+    @inlineCallbacks
+    def _renderStats(self, request, week):
+        weeks = self.conf['web.stats.weeks']
+        stats = yield self.dbpool.get_ban_stats(
+            weeks=weeks, top_setters=self.conf['web.stats.top_setters'],
+            week=week)
+        for channel in stats:
+            median = median_bucket(channel['durations'])
+            channel['median_duration'] = (
+                None if median is None else BAN_DURATION_BUCKETS[median])
+            channel['per_week'] = sum(channel['weekly']) / float(weeks)
+            channel['account_share'] = (
+                100.0 * channel['account_masks'] / channel['total'])
+        renderTemplate(request, self.template('stats.html'),
+                       stats=stats, weeks=weeks)
+
+    @app.route('/bans/events')
+    def banEventStream(self, request):
+        """
+        Stream ban changes as server-sent events: ``add``, ``unset``,
+        ``expire`` and ``edit``, each with the ban's channel, mask and mode.
+
+        A client reconnecting with a ``Last-Event-ID`` header (or
+        ``last_event_id`` argument) gets the events it missed, or a
+        ``reset`` event if they're no longer available.
+        """
+        if self.banEvents is None:
+            request.setResponseCode(404)
+            return ''
+        lastEventId = request.getHeader('last-event-id')
+        if lastEventId is None:
+            lastEventId = request.args.get('last_event_id', [None])[0]
+        request.setHeader('Content-type', 'text/event-stream')
+        request.setHeader('Cache-Control', 'no-cache')
+        return self.banEvents.subscribe(request, lastEventId)
+
+    @app.route('/api/bans')
+    @sheddable
+    def apiBans(self, request):
+        """
+        Return a page of bans as JSON, filtered by the query string.
+
+        The ``state`` may be ``active``, ``expired`` or ``all`` (the
+        default); ``channel`` (repeatable), ``mode``, and GLOB patterns for
+        ``mask`` and ``set_by`` narrow the bans down further, and ``since``
+        and ``until`` bound when they were set (or lifted, for expired
+        bans). ``limit`` is the page size, and ``after`` takes the
+        ``next`` cursor of the previous page.
+        """
+        return self.renderCached(request, self._renderApiBans)
+
+    @inlineCallbacks
+    def _renderApiBans(self, request):
+        try:
+            which, query = parseBanQuery(request.args)
+            limit = int(
+                request.args.get('limit', [self.conf['web.page_size']])[0])
+        except ValueError as e:
+            request.write(self.apiError(request, 400, str(e)))
+            request.finish()
+            return
+        limit = max(1, min(limit, self.conf['web.max_page_size']))
+        bans, next_cursor = yield self.dbpool.get_bans_page(
+            which, limit=limit, **query)
+        request.setHeader('Content-type', 'application/json')
+        request.write('{"columns":%s,"bans":[%s],"next":%s}\n' % (
+            json.dumps(API_COLUMNS, separators=(',', ':')),
+            ','.join(dumpBanRow(ban) for ban in bans),
+            json.dumps(next_cursor and encodeCursor(next_cursor)),
+        ))
+        request.finish()
+
+    @app.route('/api/bans.ndjson')
+    @sheddable
+    @inlineCallbacks
+    def apiBansExport(self, request):
+        """
+        Stream every ban matching the same filters as ``/api/bans`` as
+        newline-delimited JSON, one row per line.
+
+        The bans are streamed from a single query, a batch at a time, and
+        the next batch isn't fetched until the client has taken the
+        previous one. Each export holds a database thread, so while the
+        runner's streams are all taken this replies 503, and a client that
+        stops reading for ``web.export.write_timeout`` seconds is dropped.
+        """
+        try:
+            which, query = parseBanQuery(request.args)
+        except ValueError as e:
+            returnValue(self.apiError(request, 400, str(e)))
+        if not self.dbpool.streams.tokens:
+            request.setHeader('Retry-After', '10')
+            returnValue(self.apiError(
+                request, 503, 'too many exports in progress'))
+        request.setHeader('Content-type', 'application/x-ndjson')
+        producer = _PageProducer(
+            request, self.conf['web.export.write_timeout'])
+
+        def deliver(bans):
+            if producer.stopped:
+                return False
+            request.write(''.join(dumpBanRow(ban) + '\n' for ban in bans))
+            return producer.whenResumed().addCallback(
+                lambda ign: not producer.stopped)
+        try:
+            yield self.dbpool.stream_bans(
+                deliver, which, batch_size=self.conf['web.max_page_size'],
+                **query)
+        finally:
+            request.unregisterProducer()
+        if producer.timedOut:
+            request.transport.abortConnection()
+        elif not producer.stopped:
+            request.finish()
+
+    @app.route('/admin/backup', methods=['GET', 'POST'])
+    def adminBackup(self, request):
+        """
+        Report the progress of the current (or last) database backup as
+        JSON; a POST starts a new one. Only available with a
+        ``backup.admin_token``, which must be given in an ``Authorization:
+        Bearer`` header (not in the URL, which ends up in access logs).
+        """
+        adminToken = self.conf['backup.admin_token']
+        if self.backupService is None or not adminToken:
+            request.setResponseCode(404)
+            return ''
+        scheme, _, token = (request.getHeader('authorization') or ''
+                            ).partition(' ')
+        if scheme.lower() != 'bearer':
+            token = ''
+        if not hmac.compare_digest(token, adminToken.encode('utf-8')):
+            return self.apiError(request, 403, 'bad token')
+        if request.method == 'POST':
+            if self.backupService.current is not None:
+                return self.apiError(request, 409, 'backup in progress')
+            d = self.backupService.backup()
+            d.addErrback(lambda f: log.failure(u'error taking backup', f))
+            request.setResponseCode(202)
+        request.setHeader('Content-type', 'application/json')
+        return json.dumps(self.backupService.progress()) + '\n'
 
     @app.route('/bans/edit/<rowid>/<auth>', methods=['GET', 'HEAD'])
     @inlineCallbacks
     def editBan(self, request, rowid, auth):
         ban = yield self.dbpool.get_ban_with_auth(rowid, auth)
-        renderTemplate(request, self.loader.load('edit_ban.html'),
+        renderTemplate(request, self.template('edit_ban.html'),
             ban=ban, message=None)
 
     @app.route('/bans/edit/<rowid>/<auth>', methods=['POST'])
     @inlineCallbacks
     def postEditBan(self, request, rowid, auth):
         ban = yield self.dbpool.get_ban_with_auth(rowid, auth)
-        _, _, _, _, _, expire_at, reason, _, _ = ban
+        expire_at, reason = ban.expire_at, ban.reason
         if 'expire_at' in request.args:
             raw_expire_at = request.args['expire_at'][0]
             if raw_expire_at == 'never':
                 expire_at = None
             else:
                 try:
-                    expire_at = parse_time_string(raw_expire_at)
+                    expire_at = toEpoch(parse_time_string(raw_expire_at))
                 except ValueError:
                     # This will cause the ban reason in the form to be the old
                     # one (from the DB), not very user-friendly... but it
@@ -81,17 +768,28 @@ class InfobobWebUI(object):
                     message = (
                         'Invalid expiration timestamp or relative date {0!r}'
                     ).format(raw_expire_at)
-                    renderTemplate(request, self.loader.load('edit_ban.html'),
+                    renderTemplate(request, self.template('edit_ban.html'),
                         ban=ban, message=message)
                     return
         if 'reason' in request.args:
             reason = request.args['reason'][0]
-        yield self.dbpool.update_ban_by_rowid(rowid, expire_at, reason)
-        ban = ban[:5] + (expire_at, reason) + ban[7:]
-        renderTemplate(request, self.loader.load('edit_ban.html'),
+        group = self.conf.channel_group(ban.channel)[1:]
+        changed = yield self.dbpool.update_ban_by_rowid(
+            rowid, expire_at, reason, group)
+        if self.banEvents is not None:
+            for channel in changed:
+                self.banEvents.publish(
+                    'edit', channel=channel, mask=ban.mask, mode=ban.mode,
+                    expire_at=expire_at, reason=reason)
+        ban = ban._replace(expire_at=expire_at, reason=reason)
+        renderTemplate(request, self.template('edit_ban.html'),
             ban=ban, message='ban details updated')
 
-def makeSite(templates_dir, dbpool):
-    loader = TemplateLoader(templates_dir, auto_reload=True)
-    webui = InfobobWebUI(loader, dbpool)
+def makeSite(templates_dir, dbpool, conf=None):
+    if conf is None:
+        conf = InfobobConfig()
+        conf.apply_defaults()
+    loader = TemplateLoader(
+        templates_dir, auto_reload=conf['web.auto_reload_templates'])
+    webui = InfobobWebUI(loader, dbpool, conf)
     return server.Site(webui.app.resource())
@@ -4,18 +4,17 @@ import traceback
 import operator
 import sys
 import re
+import string
 from datetime import timedelta
 from urllib import urlencode
 from urlparse import urljoin
 
 from twisted.words.protocols import irc
 from twisted.internet import reactor, defer, error, protocol, task
-from twisted.web import xmlrpc
 from twisted import logger
-import lxml.html
 
-from infobob.redent import redent
-from infobob import database, http, util
+from infobob import util
+from infobob.lag import RoundTripTracker
 from infobob.pastebin import make_paster, make_repaster
 
 
@@ -35,24 +34,75 @@ _lol_regex = re.compile(r'\b(lo+l[lo]*|rofl+|lmao+|lel|kek)z*\b', re.I)
 _lol_message = '%s is a no-LOL zone.'
 
 
+# Leave room for the prefix the server adds when relaying our JOIN.
+_MAX_JOIN_LENGTH = 400
+_MAX_MODE_LENGTH = 400
+
+# Channel name casefolding for each ISUPPORT CASEMAPPING; servers that
+# don't advertise one use rfc1459.
+_CASEMAPPINGS = {
+    'ascii': string.maketrans(string.ascii_uppercase, string.ascii_lowercase),
+    'rfc1459': string.maketrans(
+        string.ascii_uppercase + '[]\\~', string.ascii_lowercase + '{}|^'),
+    'strict-rfc1459': string.maketrans(
+        string.ascii_uppercase + '[]\\', string.ascii_lowercase + '{}|'),
+}
+
 _EXEC_PRELUDE = """#coding:utf-8
 import os, sys, math, re, random
 """
 _MAX_LINES = 2
 
 
+class _ChannelPolicy(object):
+    """
+    A channel's configuration, looked up once for dispatching messages:
+    whether to watch for lols and bad pastes, and the handlers of the
+    commands that may be used.
+    """
+    __slots__ = ('channel', 'translate', 'lol', 'repaste', 'commands')
+
+    def __init__(self, channel_obj, handlers):
+        self.channel = channel_obj
+        self.translate = channel_obj.translate
+        self.lol = channel_obj.is_usable('lol')
+        self.repaste = channel_obj.is_usable('repaste')
+        self.commands = dict(
+            (command, handler) for command, handler in handlers.iteritems()
+            if channel_obj.is_usable(command))
+
+
+class ChannelSnapshots(object):
+    """
+    What the database was last told about each channel: its members, as a
+    dict of nick to ``user@host``, and its active ban and quiet masks. The
+    factory keeps one across reconnects, so that resyncing a channel only
+    writes what changed while the bot was away.
+
+    A channel's members are only diffed once they've been stored from a
+    complete WHO reply (and are in ``filled``); before that, the database
+    may still hold rows left by an earlier process.
+    """
+    def __init__(self):
+        self.members = collections.defaultdict(dict)
+        self.filled = set()
+        self.banlists = {}
+
+
 class Infobob(irc.IRCClient):
-    identified = False
-    outstandingPings = 0
+    identified = autojoined = False
 
     sourceURL = 'https://github.com/pound-python/infobob'
     versionName = 'infobob'
     versionNum = 'latest'
     versionEnv = 'twisted'
 
-    db = dbpool = manhole_service = None
+    db = dbpool = manhole_service = lagMonitor = banEvents = lols = None
+    clock = reactor
+    _address_nickname = _address_regex = None
 
-    def __init__(self, conf, paster=None, repaster=None):
+    def __init__(self, conf, paster=None, repaster=None, snapshots=None,
+                 serverLag=None):
         self._conf = conf
         self._paster = paster or make_paster()
         self._repaster = repaster or make_repaster(self._paster)
@@ -60,11 +110,17 @@ class Infobob(irc.IRCClient):
         if conf['irc.password']:
             self.password = conf['irc.password'].encode()
         self.dbpool = conf.dbpool
+        self.lagMonitor = conf.lagMonitor
+        self.banEvents = conf.banEvents
+        self.lols = conf.lolTracker
+        self.serverLag = serverLag or RoundTripTracker(clock=self.clock)
         self.is_opped = set()
         self._op_deferreds = {}
         self.channel_collation = collections.defaultdict(dict)
         self.most_recent_bans = {}
-        self._channel_update_deferred = defer.succeed(None)
+        self.snapshots = snapshots or ChannelSnapshots()
+        self.channel_members = self.snapshots.members
+        self._channel_updates = util.KeyedSequencer()
         self._whois_collation = {}
         self._whois_deferred = None
         self._whois_queue = defer.DeferredSemaphore(1)
@@ -72,13 +128,87 @@ class Infobob(irc.IRCClient):
             lambda: defer.DeferredSemaphore(1))
         self._waiting_on_deferred = {}
         self._loopers = {}
+        self._policies = {}
+        self._pendingModes = {}
+        self._modeTimeouts = {}
+        # Bans set in one channel of a channel group and sent to another,
+        # by (casefolded channel, mode, mask), with the rowid of the ban
+        # they copy and when to give up on the server echoing them (None
+        # while still queued). They're stored once the server echoes them.
+        self._propagating = {}
+        # Bans we've unset for expiring, by (channel, mode, mask), so that
+        # the server's echo is published as an expiry, not an unset.
+        self._expiring = set()
         self._ban_collation = collections.defaultdict(list)
         self._quiet_collation = collections.defaultdict(list)
+        self.channelSyncState = {}
+        self._syncQueue = collections.deque()
+        self._syncWaiters = collections.defaultdict(list)
+        self._syncing = None
+        self._syncCall = None
+        self._syncTimeout = None
 
     def autojoinChannels(self):
-        for channel in self._conf['irc.autojoin']:
+        self.autojoined = True
+        self.joinChannels(self._withKeys(self._conf['irc.autojoin']))
+
+    def _withKeys(self, names):
+        channels = []
+        for channel in names:
             channel_obj = self._conf.channel(channel)
-            self.join(channel_obj.name.encode(), channel_obj.key)
+            key = channel_obj.key
+            channels.append(
+                (channel_obj.name.encode(), key and key.encode()))
+        return channels
+
+    def configReloaded(self, oldConfig):
+        """
+        Join the channels added to the autojoin list by a config reload,
+        and part the ones removed from it, leaving every other channel (and
+        its synced state) alone; a parted channel's state is dropped once
+        the server confirms the part. Nothing is joined or parted before
+        the initial autojoin, which will use the new list anyway.
+
+        The cached channel policies are dropped either way, so that they're
+        rebuilt from the new channel configuration.
+        """
+        self._policies.clear()
+        if not self.autojoined:
+            return
+        old = oldConfig.get('irc', {}).get('autojoin', [])
+        new = self._conf['irc.autojoin']
+        joining = [channel for channel in new if channel not in old]
+        parting = [channel for channel in old if channel not in new]
+        if joining:
+            log.info(u'joining {channels} after config reload',
+                     channels=u', '.join(joining))
+            self.joinChannels(self._withKeys(joining))
+        for channel in parting:
+            log.info(u'parting {channel} after config reload',
+                     channel=channel)
+            self.part(channel.encode())
+
+    def joinChannels(self, channels):
+        """
+        Join ``channels``, a list of ``(name, key)`` pairs, with as many
+        channels per JOIN line as the server's TARGMAX allows.
+        """
+        targmax = self.supported.getFeature('TARGMAX') or {}
+        per_line = (targmax.get('JOIN')
+                    or self._conf['irc.sync.join_batch_size'])
+        # Keys are matched to channels by position, so keyed channels
+        # have to come first.
+        channels = sorted(channels, key=lambda channel: not channel[1])
+        batch = []
+        for channel in channels:
+            if batch and (
+                    len(batch) >= per_line
+                    or len(_joinLine(batch + [channel])) > _MAX_JOIN_LENGTH):
+                self.sendLine(_joinLine(batch))
+                batch = []
+            batch.append(channel)
+        if batch:
+            self.sendLine(_joinLine(batch))
 
     def startTimer(self, name, interval, method, *a, **kw):
         def wrap():
@@ -95,9 +225,8 @@ class Infobob(irc.IRCClient):
         looper.start(interval)
 
     def stopTimer(self, name):
-        # FIXME: Probable should be self._loopers
-        looper = self._looper.pop(name, None)
-        if looper is not None:
+        looper = self._loopers.pop(name, None)
+        if looper is not None and looper.running:
             looper.stop()
 
     def signedOn(self):
@@ -107,10 +236,85 @@ class Infobob(irc.IRCClient):
             self.msg('NickServ', 'identify %s' % nickserv_pw.encode())
         else:
             self.autojoinChannels()
-        self.startTimer('serverPing', 60, self._serverPing)
+        self.startTimer('serverPing', self._conf['irc.ping.interval'],
+                        self._serverPing)
         self.startTimer('expireBans', 60, self._expireBans)
         self.startTimer('pastebinPing', 60*60*3, self._pastebinPing)
 
+    def _shedding(self, feature):
+        """
+        Return whether the optional ``feature`` should be skipped because
+        the reactor is lagging.
+        """
+        return (self.lagMonitor is not None
+                and self.lagMonitor.shedding(feature))
+
+    def setModes(self, channel, changes):
+        """
+        Apply ``changes``, a list of ``(set, mode, arg)`` triples, to
+        ``channel``, with as many changes per MODE line as the server's
+        MODES allows.
+        """
+        per_line = self.supported.getFeature('MODES') or 1
+        batch = []
+        for change in changes:
+            if batch and (
+                    len(batch) >= per_line
+                    or len(_modeLine(channel, batch + [change]))
+                        > _MAX_MODE_LENGTH):
+                self.sendLine(_modeLine(channel, batch))
+                batch = []
+            batch.append(change)
+        if batch:
+            self.sendLine(_modeLine(channel, batch))
+
+    def queueModes(self, channel, changes):
+        """
+        Apply ``changes`` to ``channel`` once opped there, along with any
+        other changes queued for it by then. If we aren't opped within
+        ``irc.ops_timeout`` seconds, the changes are dropped.
+        """
+        pending = self._pendingModes.get(channel)
+        if pending is not None:
+            pending.extend(changes)
+            return
+        self._pendingModes[channel] = list(changes)
+        self._modeTimeouts[channel] = timeout = self.clock.callLater(
+            self._conf['irc.ops_timeout'], self._dropModes, channel)
+
+        def opped(ignored):
+            if not timeout.active():
+                return
+            timeout.cancel()
+            # Wait a turn even if already opped, so that changes queued by
+            # the rest of this turn go out in the same lines.
+            self._modeTimeouts[channel] = self.clock.callLater(
+                0, self._flushModes, channel)
+        self.ensureOps(channel).addCallback(opped)
+
+    def _flushModes(self, channel):
+        self._modeTimeouts.pop(channel, None)
+        changes = self._pendingModes.pop(channel, None)
+        if changes:
+            self.setModes(channel, changes)
+        # The server doesn't echo a ban that's already set, so only wait so
+        # long for the echo of a propagated one.
+        deadline = self.clock.seconds() + self._conf['irc.ops_timeout']
+        for _, mode, arg in changes or ():
+            key = self._propagationKey(channel, mode, arg)
+            if key in self._propagating:
+                rowid, _ = self._propagating[key]
+                self._propagating[key] = rowid, deadline
+
+    def _dropModes(self, channel):
+        self._modeTimeouts.pop(channel, None)
+        changes = self._pendingModes.pop(channel, [])
+        log.warn(u'not opped on {channel}; dropping {count} mode changes',
+                 channel=channel, count=len(changes))
+        for _, mode, arg in changes:
+            self._propagating.pop(
+                self._propagationKey(channel, mode, arg), None)
+
     def ensureOps(self, channel):
         if self._op_deferreds.get(channel) is None:
             self._op_deferreds[channel] = defer.Deferred()
@@ -118,13 +322,35 @@ class Infobob(irc.IRCClient):
         return self._op_deferreds[channel]
 
     def _serverPing(self):
-        if self.outstandingPings > 5:
-            self.loseConnection()
-        self.sendLine('PING bollocks')
-        self.outstandingPings += 1
+        """
+        Send a timestamped PING, or drop the connection if an earlier one
+        has gone unanswered for much longer than recent round trips.
+
+        While a PING is outstanding, the next check is brought forward to
+        when it would time out, rather than waiting out a full interval.
+        """
+        interval = self._conf['irc.ping.interval']
+        timeout = self.serverLag.timeout(
+            self._conf['irc.ping.rtt_multiplier'],
+            self._conf['irc.ping.min_timeout'],
+            self._conf['irc.ping.max_timeout'])
+        waited = self.serverLag.oldestOutstanding()
+        if waited > timeout:
+            log.warn(
+                u'no PONG for {waited:.1f}s (timeout {timeout:.1f}s); '
+                u'dropping connection', waited=waited, timeout=timeout)
+            self.transport.loseConnection()
+            return
+        if not self.serverLag.outstanding:
+            self.sendLine('PING %s' % (self.serverLag.ping(),))
+        else:
+            interval = min(interval, max(1, timeout - waited))
+        looper = self._loopers.get('serverPing')
+        if looper is not None:
+            looper.interval = interval
 
     def irc_PONG(self, prefix, params):
-        self.outstandingPings -= 1
+        self.serverLag.pong(params[-1])
 
     def msg(self, target, message):
         # Prevent excess flood.
@@ -173,18 +399,117 @@ class Infobob(irc.IRCClient):
             reactor.callLater(5, self.join, channel_obj.anti_redirect.encode())
             return
 
+        self.queueChannelSync(channel)
+
+    def left(self, channel):
+        """
+        Forget ``channel``'s members, banlists and sync state once we've
+        parted it, and clear its members from the database, so that nothing
+        stale is served or diffed against if it's joined again.
+        """
+        self.channel_members.pop(channel, None)
+        self.snapshots.filled.discard(channel)
+        for mode in 'bq':
+            self.snapshots.banlists.pop((channel, mode), None)
+        self.channelSyncState.pop(channel, None)
+        self.channel_collation.pop(channel, None)
+        for d in self._syncWaiters.pop(channel, []):
+            d.errback(error.ConnectionLost())
+        self.is_opped.discard(channel)
+        self._op_deferreds.pop(channel, None)
+        return self._channel_updates.run(
+            [channel], self.dbpool.set_users_in_channel, {}, channel)
+
+    def queueChannelSync(self, channel):
+        """
+        Queue a WHO (and, with ops, banlist and quietlist requests) for
+        ``channel``.
+
+        Channels are synced one at a time: the next channel's requests
+        are only sent once the previous WHO reply has been stored, plus a
+        pause of ``irc.sync.interval`` seconds or the recent server
+        round-trip time, whichever is longer.
+        """
+        if self.channelSyncState.get(channel) == 'queued':
+            return
+        self.channelSyncState[channel] = 'queued'
+        self._syncQueue.append(channel)
+        if self._syncing is None and self._syncCall is None:
+            self._syncNextChannel()
+
+    def channelSynced(self, channel):
+        """
+        Return a Deferred that fires once ``channel``'s membership has
+        been synced after joining it, or fails with
+        :class:`~twisted.internet.error.ConnectionLost` if the connection
+        is lost (or the channel is left) first.
+        """
+        if self.channelSyncState.get(channel, 'synced') == 'synced':
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._syncWaiters[channel].append(d)
+        return d
+
+    def _syncNextChannel(self):
+        self._syncCall = None
+        while self._syncQueue:
+            channel = self._syncQueue.popleft()
+            if self.channelSyncState.get(channel) == 'queued':
+                break
+        else:
+            return
+        self._syncing = channel
+        self.channelSyncState[channel] = 'syncing'
+        self._syncTimeout = self.clock.callLater(
+            self._conf['irc.sync.timeout'], self._channelSyncTimedOut, channel)
         self.who(channel)
-        if channel_obj.have_ops:
+        if self._conf.channel(channel).have_ops:
             self.mode(channel, True, 'b')
             self.mode(channel, True, 'q')
 
+    def _channelSyncTimedOut(self, channel):
+        self._syncTimeout = None
+        log.warn(u'timed out syncing {channel}', channel=channel)
+        self._finishChannelSync(channel)
+
+    def _finishChannelSync(self, channel):
+        if self.channelSyncState.get(channel) == 'syncing':
+            self.channelSyncState[channel] = 'synced'
+            for d in self._syncWaiters.pop(channel, []):
+                d.callback(None)
+        if channel != self._syncing:
+            return
+        if self._syncTimeout is not None:
+            self._syncTimeout.cancel()
+            self._syncTimeout = None
+        self._syncing = None
+        delay = max(
+            self._conf['irc.sync.interval'], self.serverLag.estimate() or 0)
+        self._syncCall = self.clock.callLater(delay, self._syncNextChannel)
+
+    def _stopChannelSync(self):
+        for call in (self._syncCall, self._syncTimeout):
+            if call is not None and call.active():
+                call.cancel()
+        self._syncCall = self._syncTimeout = self._syncing = None
+        self._syncQueue.clear()
+
     def irc_RPL_WHOREPLY(self, prefix, params):
         channel, user, host, _, nick = params[1:6]
         self.channel_collation[channel][nick] = '%s@%s' % (user, host)
 
     def irc_RPL_ENDOFWHO(self, prefix, params):
         channel = params[1]
-        self.fillChannel(self.channel_collation.pop(channel), channel)
+        # A WHO for a channel we're in always lists at least us, so an end
+        # with no replies answers some other query (or a channel we've
+        # since left), and mustn't empty the channel's stored membership.
+        if channel not in self.channel_collation:
+            return
+        d = self.fillChannel(self.channel_collation.pop(channel), channel)
+        d.addErrback(
+            lambda f: log.failure(
+                u'error filling {channel}', f, channel=channel))
+        d.addCallback(lambda ign: self._finishChannelSync(channel))
 
     def irc_RPL_BANLIST(self, prefix, params):
         _, channel, mask, setter, when = params
@@ -192,8 +517,7 @@ class Infobob(irc.IRCClient):
 
     def irc_RPL_ENDOFBANLIST(self, prefix, params):
         channel = params[1]
-        bans = self._ban_collation.pop(channel, [])
-        self.dbpool.ensure_active_bans(channel, 'b', bans)
+        self._resyncBanlist(channel, 'b', self._ban_collation.pop(channel, []))
 
     def irc_RPL_QUIETLIST(self, prefix, params):
         _, channel, _, mask, setter, when = params
@@ -201,39 +525,92 @@ class Infobob(irc.IRCClient):
 
     def irc_RPL_ENDOFQUIETLIST(self, prefix, params):
         channel = params[1]
-        quiets = self._quiet_collation.pop(channel, [])
-        self.dbpool.ensure_active_bans(channel, 'q', quiets)
+        self._resyncBanlist(
+            channel, 'q', self._quiet_collation.pop(channel, []))
 
-    def _blockChannelUpdates(self):
-        if self._channel_update_deferred.called:
-            self._channel_update_deferred = defer.Deferred()
+    def _resyncBanlist(self, channel, mode, entries):
+        """
+        Store the entries of a banlist (or quietlist) reply whose masks
+        weren't active when the database was last told about the list.
+        """
+        key = (channel, mode)
+        known = self.snapshots.banlists.get(key)
+        self.snapshots.banlists[key] = set(mask for mask, _, _ in entries)
+        if known is not None:
+            entries = [entry for entry in entries if entry[0] not in known]
+            if not entries:
+                return defer.succeed(None)
+        d = self.dbpool.ensure_active_bans(channel, mode, entries)
+        d.addErrback(self._banlistResyncFailed, key)
+        return d
 
-    def _unblockChannelUpdates(self):
-        if not self._channel_update_deferred.called:
-            self._channel_update_deferred.callback(None)
+    def _banlistResyncFailed(self, f, key):
+        # Forget the list, so that the next resync stores all of it.
+        self.snapshots.banlists.pop(key, None)
+        log.failure(u'error storing the +{mode} list of {channel}', f,
+                    channel=key[0], mode=key[1])
+
+    # Membership updates are written in order per channel. A ban check
+    # holds its own channel while it runs, so it sees a consistent view of
+    # that channel without stalling updates to any other channel. Changes
+    # that span channels (quits and nick changes) wait on every channel
+    # the nick was seen in.
+
+    def _channelsWithNick(self, nick):
+        return [channel for channel, members in self.channel_members.items()
+                if nick in members]
 
-    @defer.inlineCallbacks
     def fillChannel(self, users, channel):
-        yield self._channel_update_deferred
-        yield self.dbpool.set_users_in_channel(users, channel)
+        """
+        Store ``channel``'s members from a complete WHO reply. Once a
+        channel has been filled, later fills (after a reconnect, say) only
+        write the nicks that joined, left, or changed host since.
+        """
+        members = self.channel_members[channel]
+        self.channel_members[channel] = dict(users)
+        if channel not in self.snapshots.filled:
+            d = self._channel_updates.run(
+                [channel], self.dbpool.set_users_in_channel, users, channel)
+        else:
+            joined = dict((nick, host) for nick, host in users.iteritems()
+                          if members.get(nick) != host)
+            left = [nick for nick in members if nick not in users]
+            if not joined and not left:
+                return defer.succeed(None)
+            d = self._channel_updates.run(
+                [channel], self.dbpool.sync_users_in_channel,
+                channel, joined, left)
+        self.snapshots.filled.add(channel)
+        d.addErrback(self._fillFailed, channel)
+        return d
+
+    def _fillFailed(self, f, channel):
+        self.snapshots.filled.discard(channel)
+        return f
 
-    @defer.inlineCallbacks
     def addNick(self, nick, host, channel):
-        yield self._channel_update_deferred
-        yield self.dbpool.add_user_to_channel(nick, host, channel)
+        self.channel_members[channel][nick] = host
+        return self._channel_updates.run(
+            [channel], self.dbpool.add_user_to_channel, nick, host, channel)
 
-    @defer.inlineCallbacks
     def removeNick(self, nick, channel=None):
-        yield self._channel_update_deferred
         if channel is None:
-            yield self.dbpool.remove_nick_from_channels(nick)
-        else:
-            yield self.dbpool.remove_nick_from_channel(nick, channel)
+            channels = self._channelsWithNick(nick)
+            for member_of in channels:
+                del self.channel_members[member_of][nick]
+            return self._channel_updates.run(
+                channels, self.dbpool.remove_nick_from_channels, nick)
+        self.channel_members[channel].pop(nick, None)
+        return self._channel_updates.run(
+            [channel], self.dbpool.remove_nick_from_channel, nick, channel)
 
-    @defer.inlineCallbacks
     def renameNick(self, oldname, newname):
-        yield self._channel_update_deferred
-        yield self.dbpool.rename_nick(oldname, newname)
+        channels = self._channelsWithNick(oldname)
+        for member_of in channels:
+            members = self.channel_members[member_of]
+            members[newname] = members.pop(oldname)
+        return self._channel_updates.run(
+            channels, self.dbpool.rename_nick, oldname, newname)
 
     def irc_JOIN(self, prefix, params):
         """
@@ -266,8 +643,24 @@ class Infobob(irc.IRCClient):
         self.renameNick(oldname, newname)
 
     def connectionLost(self, reason):
-        if self.dbpool:
-            self.dbpool.close()
+        self.autojoined = False
+        self._stopChannelSync()
+        self.serverLag.forgetOutstanding()
+        waiters, self._syncWaiters = (
+            self._syncWaiters, collections.defaultdict(list))
+        for ds in waiters.values():
+            for d in ds:
+                d.errback(error.ConnectionLost())
+        self.channel_collation.clear()
+        for call in self._modeTimeouts.values():
+            if call.active():
+                call.cancel()
+        self._modeTimeouts.clear()
+        self._pendingModes.clear()
+        self._propagating.clear()
+        self._expiring.clear()
+        for name in list(self._loopers):
+            self.stopTimer(name)
         irc.IRCClient.connectionLost(self, reason)
 
     @defer.inlineCallbacks
@@ -300,20 +693,20 @@ class Infobob(irc.IRCClient):
                 u'privmsg from {user}: {message}', user=user, message=message
             )
             target = user
-            channel_obj = self._conf.channel('privmsg')
+            policy = self._policy('privmsg')
         else:
             target = channel
-            channel_obj = self._conf.channel(channel)
-        _ = channel_obj.translate
-        if channel_obj.is_usable('lol') and _lol_regex.search(message):
+            policy = self._policy(channel)
+        _ = policy.translate
+        if (policy.lol and not self._shedding('lol')
+                and _lol_regex.search(message)):
             self.do_lol(user, channel, _)
-        if channel_obj.is_usable('repaste'):
+        if policy.repaste and not self._shedding('repaste'):
             to_repaste = self._repaster.extractBadPasteSpecs(message)
             if to_repaste:
                 self.repaste(target, user, to_repaste, _)
 
-        m = re.match(
-            r'^s*%s\s*[,:> ]+(\S?.*?)[.!?]?\s*$' % self.nickname, message, re.I)
+        m = self._addressRegex().match(message)
         if m:
             command, = m.groups()
         elif channel == self.nickname:
@@ -323,9 +716,31 @@ class Infobob(irc.IRCClient):
 
         if command:
             s_command = command.split(' ')
-            command_func = getattr(self, 'infobob_' + s_command[0], None)
-            if command_func is not None and channel_obj.is_usable(s_command[0]):
-                command_func(target, channel_obj, *s_command[1:])
+            command_func = policy.commands.get(s_command[0])
+            if command_func is not None:
+                command_func(target, policy.channel, *s_command[1:])
+
+    def _addressRegex(self):
+        """
+        Return the pattern for messages addressed to us, compiled again only
+        when our nickname has changed.
+        """
+        if self.nickname != self._address_nickname:
+            self._address_nickname = self.nickname
+            self._address_regex = re.compile(
+                r'^\s*%s\s*[,:> ]+(\S?.*?)[.!?]?\s*$'
+                % (re.escape(self.nickname),), re.I)
+        return self._address_regex
+
+    def _policy(self, channel):
+        policy = self._policies.get(channel)
+        if policy is None:
+            handlers = dict(
+                (name[len('infobob_'):], getattr(self, name))
+                for name in dir(self) if name.startswith('infobob_'))
+            policy = self._policies[channel] = _ChannelPolicy(
+                self._conf.channel(channel), handlers)
+        return policy
 
     def noticed(self, user, channel, message):
         self._autojoinIfJustIdentified(user, message)
@@ -363,27 +778,27 @@ class Infobob(irc.IRCClient):
     @defer.inlineCallbacks
     def updateBan(self, user, channel, mode_set, mode, mask):
         channel_obj = self._conf.channel(channel)
-        if not channel_obj.have_ops:
+        nick, _x, host = user.partition('!')
+        # The server echoes a ban we propagated under its own spelling of
+        # the channel, which needn't be the configured one.
+        if not channel_obj.have_ops and not (
+                nick == self.nickname and mode_set
+                and self._propagationKey(channel, mode, mask)
+                    in self._propagating):
             return
         _ = channel_obj.translate
 
-        nick, _x, host = user.partition('!')
-        self._blockChannelUpdates()
+        # Mask checks need the channel's membership, so wait for it to be
+        # synced (only this channel's sync, not the whole autojoin).
         try:
-            if mode_set:
-                if nick != self.nickname:
-                    rowid = yield self.dbpool.add_ban(channel, user, mask, mode)
-            else:
-                not_expired = yield self.dbpool.remove_ban(
-                    channel, user, mask, mode)
-            if (not mode_set and not not_expired) or nick == self.nickname:
-                return
-            elif mask.startswith('$'):
-                others = None
-            elif mode_set:
-                others = yield self.dbpool.check_mask(channel, mask)
-        finally:
-            self._unblockChannelUpdates()
+            yield self.channelSynced(channel)
+        except error.ConnectionLost:
+            return
+        rowid, not_expired, others = yield self._channel_updates.run(
+            [channel], self._recordBanChange,
+            channel, user, mode_set, mode, mask)
+        if (not mode_set and not not_expired) or nick == self.nickname:
+            return
 
         if not mode_set:
             if not_expired:
@@ -483,6 +898,10 @@ class Infobob(irc.IRCClient):
                         self.mode(channel, False, mode, mask=mask)
                         rowid = yield self.dbpool.add_ban(
                             channel, user, new_mask, mode)
+                        self._publishBan(
+                            'add', channel, new_mask, mode, by=user)
+                        self._propagateBan(
+                            channel, mode, new_mask, rowid, replacing=mask)
                         mask = new_mask
 
                 elif n_affected_nicks == 1 and not others_by_account[None]:
@@ -514,6 +933,10 @@ class Infobob(irc.IRCClient):
                         self.mode(channel, False, mode, mask=mask)
                         rowid = yield self.dbpool.add_ban(
                             channel, user, new_mask, mode)
+                        self._publishBan(
+                            'add', channel, new_mask, mode, by=user)
+                        self._propagateBan(
+                            channel, mode, new_mask, rowid, replacing=mask)
                         mask = new_mask
 
         auth = yield self.dbpool.add_ban_auth(rowid)
@@ -522,6 +945,88 @@ class Infobob(irc.IRCClient):
         ).encode()
         self.msg(nick, _(u'to enter and edit details about this ban, please visit %s') % (url,))
 
+    @defer.inlineCallbacks
+    def _recordBanChange(self, channel, user, mode_set, mode, mask):
+        """
+        Store a ban being set or unset, and for a newly set mask, find the
+        nicks on the channel that it matches.
+
+        A ban set by someone else is also sent to the rest of the channel's
+        group; each copy is stored when the server echoes it back, so that
+        a copy that never made it isn't recorded as set.
+        """
+        nick = user.partition('!')[0]
+        rowid = not_expired = others = None
+        banlist = self.snapshots.banlists.get((channel, mode))
+        if banlist is not None:
+            if mode_set:
+                banlist.add(mask)
+            else:
+                banlist.discard(mask)
+        if not mode_set:
+            not_expired = yield self.dbpool.remove_ban(
+                channel, user, mask, mode)
+            if (channel, mode, mask) in self._expiring:
+                self._expiring.discard((channel, mode, mask))
+                self._publishBan('expire', channel, mask, mode)
+            else:
+                self._publishBan('unset', channel, mask, mode, by=user)
+        elif nick != self.nickname:
+            rowid = yield self.dbpool.add_ban(channel, user, mask, mode)
+            self._publishBan('add', channel, mask, mode, by=user)
+            self._propagateBan(channel, mode, mask, rowid)
+            if not mask.startswith('$'):
+                others = yield self.dbpool.check_mask(channel, mask)
+        else:
+            origin, _ = self._propagating.pop(
+                self._propagationKey(channel, mode, mask), (None, None))
+            if origin is not None:
+                yield self.dbpool.add_ban_copy(origin, channel)
+                self._publishBan('add', channel, mask, mode, by=user)
+        defer.returnValue((rowid, not_expired, others))
+
+    def _propagateBan(self, channel, mode, mask, rowid, replacing=None):
+        """
+        Queue the ban ``mask``, stored as ``rowid`` for ``channel``, for the
+        other channels in its channel group that we have ops in, unsetting
+        the ``replacing`` mask there if it's given.
+        """
+        now = self.clock.seconds()
+        for key, (_, deadline) in self._propagating.items():
+            if deadline is not None and deadline <= now:
+                del self._propagating[key]
+        for other in self._conf.channel_group(channel)[1:]:
+            if not self._conf.channel(other).have_ops:
+                continue
+            other = other.encode('utf-8')
+            banlist = self.snapshots.banlists.get((other, mode), ())
+            changes = []
+            if mask not in banlist:
+                self._propagating[self._propagationKey(other, mode, mask)] = (
+                    rowid, None)
+                changes.append((True, mode, mask))
+            if replacing is None:
+                pass
+            elif replacing in banlist:
+                changes.append((False, mode, replacing))
+            elif (True, mode, replacing) in self._pendingModes.get(other, ()):
+                self._pendingModes[other].remove((True, mode, replacing))
+                self._propagating.pop(
+                    self._propagationKey(other, mode, replacing), None)
+            if changes:
+                self.queueModes(other, changes)
+
+    def _propagationKey(self, channel, mode, mask):
+        casemapping = self.supported.getFeature('CASEMAPPING')
+        table = _CASEMAPPINGS.get(
+            casemapping[0] if casemapping else None, _CASEMAPPINGS['rfc1459'])
+        return channel.translate(table), mode, mask
+
+    def _publishBan(self, kind, channel, mask, mode, **fields):
+        if self.banEvents is not None:
+            self.banEvents.publish(
+                kind, channel=channel, mask=mask, mode=mode, **fields)
+
     def _deopSelf(self):
         for channel in self.is_opped:
             self.mode(channel, False, 'o', user=self.nickname)
@@ -533,13 +1038,27 @@ class Infobob(irc.IRCClient):
             if not self._conf.channel(channel).have_ops:
                 continue
             yield self.ensureOps(channel)
-            for _, mask, mode in it:
-                self.mode(channel, False, mode, mask=mask)
+            bans = list(it)
+            self._expiring.update(
+                (channel, mode, mask) for _, mask, mode in bans)
+            self.setModes(
+                channel, [(False, mode, mask) for _, mask, mode in bans])
 
     @defer.inlineCallbacks
     def do_lol(self, nick, channel, _):
-        yield self.dbpool.add_lol(nick)
-        self.msg(nick, _(_lol_message) % channel)
+        """
+        Tell ``nick`` off for lolling, or, in a channel with
+        ``lol_kick_after`` set, kick it once it has lolled that many times
+        within the tracker's window.
+        """
+        count = self.lols.record(nick) if self.lols is not None else 1
+        channel_obj = self._conf.channel(channel)
+        kick_after = channel_obj.lol_kick_after
+        if kick_after and channel_obj.have_ops and count >= kick_after:
+            yield self.ensureOps(channel)
+            self.kick(channel, nick, _(_lol_message) % channel)
+        else:
+            self.msg(nick, _(_lol_message) % channel)
 
     def pastebin(self, language, data):
         d = self._paster.createPaste(language, data)
@@ -561,6 +1080,11 @@ class Infobob(irc.IRCClient):
     @defer.inlineCallbacks
     def infobob_redent(self, target, channel, paste_target, *text):
         _ = channel.translate
+        if self._shedding('redent'):
+            log.info(u'shedding redent for {target}', target=target)
+            return
+        # Pygments is slow to import, and redent is rarely used.
+        from infobob.redent import redent
         redented = (
             redent(' '.join(text).decode('utf8', 'replace')).encode('utf8'))
         try:
@@ -576,15 +1100,47 @@ class Infobob(irc.IRCClient):
         self.msg(target, _(u'Okay!'))
         reactor.stop()
 
+def _modeLine(channel, changes):
+    flags = []
+    current = None
+    for is_set, mode, arg in changes:
+        if is_set != current:
+            flags.append('+' if is_set else '-')
+            current = is_set
+        flags.append(mode)
+    return 'MODE %s %s %s' % (
+        channel, ''.join(flags), ' '.join(arg for _, _, arg in changes))
+
+def _joinLine(channels):
+    names = ','.join(name for name, key in channels)
+    keys = ','.join(key for name, key in channels if key)
+    if keys:
+        return 'JOIN %s %s' % (names, keys)
+    return 'JOIN %s' % (names,)
+
 class InfobobFactory(protocol.ReconnectingClientFactory):
     protocol = Infobob
     maxDelay = 120
     lastProtocol = None
 
-    def __init__(self, conf):
+    def __init__(self, conf, paster=None, repaster=None):
         self._conf = conf
+        # Kept across reconnects, along with their pastebin latencies and
+        # repaste cache.
+        self.paster = paster or make_paster()
+        self.repaster = repaster or make_repaster(self.paster)
+        self.snapshots = ChannelSnapshots()
+        # Round trips from earlier connections are the best guess at the
+        # server's lag while a new one is getting going.
+        self.serverLag = RoundTripTracker()
 
     def buildProtocol(self, addr):
-        self.lastProtocol = p = self.protocol(self._conf)
+        self.lastProtocol = p = self.protocol(
+            self._conf, paster=self.paster, repaster=self.repaster,
+            snapshots=self.snapshots, serverLag=self.serverLag)
         p.factory = self
         return p
+
+    def configReloaded(self, oldConfig):
+        if self.lastProtocol is not None:
+            self.lastProtocol.configReloaded(oldConfig)
@@ -0,0 +1,175 @@
+"""
+Reactor lag monitoring, load shedding, and server round-trip tracking.
+
+A long template render or redent blocks the reactor, which delays
+everything else, including the PONGs that keep us connected. The
+:class:`LagMonitor` measures how late the reactor runs a timed call, and
+reports which optional features should be shed while the reactor is
+lagging. The :class:`RoundTripTracker` measures how long the IRC server
+takes to answer our PINGs.
+"""
+import collections
+import itertools
+
+from twisted.internet import reactor
+from twisted.application import service
+from twisted import logger
+
+from infobob.util import Histogram
+
+log = logger.Logger()
+
+
+class LagMonitor(service.Service):
+    """
+    Continuously measure reactor scheduling delay.
+
+    Every ``interval`` seconds, the difference between when a call was
+    due and when it actually ran is recorded. The current lag is the
+    largest delay seen among the last ``window`` samples. A feature is
+    shed while the current lag is at or above its threshold in
+    ``thresholds``; features without a threshold are never shed.
+    """
+    name = 'lag-monitor'
+
+    def __init__(self, thresholds, interval=0.5, window=20, clock=reactor):
+        self.thresholds = dict(thresholds)
+        self.interval = interval
+        self.histogram = Histogram()
+        self.recent = collections.deque(maxlen=window)
+        self.shed = frozenset()
+        self._clock = clock
+        self._call = None
+        self._expected = None
+
+    @property
+    def lag(self):
+        return max(self.recent) if self.recent else 0.0
+
+    def shedding(self, feature):
+        return feature in self.shed
+
+    def startService(self):
+        service.Service.startService(self)
+        self._schedule()
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+    def _schedule(self):
+        self._expected = self._clock.seconds() + self.interval
+        self._call = self._clock.callLater(self.interval, self._tick)
+
+    def _tick(self):
+        delay = max(0.0, self._clock.seconds() - self._expected)
+        self.histogram.record(delay)
+        self.recent.append(delay)
+        self._updateShed()
+        self._schedule()
+
+    def _updateShed(self):
+        lag = self.lag
+        shed = frozenset(
+            feature for feature, threshold in self.thresholds.iteritems()
+            if threshold is not None and lag >= threshold)
+        if shed == self.shed:
+            return
+        started, stopped = shed - self.shed, self.shed - shed
+        self.shed = shed
+        if started:
+            log.warn(
+                u'reactor lag {lag:.3f}s; shedding {features}',
+                lag=lag, features=u', '.join(sorted(started)))
+        if stopped:
+            log.info(
+                u'reactor lag {lag:.3f}s; resuming {features}',
+                lag=lag, features=u', '.join(sorted(stopped)))
+
+    def summary(self):
+        summary = self.histogram.summary()
+        summary.update(lag=self.lag, shed=sorted(self.shed))
+        return summary
+
+
+class RoundTripTracker(object):
+    """
+    Track round-trip times to the IRC server from PING/PONG pairs.
+
+    Each PING carries a token from :meth:`ping`; passing the token echoed
+    back in the PONG to :meth:`pong` records the round trip. The last
+    ``history`` round trips are kept in ``recent`` for anything that
+    wants to pace itself to the server.
+    """
+    def __init__(self, history=30, clock=reactor):
+        self.histogram = Histogram(smallest=0.005)
+        self.recent = collections.deque(maxlen=history)
+        self._pending = collections.OrderedDict()
+        self._counter = itertools.count()
+        self._clock = clock
+
+    def ping(self):
+        token = 'infobob-%d' % (next(self._counter),)
+        self._pending[token] = self._clock.seconds()
+        return token
+
+    def pong(self, token):
+        sent_at = self._pending.pop(token, None)
+        if sent_at is None:
+            return None
+        rtt = self._clock.seconds() - sent_at
+        self.histogram.record(rtt)
+        self.recent.append(rtt)
+        return rtt
+
+    @property
+    def outstanding(self):
+        return len(self._pending)
+
+    def forgetOutstanding(self):
+        """
+        Forget the unanswered PINGs, e.g. those sent on a connection that
+        has been lost, whose PONGs will never come. The recent round trips
+        are kept.
+        """
+        self._pending.clear()
+
+    def oldestOutstanding(self):
+        """
+        Return how long the oldest unanswered PING has been waiting, or 0
+        if every PING has been answered.
+        """
+        for sent_at in self._pending.itervalues():
+            return self._clock.seconds() - sent_at
+        return 0.0
+
+    def estimate(self, pct=90):
+        """
+        Return the ``pct``th percentile of the recent round trips, or None
+        if none have been measured yet.
+        """
+        if not self.recent:
+            return None
+        ordered = sorted(self.recent)
+        index = min(len(ordered) - 1, int(len(ordered) * pct / 100.0))
+        return ordered[index]
+
+    def timeout(self, multiplier, minimum, maximum):
+        """
+        Return how long a PING may go unanswered before the connection
+        should be considered dead: ``multiplier`` times the recent round
+        trip estimate, clamped to ``minimum`` and ``maximum``.
+        """
+        estimate = self.estimate()
+        if estimate is None:
+            return maximum
+        return max(minimum, min(maximum, estimate * multiplier))
+
+    def summary(self):
+        summary = self.histogram.summary()
+        summary.update(
+            recent=list(self.recent), outstanding=self.outstanding,
+            estimate=self.estimate())
+        return summary
@@ -0,0 +1,143 @@
+"""
+Counting lol offenses.
+
+Whether to escalate is decided from an in-memory sliding window of each
+nick's recent offenses, so a matching message costs no database work. The
+offenses are written to the database in batches, and rows older than the
+retention period are rolled up into daily totals, keeping ``lol_offenses``
+bounded.
+"""
+import collections
+
+from twisted.internet import defer, reactor, task
+from twisted.application import service
+from twisted import logger
+
+log = logger.Logger()
+
+_DAY = 24 * 60 * 60
+
+
+class OffenseWindow(object):
+    """
+    Count each nick's offenses over the last ``window`` seconds.
+
+    Offenses are counted in ``buckets`` buckets, each spanning an equal
+    part of the window, so a count may include offenses up to one bucket
+    older than ``window``. Only nicks with offenses in the window are
+    kept.
+    """
+    def __init__(self, window=120, buckets=12):
+        self.window = window
+        self.width = float(window) / buckets
+        self._nicks = {}
+
+    def __len__(self):
+        return len(self._nicks)
+
+    def record(self, nick, now):
+        """
+        Count an offense by ``nick`` at ``now``, and return how many
+        offenses ``nick`` has in the window, including this one.
+        """
+        bucket = int(now // self.width)
+        counts = self._nicks.get(nick)
+        if counts is None:
+            counts = self._nicks[nick] = collections.deque()
+        if counts and counts[-1][0] == bucket:
+            counts[-1][1] += 1
+        else:
+            counts.append([bucket, 1])
+        self._expire(counts, bucket)
+        return sum(count for _, count in counts)
+
+    def count(self, nick, now):
+        counts = self._nicks.get(nick)
+        if counts is None:
+            return 0
+        self._expire(counts, int(now // self.width))
+        return sum(count for _, count in counts)
+
+    def prune(self, now):
+        """
+        Forget every nick without offenses in the window.
+        """
+        bucket = int(now // self.width)
+        for nick, counts in self._nicks.items():
+            self._expire(counts, bucket)
+            if not counts:
+                del self._nicks[nick]
+
+    def _expire(self, counts, bucket):
+        oldest = bucket - int(self.window // self.width)
+        while counts and counts[0][0] < oldest:
+            counts.popleft()
+
+
+class LolTracker(service.Service):
+    """
+    Track lol offenses for escalation, and persist them in batches.
+
+    Offenses recorded are written every ``flushInterval`` seconds, and
+    once an hour the offenses older than ``retentionDays`` days are rolled
+    up into daily totals per nick. Stopping the service writes whatever's
+    still pending.
+    """
+    name = 'lol-tracker'
+
+    def __init__(self, dbpool, window=120, buckets=12, flushInterval=30,
+                 retentionDays=7, clock=reactor):
+        self.dbpool = dbpool
+        self.window = OffenseWindow(window, buckets)
+        self.retention = retentionDays * _DAY
+        self.pending = []
+        self._clock = clock
+        self._flushInterval = flushInterval
+        self._flusher = task.LoopingCall(self.flush)
+        self._flusher.clock = clock
+        self._roller = task.LoopingCall(self.rollUp)
+        self._roller.clock = clock
+
+    def record(self, nick):
+        """
+        Record an offense by ``nick``, and return how many offenses it has
+        in the window, including this one.
+        """
+        now = self._clock.seconds()
+        self.pending.append((nick, now))
+        return self.window.record(nick, now)
+
+    def startService(self):
+        service.Service.startService(self)
+        self._flusher.start(self._flushInterval, now=False)
+        self._roller.start(60 * 60, now=True)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        for looper in (self._flusher, self._roller):
+            if looper.running:
+                looper.stop()
+        return self.flush()
+
+    def flush(self):
+        """
+        Write the pending offenses, returning a Deferred that fires when
+        they've been written. Offenses that fail to be written are kept
+        for the next flush.
+        """
+        self.window.prune(self._clock.seconds())
+        if not self.pending:
+            return defer.succeed(None)
+        batch, self.pending = self.pending, []
+        d = self.dbpool.add_lols(batch)
+
+        def ebRequeue(f):
+            log.failure(u'error writing {count} lol offenses', f,
+                        count=len(batch))
+            self.pending[:0] = batch
+        return d.addErrback(ebRequeue)
+
+    def rollUp(self):
+        d = self.dbpool.roll_up_lols(self._clock.seconds() - self.retention)
+        return d.addErrback(
+            lambda f: log.failure(u'error rolling up lol offenses', f))
@@ -0,0 +1,103 @@
+"""
+Background database maintenance.
+
+Long-unset bans are moved to ``bans_archive``, stale ban edit links are
+expired, hosts of nicks no longer in any channel are pruned, and free pages
+are handed back with an incremental vacuum. Each task runs as a series of
+short database interactions, with a pause after each, so the bot's own
+writes never wait long behind it.
+"""
+from twisted.internet import defer, reactor, task
+from twisted.application import service
+from twisted import logger
+
+log = logger.Logger()
+
+_DAY = 24 * 60 * 60
+
+
+class MaintenanceService(service.Service):
+    """
+    Run every maintenance task, every ``interval`` seconds.
+
+    A slice of a task handles at most ``batchSize`` rows per statement and
+    stops starting new batches after ``sliceSeconds``; the next slice runs
+    ``sliceSeconds`` after that. Bans unset more than ``archiveAfterDays``
+    days ago are archived and edit links for unset bans set more than
+    ``authTokenDays`` days ago are expired; either can be None to keep
+    everything. Up to ``vacuumPages`` pages are freed per slice.
+    """
+    name = 'maintenance'
+
+    def __init__(self, dbpool, interval=600, sliceSeconds=0.05,
+                 batchSize=500, archiveAfterDays=365, authTokenDays=30,
+                 vacuumPages=100, clock=reactor):
+        self.dbpool = dbpool
+        self.sliceSeconds = sliceSeconds
+        self.batchSize = batchSize
+        self.archiveAfterDays = archiveAfterDays
+        self.authTokenDays = authTokenDays
+        self.vacuumPages = vacuumPages
+        self._clock = clock
+        self._interval = interval
+        self._looper = task.LoopingCall(self.runOnce)
+        self._looper.clock = clock
+
+    def startService(self):
+        service.Service.startService(self)
+        self._looper.start(self._interval, now=False)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self._looper.running:
+            self._looper.stop()
+
+    def tasks(self):
+        """
+        Return the maintenance tasks, as ``(name, slice)`` pairs: calling
+        ``slice()`` runs one slice and returns a Deferred that fires with
+        how many rows (or pages) it handled and whether the task is done.
+        """
+        now = self._clock.seconds()
+        budget = self.sliceSeconds
+        tasks = []
+        if self.archiveAfterDays is not None:
+            tasks.append(('archive bans', lambda: self.dbpool.archive_bans(
+                now - self.archiveAfterDays * _DAY, self.batchSize, budget)))
+        if self.authTokenDays is not None:
+            tasks.append((
+                'expire ban edit links',
+                lambda: self.dbpool.expire_ban_authorizations(
+                    now - self.authTokenDays * _DAY, self.batchSize,
+                    budget)))
+        tasks.append((
+            'prune user hosts',
+            lambda: self.dbpool.prune_user_hosts(self.batchSize, budget)))
+        tasks.append(('vacuum', lambda: self.dbpool.incremental_vacuum(
+            self.vacuumPages)))
+        return tasks
+
+    @defer.inlineCallbacks
+    def runOnce(self):
+        """
+        Run every task to completion, one slice at a time, stopping early
+        if the service is stopped. Errors are logged, and end only the task
+        they happened in.
+        """
+        for name, runSlice in self.tasks():
+            total = 0
+            done = False
+            while not done and self.running:
+                try:
+                    handled, done = yield runSlice()
+                except Exception:
+                    log.failure(u'error in maintenance task {task}',
+                                task=name)
+                    break
+                total += handled
+                if not done:
+                    yield task.deferLater(
+                        self._clock, self.sliceSeconds, lambda: None)
+            if total:
+                log.info(u'maintenance: {task}: {count}',
+                         task=name, count=total)
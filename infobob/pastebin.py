@@ -11,10 +11,8 @@ import time
 
 from twisted.internet import reactor
 from twisted.internet import defer
-from twisted.web import xmlrpc
 from twisted.web.http_headers import Headers
 from twisted import logger
-import treq
 import zope.interface as zi
 import attr
 
@@ -461,16 +459,26 @@ class FailedToRetrieve(Exception):
     pass
 
 
-def retrieveUrlContent(url, client=treq):
+def _treq():
+    # treq pulls in most of twisted.web and requests; only import it when
+    # something is actually fetched or pasted.
+    import treq
+    return treq
+
+
+def retrieveUrlContent(url, client=None):
     """
     Make a GET request to ``url``, verify 200 status response, and
     return a Deferred that fires with the content as a byte string.
+    ``client`` defaults to treq.
 
     Will errback with :exc:`FailedToRetrieve` if a non-200 response
     was received.
     """
     if isinstance(url, unicode):
         url = url.encode('utf-8')
+    if client is None:
+        client = _treq()
     log.info(u'Attempting to retrieve {url!r}'.format(url=url))
     respDfd = client.get(url)
 
@@ -627,10 +635,17 @@ class SpacepastePastebin(object):
     def __init__(self, name, serviceUrl):
         self.name = name
         self._serviceUrl = serviceUrl
-        self._proxy = xmlrpc.Proxy(serviceUrl.encode('ascii') + b'/xmlrpc/')
+        self._proxy = None
+
+    def _getProxy(self):
+        if self._proxy is None:
+            from twisted.web import xmlrpc
+            self._proxy = xmlrpc.Proxy(
+                self._serviceUrl.encode('ascii') + b'/xmlrpc/')
+        return self._proxy
 
     def checkIfAvailable(self):
-        d = self._proxy.callRemote(b'pastes.getLanguages')
+        d = self._getProxy().callRemote(b'pastes.getLanguages')
 
         def ebLogAndReportUnavailable(f):
             log.failure(
@@ -645,7 +660,7 @@ class SpacepastePastebin(object):
 
     @defer.inlineCallbacks
     def createPaste(self, content, language):
-        pasteId = yield self._proxy.callRemote(
+        pasteId = yield self._getProxy().callRemote(
             b'pastes.newPaste', language.encode('ascii'), content)
         defer.returnValue(u'{0}/show/{1}/'.format(
             self._serviceUrl,
@@ -655,7 +670,7 @@ class SpacepastePastebin(object):
 
 @zi.implementer(IPastebin)
 class PinnwandPastebin(object):
-    def __init__(self, name, client=treq):
+    def __init__(self, name, client=None):
         self.name = name
         self._client = client
         # For now just hardcode, no clue if other pastebins run this.
@@ -686,7 +701,8 @@ class PinnwandPastebin(object):
             b'code': content,
             b'expiry': self._expiry,
         })
-        response = yield self._client.post(
+        client = self._client if self._client is not None else _treq()
+        response = yield client.post(
             self._uploadUrl.encode('ascii'),
             data=payload,
             headers=Headers(
@@ -1,13 +1,18 @@
 from __future__ import with_statement
 from functools import partial
+import signal
 from zope.interface import implements
+from twisted.internet import reactor
 from twisted.internet.ssl import ClientContextFactory
 from twisted.plugin import IPlugin
 from twisted.python import usage
 from twisted.application import internet, service
 from twisted.application.service import IServiceMaker
+from twisted import logger
 from infobob.config import InfobobConfig
-from infobob import irc, database, http
+from infobob import irc, database, lag, events, lol, maintenance, backup
+
+log = logger.Logger()
 
 class InfobobOptions(usage.Options):
     def parseArgs(self, *args):
@@ -19,6 +24,42 @@ class InfobobOptions(usage.Options):
     def getSynopsis(self):
         return 'Usage: twistd [options] infobob <config file>'
 
+class WebUIService(service.Service):
+    """
+    Serve the web UI on ``web.port``.
+
+    Genshi and klein take a while to import, so the web UI is only
+    imported and started once the reactor is running, while the IRC
+    connection is waiting on the network, rather than ahead of it.
+    """
+    name = 'web'
+    port = None
+
+    def __init__(self, conf, clock=reactor):
+        self._conf = conf
+        self._clock = clock
+        self._call = None
+
+    def startService(self):
+        service.Service.startService(self)
+        self._call = self._clock.callLater(0, self._listen)
+
+    def _listen(self):
+        self._call = None
+        from infobob import http
+        site = http.makeSite(
+            http.DEFAULT_TEMPLATES_DIR, self._conf.dbpool, self._conf)
+        self.port = self._clock.listenTCP(self._conf['web.port'], site)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+        if self.port is not None:
+            port, self.port = self.port, None
+            return port.stopListening()
+
 class InfobobServiceMaker(object):
     implements(IServiceMaker, IPlugin)
     tapname = "infobob"
@@ -32,6 +73,55 @@ class InfobobServiceMaker(object):
         with open(options.config) as cfgFile:
             conf.load(cfgFile)
         conf.config_loc = options.config
+        self.conf = conf
+
+        # Services are stopped in the reverse of the order they're added,
+        # so the database is stopped after the IRC and web services, and
+        # waits for whatever they've already queued.
+        conf.dbpool = database.InfobobDatabaseRunner(conf)
+        conf.dbpool.setServiceParent(multiService)
+
+        conf.lolTracker = lol.LolTracker(
+            conf.dbpool,
+            window=conf['misc.lol.window'],
+            buckets=conf['misc.lol.buckets'],
+            flushInterval=conf['misc.lol.flush_interval'],
+            retentionDays=conf['misc.lol.retention_days'])
+        conf.lolTracker.setServiceParent(multiService)
+
+        self.maintenanceService = maintenance.MaintenanceService(
+            conf.dbpool,
+            interval=conf['maintenance.interval'],
+            sliceSeconds=conf['maintenance.slice_seconds'],
+            batchSize=conf['maintenance.batch_size'],
+            archiveAfterDays=conf['maintenance.archive_after_days'],
+            authTokenDays=conf['maintenance.auth_token_days'],
+            vacuumPages=conf['maintenance.vacuum_pages'])
+        self.maintenanceService.setServiceParent(multiService)
+
+        if conf['backup.directory'] is not None:
+            conf.backupService = backup.BackupService(
+                conf.dbpool, conf['database.sqlite.db_file'],
+                conf['backup.directory'],
+                interval=conf['backup.interval'],
+                keep=conf['backup.keep'],
+                pagesPerStep=conf['backup.pages_per_step'],
+                stepPause=conf['backup.step_pause'],
+                maxRestarts=conf['backup.max_restarts'])
+            conf.backupService.setServiceParent(multiService)
+
+        conf.lagMonitor = lag.LagMonitor(
+            conf['misc.lag.shed'],
+            interval=conf['misc.lag.interval'],
+            window=conf['misc.lag.window'])
+        conf.lagMonitor.setServiceParent(multiService)
+
+        conf.banEvents = events.BanEventHub(
+            history=conf['web.events.history'],
+            maxBuffered=conf['web.events.max_buffered'],
+            heartbeat=conf['web.events.heartbeat'])
+        conf.banEvents.setServiceParent(multiService)
+
         self.ircFactory = irc.InfobobFactory(conf)
         clientService = internet.TCPClient
         if conf['irc.ssl']:
@@ -41,8 +131,6 @@ class InfobobServiceMaker(object):
             conf['irc.server'], conf['irc.port'], self.ircFactory)
         self.ircService.setServiceParent(multiService)
 
-        conf.dbpool = database.InfobobDatabaseRunner(conf)
-
         if (conf['misc.manhole.socket'] is not None
                 and conf['misc.manhole.passwd_file']):
             from twisted.conch.manhole_tap import makeService
@@ -54,9 +142,29 @@ class InfobobServiceMaker(object):
             ))
             self.manholeService.setServiceParent(multiService)
 
-        self.webService = internet.TCPServer(
-            conf['web.port'],
-            http.makeSite(http.DEFAULT_TEMPLATES_DIR, conf.dbpool))
+        self.webService = WebUIService(conf)
         self.webService.setServiceParent(multiService)
 
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(
+                signal.SIGHUP,
+                lambda signum, frame: reactor.callFromThread(
+                    self.reloadConfig))
+
         return multiService
+
+    def reloadConfig(self):
+        """
+        Reread the config file, keeping the current configuration if it
+        can't be loaded. Server and web settings only take effect on
+        restart; channel settings and the autojoin list apply at once.
+        """
+        try:
+            with open(self.conf.config_loc) as cfgFile:
+                oldConfig = self.conf.reload(cfgFile)
+        except Exception:
+            log.failure(u'error reloading config from {path}',
+                        path=self.conf.config_loc)
+            return
+        log.info(u'reloaded config from {path}', path=self.conf.config_loc)
+        self.ircFactory.configReloaded(oldConfig)
@@ -1,10 +1,48 @@
+import io
+import os.path
+import json
+import sqlite3
+
 from twisted.internet import defer
+from twisted.trial.unittest import SkipTest
+from twisted.web.test.requesthelper import DummyRequest
+
+from infobob.config import InfobobConfig
+from infobob.database import InfobobDatabaseRunner
+
+
+SCHEMA_PATH = os.path.join(
+    os.path.dirname(__file__), os.pardir, os.pardir, 'db.schema')
 
 
 class FakeObj(object):
     pass
 
 
+class ProducerRequest(DummyRequest):
+    producer = None
+
+    def __init__(self):
+        DummyRequest.__init__(self, [b''])
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+
+class FakeDatabaseRunner(FakeObj):
+    epoch = 'test'
+    version = 0
+
+    def __init__(self):
+        self.streams = defer.DeferredSemaphore(1)
+
+    def get_bans_version(self):
+        return defer.succeed(self.version)
+
+
 class SequentialReturner(object):
     """
     Record calls and return the provide values in sequence.
@@ -50,3 +88,33 @@ class Call(object):
         )
         callargs = ', '.join(s for s in (argslist, kwargslist) if s)
         return 'Call({0})'.format(callargs)
+
+
+def makeConfig(configStructure):
+    conf = InfobobConfig()
+    conf.load(io.BytesIO(json.dumps(configStructure)))
+    return conf
+
+
+def makeDatabaseRunner(testCase, configStructure=None):
+    """
+    Create an :class:`InfobobDatabaseRunner` backed by a fresh database
+    file built from ``db.schema``, closed when the test finishes.
+
+    Skips the test if the schema isn't available (e.g. when testing an
+    installed package).
+    """
+    if not os.path.exists(SCHEMA_PATH):
+        raise SkipTest('db.schema not found at {0!r}'.format(SCHEMA_PATH))
+    dbFile = testCase.mktemp()
+    with open(SCHEMA_PATH) as schemaFile:
+        conn = sqlite3.connect(dbFile)
+        conn.executescript(schemaFile.read())
+        conn.close()
+    configStructure = dict(configStructure or {})
+    configStructure.setdefault('database', {}).setdefault(
+        'sqlite', {})['db_file'] = dbFile
+    conf = makeConfig(configStructure)
+    conf.dbpool = runner = InfobobDatabaseRunner(conf)
+    testCase.addCleanup(runner.close)
+    return runner
@@ -0,0 +1,147 @@
+import os
+import os.path
+import sqlite3
+
+from twisted.application import service
+from twisted.internet import defer, reactor, task
+from twisted.trial.unittest import TestCase as TrialTestCase
+
+from infobob import backup
+from infobob.backup import BackupService, BackupError, BackupInProgress
+import infobob.tests.support as sp
+
+
+class RestartingBackup(object):
+    """
+    Stand in for OnlineBackup, as if the source were written to before
+    every step, unless the step copies everything.
+    """
+    steps = []
+    finishes = True
+
+    def __init__(self, source, destination):
+        open(destination, 'w').close()
+        self.pagecount = 10
+        self.remaining = None
+
+    def step(self, pages):
+        self.steps.append(pages)
+        if pages < 0 and self.finishes:
+            self.remaining = 0
+            return True
+        self.remaining = 10 if self.remaining is None else 9 + len(self.steps)
+        return False
+
+    def close(self):
+        pass
+
+
+class BackupServiceTestCase(TrialTestCase):
+    def setUp(self):
+        self.runner = sp.makeDatabaseRunner(self)
+        self.directory = self.mktemp()
+        os.makedirs(self.directory)
+        self.service = BackupService(
+            self.runner, self.runner._conf['database.sqlite.db_file'],
+            self.directory, keep=2, pagesPerStep=1, stepPause=0,
+            clock=reactor)
+        self.service.startService()
+        self.addCleanup(self.service.stopService)
+
+    @defer.inlineCallbacks
+    def test_backup_copies_database(self):
+        yield self.runner.dbpool.runOperation("""
+            INSERT INTO bans (channel, mask, mode, set_at, set_by)
+            VALUES ('#project', 'baduser!*@*', 'b', 1, 'someop')
+        """)
+        path = yield self.service.backup()
+        self.assertEqual(self.service.snapshots(), [path])
+        self.assertEqual(os.listdir(self.directory), [os.path.basename(path)])
+        progress = self.service.progress()
+        self.assertEqual(progress['state'], 'done')
+        self.assertEqual(progress['remaining'], 0)
+        self.assertTrue(progress['pages'] > 1)
+
+        conn = sqlite3.connect(path)
+        self.addCleanup(conn.close)
+        self.assertEqual(
+            conn.execute('SELECT channel, mask FROM bans').fetchall(),
+            [(u'#project', u'baduser!*@*')])
+
+    @defer.inlineCallbacks
+    def test_only_one_backup_at_a_time(self):
+        d = self.service.backup()
+        self.failureResultOf(self.service.backup(), BackupInProgress)
+        yield d
+
+    @defer.inlineCallbacks
+    def test_rotation_keeps_newest(self):
+        for name in ['infobob-1.sqlite', 'infobob-2.sqlite']:
+            open(os.path.join(self.directory, name), 'w').close()
+        path = yield self.service.backup()
+        self.assertEqual(
+            [os.path.basename(p) for p in self.service.snapshots()],
+            ['infobob-2.sqlite', os.path.basename(path)])
+
+    @defer.inlineCallbacks
+    def test_stop_abandons_backup(self):
+        d = self.service.backup()
+        yield self.service.stopService()
+        yield self.assertFailure(d, BackupError)
+        self.assertEqual(self.service.progress()['state'], 'failed')
+        self.assertEqual(os.listdir(self.directory), [])
+
+    @defer.inlineCallbacks
+    def test_stopped_with_database_mid_backup(self):
+        # As under twistd, where both are stopped at once.
+        runner = sp.makeDatabaseRunner(self)
+        services = service.MultiService()
+        runner.setServiceParent(services)
+        backupService = BackupService(
+            runner, runner._conf['database.sqlite.db_file'], self.directory,
+            pagesPerStep=1, stepPause=0.2, clock=reactor)
+        backupService.setServiceParent(services)
+        services.startService()
+        d = backupService.backup()
+        # Long enough for the first step, but not the pause after it.
+        yield task.deferLater(reactor, 0.1, lambda: None)
+        self.assertEqual(backupService.progress()['state'], 'copying')
+
+        yield services.stopService()
+        self.assertEqual(backupService.progress()['state'], 'failed')
+        self.assertTrue(runner._closed)
+        yield self.assertFailure(d, BackupError)
+        self.assertEqual(os.listdir(self.directory), [])
+    test_stopped_with_database_mid_backup.timeout = 5
+
+    @defer.inlineCallbacks
+    def test_restarting_backup_finished_in_one_step(self):
+        self.patch(backup, 'OnlineBackup', RestartingBackup)
+        self.patch(RestartingBackup, 'steps', [])
+        self.service.maxRestarts = 2
+        path = yield self.service.backup()
+        self.assertEqual(RestartingBackup.steps, [1, 1, 1, -1])
+        progress = self.service.progress()
+        self.assertEqual(progress['state'], 'done')
+        self.assertEqual(progress['restarts'], 2)
+        self.assertEqual(self.service.snapshots(), [path])
+
+    @defer.inlineCallbacks
+    def test_gives_up_when_one_step_cannot_finish(self):
+        self.patch(backup, 'OnlineBackup', RestartingBackup)
+        self.patch(RestartingBackup, 'steps', [])
+        self.patch(RestartingBackup, 'finishes', False)
+        self.service.maxRestarts = 1
+        yield self.assertFailure(self.service.backup(), BackupError)
+        self.assertEqual(RestartingBackup.steps, [1, 1, -1])
+        self.assertEqual(self.service.progress()['state'], 'failed')
+        self.assertEqual(os.listdir(self.directory), [])
+
+    @defer.inlineCallbacks
+    def test_failure_to_start_is_reported(self):
+        self.service.source = os.path.join(self.directory, 'missing', 'db')
+        yield self.assertFailure(self.service.backup(), BackupError)
+        progress = self.service.progress()
+        self.assertEqual(progress['state'], 'failed')
+        self.assertIn('opening', progress['error'])
+        self.assertEqual(os.listdir(self.directory), [])
@@ -0,0 +1,113 @@
+from cStringIO import StringIO
+
+from twisted.internet import defer
+from twisted.trial.unittest import TestCase as TrialTestCase
+
+from infobob import bantool
+import infobob.tests.support as sp
+
+
+INSERT_BANS = """
+    INSERT INTO bans
+                (channel, mask, mode, set_at, set_by, expire_at, unset_at,
+                 unset_by, reason)
+    VALUES      ('#a', 'a1', 'b', 100, 'op', 200, 150, 'op', 'gone'),
+                ('#a', 'a2', 'q', 200.5, 'op', NULL, NULL, NULL,
+                 'caf\xc3\xa9, "quoted"
+and a newline'),
+                ('#b', 'b1', 'b', 100, 'op', NULL, NULL, NULL, NULL)
+"""
+
+
+class BanToolTestCase(TrialTestCase):
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.source = sp.makeDatabaseRunner(self)
+        yield self.source.dbpool.runOperation(INSERT_BANS)
+        self.code = yield self.source.add_ban_auth(2)
+        self.target = sp.makeDatabaseRunner(self)
+
+    @defer.inlineCallbacks
+    def allBans(self, runner):
+        bans = []
+        yield runner.stream_bans(bans.extend, 'all', with_auth=True)
+        defer.returnValue(bans)
+
+    @defer.inlineCallbacks
+    def roundTrip(self, format):
+        out = StringIO()
+        exported = yield bantool.exportBans(
+            self.source, out, format, batchSize=2)
+        self.assertEqual(exported, 3)
+        result = yield bantool.importBans(
+            self.target, StringIO(out.getvalue()), format, batchSize=2)
+        defer.returnValue((out.getvalue(), result))
+
+    @defer.inlineCallbacks
+    def test_ndjson_round_trip(self):
+        exported, result = yield self.roundTrip('ndjson')
+        self.assertEqual(len(exported.splitlines()), 3)
+        self.assertEqual(result, (3, 0))
+        source = yield self.allBans(self.source)
+        target = yield self.allBans(self.target)
+        self.assertEqual(target, source)
+        self.assertIn((b'a2', [self.code]),
+                      [(ban.mask, codes) for ban, codes in target])
+
+    @defer.inlineCallbacks
+    def test_csv_round_trip(self):
+        exported, result = yield self.roundTrip('csv')
+        self.assertTrue(exported.startswith('channel,mask,mode,set_at,'))
+        self.assertEqual(result, (3, 0))
+        source = yield self.allBans(self.source)
+        target = yield self.allBans(self.target)
+        self.assertEqual(target, source)
+
+    @defer.inlineCallbacks
+    def test_import_is_idempotent(self):
+        exported, _ = yield self.roundTrip('ndjson')
+        result = yield bantool.importBans(
+            self.target, StringIO(exported), 'ndjson')
+        self.assertEqual(result, (0, 0))
+        yield self.source.set_ban_reason(b'#b', b'b1', b'b', b'changed')
+        out = StringIO()
+        yield bantool.exportBans(self.source, out)
+        result = yield bantool.importBans(
+            self.target, StringIO(out.getvalue()))
+        self.assertEqual(result, (0, 1))
+        auths = yield self.target.dbpool.runQuery(
+            'SELECT count(*) FROM ban_authorizations')
+        self.assertEqual(auths, [(1,)])
+
+    @defer.inlineCallbacks
+    def test_import_moves_channels(self):
+        out = StringIO()
+        yield bantool.exportBans(self.source, out, channels=[b'#a'])
+        result = yield bantool.importBans(
+            self.target, StringIO(out.getvalue()),
+            channelMap={b'#a': b'#c'})
+        self.assertEqual(result, (2, 0))
+        target = yield self.allBans(self.target)
+        self.assertEqual([ban.channel for ban, _ in target], [b'#c', b'#c'])
+
+    @defer.inlineCallbacks
+    def test_bad_record_stops_after_written_batches(self):
+        lines = StringIO(
+            '{"channel":"#a","mask":"a1","mode":"b","set_at":1,'
+            '"set_by":"op"}\n'
+            '{"channel":"#a","mask":"a2"}\n')
+        e = yield self.assertFailure(
+            bantool.importBans(self.target, lines, batchSize=1), ValueError)
+        self.assertEqual(str(e), 'record 2: missing mode, set_at, set_by')
+        target = yield self.allBans(self.target)
+        self.assertEqual(len(target), 1)
+
+    def test_progress(self):
+        out = StringIO()
+        clock = sp.SequentialReturner([0, 1, 10, 12])
+        progress = bantool.Progress('imported', out, interval=5, clock=clock)
+        progress.add(100)
+        self.assertEqual(out.getvalue(), '')
+        progress.add(900)
+        self.assertEqual(
+            out.getvalue(), 'imported 1000 bans in 12.0s (83/s)\n')
@@ -0,0 +1,60 @@
+import io
+import json
+
+from twisted.trial.unittest import TestCase as TrialTestCase
+
+import infobob.tests.support as sp
+
+
+def configFile(configStructure):
+    return io.BytesIO(json.dumps(configStructure))
+
+
+class ReloadTestCase(TrialTestCase):
+    def setUp(self):
+        self.conf = sp.makeConfig({
+            'irc': {'autojoin': ['#a']},
+            'channels': {
+                'defaults': {'default_ban_time': 60},
+                '#a': {'commands': [['deny', 'lol']]},
+            },
+        })
+
+    def test_channels_rebuilt(self):
+        a = self.conf.channel('#a')
+        other = self.conf.channel('#other')
+        self.assertFalse(a.is_usable('lol'))
+
+        old = self.conf.reload(configFile({
+            'irc': {'autojoin': ['#a', '#b']},
+            'channels': {
+                'defaults': {'default_ban_time': 120},
+                '#b': {'have_ops': True},
+            },
+        }))
+        self.assertEqual(old['irc']['autojoin'], ['#a'])
+        self.assertEqual(self.conf['irc.autojoin'], ['#a', '#b'])
+        self.assertIsNot(self.conf.channel('#a'), a)
+        self.assertFalse(self.conf.channel('#a').is_usable('lol'))
+        self.assertEqual(self.conf.channel('#other').default_ban_time, 120)
+        self.assertIsNot(self.conf.channel('#other'), other)
+        self.assertTrue(self.conf.channel('#b').have_ops)
+        # The old objects are left as they were for anyone still using them.
+        self.assertEqual(other.default_ban_time, 60)
+
+    def test_broken_config_changes_nothing(self):
+        a = self.conf.channel('#a')
+        self.assertRaises(
+            ValueError, self.conf.reload, io.BytesIO(b'{"irc": '))
+        self.assertEqual(self.conf['irc.autojoin'], ['#a'])
+        self.assertIs(self.conf.channel('#a'), a)
+
+
+class ChannelGroupTestCase(TrialTestCase):
+    def test_channel_group(self):
+        conf = sp.makeConfig({
+            'channel_groups': {'python': ['#python', '#python-ot', '#pyx']},
+        })
+        self.assertEqual(conf.channel_group('#python-ot'),
+                         ['#python-ot', '#python', '#pyx'])
+        self.assertEqual(conf.channel_group('#other'), ['#other'])
@@ -0,0 +1,614 @@
+import datetime
+import sqlite3
+import threading
+import time
+
+import dateutil.tz
+
+from twisted.internet import defer
+from twisted.trial.unittest import TestCase as TrialTestCase
+
+from infobob import database
+import infobob.tests.support as sp
+
+
+class InteractionTimingTestCase(TrialTestCase):
+    @defer.inlineCallbacks
+    def test_interactions_are_timed(self):
+        runner = sp.makeDatabaseRunner(self)
+        yield runner.add_lols([(b'someone', 1)])
+        yield runner.add_lols([(b'someone', 2)])
+        yield runner.get_expired_bans()
+
+        self.assertEqual(runner.stats.execution['add_lols'].count, 2)
+        self.assertEqual(runner.stats.wait['add_lols'].count, 2)
+        self.assertEqual(runner.stats.execution['get_expired_bans'].count, 1)
+        self.assertEqual(
+            sorted(runner.stats.summary()), ['add_lols', 'get_expired_bans'])
+        self.assertEqual(list(runner.stats.slow), [])
+
+    @defer.inlineCallbacks
+    def test_slow_interactions_are_explained(self):
+        runner = sp.makeDatabaseRunner(self, {
+            'database': {'sqlite': {'slow_interaction_threshold': 0}},
+        })
+        result = yield runner.check_mask(b'#project', b'*!*@*')
+        self.assertEqual(result, [])
+        # Explained after the interaction, in one of its own.
+        yield runner.drain()
+
+        [(_, name, _, _, plans)] = runner.stats.slow
+        self.assertEqual(name, 'check_mask')
+        [(sql, plan)] = plans
+        self.assertTrue(sql.startswith('SELECT nick FROM channel_users'))
+        self.assertTrue(plan)
+
+
+    @defer.inlineCallbacks
+    def test_executemany_explained(self):
+        runner = sp.makeDatabaseRunner(self, {
+            'database': {'sqlite': {'slow_interaction_threshold': 0}},
+        })
+        yield runner.add_lols(iter([(b'someone', 1), (b'other', 2)]))
+        yield runner.drain()
+
+        [(_, name, _, _, plans)] = runner.stats.slow
+        self.assertEqual(name, 'add_lols')
+        [(sql, plan)] = plans
+        self.assertTrue(sql.startswith('INSERT OR IGNORE INTO lol_offenses'))
+        self.assertNotIn('could not explain', ' '.join(plan))
+        rows = yield runner.dbpool.runQuery(
+            'SELECT count(*) FROM lol_offenses')
+        self.assertEqual(rows, [(2,)])
+
+
+class BanPagesTestCase(TrialTestCase):
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.runner = sp.makeDatabaseRunner(self)
+        yield self.runner.dbpool.runOperation(INSERT_BANS)
+
+    @defer.inlineCallbacks
+    def collectPages(self, which, limit, **filters):
+        pages = []
+        after = None
+        while True:
+            bans, after = yield self.runner.get_bans_page(
+                which, after=after, limit=limit, **filters)
+            pages.append([(channel, mask) for channel, mask in
+                          (ban[:2] for ban in bans)])
+            if after is None:
+                defer.returnValue(pages)
+
+    @defer.inlineCallbacks
+    def test_pages_follow_channel_then_most_recent(self):
+        pages = yield self.collectPages('all', 2)
+        self.assertEqual(pages, [
+            [(b'#a', b'a3'), (b'#a', b'a2')],
+            [(b'#a', b'a2-tie'), (b'#a', b'a1')],
+            [(b'#b', b'b2'), (b'#b', b'b1')],
+        ])
+
+    @defer.inlineCallbacks
+    def test_active_and_channel_filter(self):
+        pages = yield self.collectPages('active', 3, channels=[b'#a'])
+        self.assertEqual(pages, [
+            [(b'#a', b'a3'), (b'#a', b'a2'), (b'#a', b'a2-tie')],
+        ])
+
+    @defer.inlineCallbacks
+    def test_expired_ordered_by_unset_across_channels(self):
+        pages = yield self.collectPages('expired', 1)
+        self.assertEqual(pages, [[(b'#b', b'b1')], [(b'#a', b'a1')]])
+        streamed = []
+        yield self.runner.stream_bans(streamed.extend, 'expired')
+        self.assertEqual([ban.mask for ban in streamed], [b'b1', b'a1'])
+        plan = yield self.runner.dbpool.runQuery(
+            "EXPLAIN QUERY PLAN SELECT rowid FROM bans WHERE %s"
+            " ORDER BY unset_at DESC, rowid"
+            % (database._BAN_LISTS['expired'][0],))
+        self.assertIn('bans_recently_expired', plan[0][-1])
+
+    @defer.inlineCallbacks
+    def test_filters(self):
+        pages = yield self.collectPages('all', 10, mask=b'a*', set_by=b'op')
+        self.assertEqual([mask for _, mask in pages[0]],
+                         [b'a3', b'a2', b'a2-tie', b'a1'])
+        pages = yield self.collectPages('all', 1, since=200, until=300)
+        self.assertEqual(pages, [[(b'#a', b'a2')], [(b'#a', b'a2-tie')],
+                                 [(b'#b', b'b2')]])
+        pages = yield self.collectPages('unset', 10, mode=b'b')
+        self.assertEqual(pages, [[(b'#a', b'a1'), (b'#b', b'b2'),
+                                  (b'#b', b'b1')]])
+        pages = yield self.collectPages('all', 10, mode=b'q')
+        self.assertEqual(pages, [[]])
+
+    @defer.inlineCallbacks
+    def test_rows_keep_epoch_times(self):
+        [ban], _ = yield self.runner.get_bans_page('unset', limit=1)
+        self.assertEqual(
+            ban, (b'#a', b'a1', b'b', 100, b'op', 200, b'gone', 150, b'op'))
+        self.assertEqual(ban.unset_by, b'op')
+        self.assertEqual(ban.expire_at_datetime, datetime.datetime(
+            1970, 1, 1, 0, 3, 20, tzinfo=dateutil.tz.tzutc()))
+        self.assertIs(ban.expire_at_datetime.tzinfo, database.local)
+
+    @defer.inlineCallbacks
+    def test_stream_waits_for_consumer(self):
+        batches = defer.DeferredQueue()
+
+        def deliver(bans):
+            ready = defer.Deferred()
+            batches.put(([ban.mask for ban in bans], ready))
+            return ready
+
+        d = self.runner.stream_bans(deliver, 'all', batch_size=2)
+        masks, ready = yield batches.get()
+        self.assertEqual(masks, [b'a3', b'a2'])
+        # Nothing more is fetched until the consumer's ready.
+        self.assertEqual(batches.pending, [])
+        ready.callback(None)
+        masks, ready = yield batches.get()
+        self.assertEqual(masks, [b'a2-tie', b'a1'])
+        ready.callback(False)
+        delivered = yield d
+        self.assertEqual(delivered, 4)
+        self.assertEqual(batches.pending, [])
+
+    @defer.inlineCallbacks
+    def test_streams_limited_and_abandoned_on_stop(self):
+        runner = sp.makeDatabaseRunner(self, {
+            'database': {'sqlite': {'max_streams': 1}}})
+        yield runner.dbpool.runOperation(INSERT_BANS)
+        batches = defer.DeferredQueue()
+
+        def deliver(bans):
+            batches.put(bans)
+            return defer.Deferred()
+
+        first = runner.stream_bans(deliver, 'all', batch_size=2)
+        second = runner.stream_bans(deliver, 'all', batch_size=2)
+        yield batches.get()
+        # The second waits for the first, which never gets an answer.
+        self.assertEqual(runner.streams.tokens, 0)
+        self.assertEqual(len(runner.streams.waiting), 1)
+        yield runner.stopService()
+        delivered = yield first
+        self.assertEqual(delivered, 2)
+        delivered = yield second
+        self.assertEqual(delivered, 0)
+        self.assertEqual(batches.pending, [])
+
+    @defer.inlineCallbacks
+    def test_stream_filters_and_resumes(self):
+        streamed = []
+        delivered = yield self.runner.stream_bans(
+            streamed.extend, 'all', after=(b'#a', 200, 2), mode=b'b',
+            batch_size=10)
+        self.assertEqual(delivered, 4)
+        self.assertEqual([ban.mask for ban in streamed],
+                         [b'a2-tie', b'a1', b'b2', b'b1'])
+
+
+class GroupBanTestCase(TrialTestCase):
+    @defer.inlineCallbacks
+    def test_group_ban_expiry_kept_in_sync(self):
+        runner = sp.makeDatabaseRunner(self, {
+            'channels': {'#a': {'default_ban_time': 60}}})
+        rowids = [(yield runner.add_ban(
+            b'#a', b'op!op@host', b'bad!*@*', b'b'))]
+        yield runner.set_ban_reason(b'#a', b'bad!*@*', b'b', b'spam')
+        for channel in [b'#b', b'#c']:
+            rowids.append((yield runner.add_ban_copy(rowids[0], channel)))
+        rows = yield runner.dbpool.runQuery("""
+            SELECT   channel, set_by, expire_at - set_at, reason
+            FROM     bans
+            ORDER BY rowid
+        """)
+        self.assertEqual(rows, [
+            (channel, b'op!op@host', 60, b'spam')
+            for channel in [b'#a', b'#b', b'#c']])
+
+        yield runner.remove_ban(b'#c', b'op!op@host', b'bad!*@*', b'b')
+        changed = yield runner.update_ban_by_rowid(
+            rowids[0], 1000, b'eggs', [b'#b', b'#c', b'#d'])
+        self.assertEqual(changed, [b'#a', b'#b'])
+        # Nothing left to change.
+        changed = yield runner.update_ban_by_rowid(
+            rowids[0], 1000, b'eggs', [b'#b', b'#c', b'#d'])
+        self.assertEqual(changed, [])
+        rows = yield runner.dbpool.runQuery(
+            'SELECT channel, expire_at, reason FROM bans ORDER BY rowid')
+        self.assertEqual(rows[:2], [(b'#a', 1000, b'eggs'),
+                                    (b'#b', 1000, b'eggs')])
+        # An unset ban is left alone.
+        self.assertNotEqual(rows[2][1:], (1000, b'eggs'))
+
+
+class BanSearchTestCase(TrialTestCase):
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.runner = sp.makeDatabaseRunner(self)
+        yield self.runner.dbpool.runOperation(INSERT_BANS)
+
+    @defer.inlineCallbacks
+    def search(self, text, limit=10, **kwargs):
+        pages = []
+        after = None
+        while True:
+            bans, after = yield self.runner.search_bans(
+                text, after=after, limit=limit, **kwargs)
+            pages.append([ban[1] for ban in bans])
+            if after is None:
+                defer.returnValue(pages)
+
+    def test_fts_query_quotes_terms(self):
+        self.assertEqual(database.fts_query(u'spam  bot*'), u'"spam" "bot"*')
+        self.assertEqual(database.fts_query(u'a"b OR NEAR('),
+                         u'"a""b" "OR" "NEAR("')
+        self.assertIs(database.fts_query(u' * '), None)
+
+    @defer.inlineCallbacks
+    def test_ranked_and_paged(self):
+        yield self.runner.set_ban_reason(b'#a', b'a3', b'b', b'spam bot')
+        yield self.runner.set_ban_reason(
+            b'#a', b'a2', b'b', b'spam, and a bot, and a great many words')
+        pages = yield self.search(u'spam bot', limit=1)
+        self.assertEqual(pages, [[b'a3'], [b'a2']])
+
+    @defer.inlineCallbacks
+    def test_mask_prefix_and_channels(self):
+        pages = yield self.search(u'a2*')
+        self.assertEqual(sorted(pages[0]), [b'a2', b'a2-tie'])
+        pages = yield self.search(u'gone', channels=[b'#b'])
+        self.assertEqual(pages, [[b'b1']])
+
+    @defer.inlineCallbacks
+    def test_syntax_is_literal(self):
+        pages = yield self.search(u'gone OR "')
+        self.assertEqual(pages, [[]])
+
+    @defer.inlineCallbacks
+    def test_index_follows_updates_and_deletes(self):
+        yield self.runner.set_ban_reason(b'#a', b'a3', b'b', b'flooding')
+        pages = yield self.search(u'flooding')
+        self.assertEqual(pages, [[b'a3']])
+        yield self.runner.set_ban_reason(b'#a', b'a3', b'b', b'spamming')
+        pages = yield self.search(u'flooding')
+        self.assertEqual(pages, [[]])
+        yield self.runner.dbpool.runOperation(
+            "DELETE FROM bans WHERE reason = 'gone'")
+        pages = yield self.search(u'gone')
+        self.assertEqual(pages, [[]])
+
+
+class BanStatsTestCase(TrialTestCase):
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.runner = sp.makeDatabaseRunner(self)
+        yield self.runner.dbpool.runOperation(INSERT_BANS)
+
+    def aggregates(self):
+        return self.runner.dbpool.runInteraction(lambda txn: [
+            txn.execute('SELECT * FROM %s ORDER BY 1, 2' % (table,))
+            .fetchall() for table in [
+                'ban_stats_channels', 'ban_stats_weekly',
+                'ban_stats_setters', 'ban_stats_durations']])
+
+    @defer.inlineCallbacks
+    def test_maintained_incrementally(self):
+        yield self.runner.dbpool.runOperation("""
+            UPDATE bans SET unset_at = 200 + 86400, unset_by = 'op'
+            WHERE mask = 'a2'
+        """)
+        yield self.runner.dbpool.runOperation("""
+            INSERT INTO bans (channel, mask, mode, set_at, set_by)
+            VALUES ('#a', '$a:spammer', 'b', 1209600, 'other!o@host')
+        """)
+        yield self.runner.dbpool.runOperation(
+            "DELETE FROM bans WHERE mask = 'b1'")
+        [channels, weekly, setters, durations] = yield self.aggregates()
+        self.assertEqual(channels, [
+            (b'#a', 3, 5, 1), (b'#b', 0, 1, 0)])
+        self.assertEqual(weekly, [
+            (b'#a', 0, 4), (b'#a', 2, 1), (b'#b', 0, 1)])
+        self.assertEqual(setters, [
+            (b'#a', b'op', 4), (b'#a', b'other', 1), (b'#b', b'op', 1)])
+        self.assertEqual(durations, [
+            (b'#a', 0, 1), (b'#a', 3, 1), (b'#b', 0, 1)])
+
+    @defer.inlineCallbacks
+    def test_rebuild_matches_triggers(self):
+        yield self.runner.dbpool.runOperation(
+            "UPDATE bans SET unset_at = 300, unset_by = 'op' "
+            "WHERE mask = 'a3'")
+        incremental = yield self.aggregates()
+        with open(sp.SCHEMA_PATH) as schemaFile:
+            schema = schemaFile.read()
+        yield self.runner.dbpool.runWithConnection(
+            lambda conn: conn.executescript(schema))
+        rebuilt = yield self.aggregates()
+        # Emptied rows are left behind by the triggers, but not the rebuild.
+        channels = incremental[0]
+        self.assertEqual(rebuilt[0], [row for row in channels if row[2]])
+        self.assertEqual(rebuilt[1:], [[row for row in rows if row[-1]]
+                                       for rows in incremental[1:]])
+
+    @defer.inlineCallbacks
+    def test_archived_bans_still_counted(self):
+        before = yield self.aggregates()
+        yield self.runner.archive_bans(200, 500, 1)
+        archived = yield self.aggregates()
+        self.assertEqual(archived, before)
+
+        with open(sp.SCHEMA_PATH) as schemaFile:
+            schema = schemaFile.read()
+        yield self.runner.dbpool.runWithConnection(
+            lambda conn: conn.executescript(schema))
+        rebuilt = yield self.aggregates()
+        self.assertEqual(rebuilt, before)
+
+    @defer.inlineCallbacks
+    def test_get_ban_stats(self):
+        week = 7 * 24 * 60 * 60
+        now = time.time()
+        yield self.runner.dbpool.runOperation("""
+            INSERT INTO bans (channel, mask, mode, set_at, set_by)
+            VALUES ('#b', 'b3', 'b', ?, 'other!o@host'),
+                   ('#b', 'b4', 'b', ?, 'other!o@host')
+        """, (now, now - week))
+        stats = yield self.runner.get_ban_stats(weeks=2, top_setters=1)
+        self.assertEqual([channel['channel'] for channel in stats],
+                         [b'#a', b'#b'])
+        b = stats[1]
+        self.assertEqual((b['active'], b['total'], b['account_masks']),
+                         (2, 4, 0))
+        self.assertEqual(b['weekly'], [1, 1])
+        self.assertEqual(b['setters'], [(b'op', 2)])
+        self.assertEqual(b['durations'], [2] + [0] * 8)
+        self.assertEqual(stats[0]['setters'], [(b'op', 4)])
+
+    def test_median_bucket(self):
+        self.assertEqual(database.median_bucket([0, 0]), None)
+        self.assertEqual(database.median_bucket([1, 0, 1]), 0)
+        self.assertEqual(database.median_bucket([1, 0, 2]), 2)
+
+
+class DataVersionTestCase(TrialTestCase):
+    @defer.inlineCallbacks
+    def test_only_ban_changes_bump_version(self):
+        runner = sp.makeDatabaseRunner(self, {
+            'channels': {'#a': {'default_ban_time': 60}}})
+        version = yield runner.get_bans_version()
+        yield runner.get_bans_page('all')
+        yield runner.add_lols([(b'someone', 1)])
+        self.assertEqual((yield runner.get_bans_version()), version)
+        yield runner.add_ban(b'#a', b'op!op@host', b'a1', b'b')
+        self.assertTrue((yield runner.get_bans_version()) > version)
+
+    @defer.inlineCallbacks
+    def test_archiving_nothing_keeps_version(self):
+        runner = sp.makeDatabaseRunner(self)
+        version = yield runner.get_bans_version()
+        handled, done = yield runner.archive_bans(200, 500, 1)
+        self.assertEqual((handled, done), (0, True))
+        yield runner.expire_ban_authorizations(200, 500, 1)
+        self.assertEqual((yield runner.get_bans_version()), version)
+
+    @defer.inlineCallbacks
+    def test_other_processes_bump_version(self):
+        runner = sp.makeDatabaseRunner(self)
+        version = yield runner.get_bans_version()
+        # As bantool would, from its own connection to the same file.
+        conn = sqlite3.connect(runner._conf['database.sqlite.db_file'])
+        with conn:
+            conn.execute("""
+                INSERT INTO bans (channel, mask, mode, set_at, set_by)
+                VALUES ('#a', 'a1', 'b', 0, 'op')
+            """)
+        conn.close()
+        self.assertTrue((yield runner.get_bans_version()) > version)
+
+
+class ChannelUsersTestCase(TrialTestCase):
+    @defer.inlineCallbacks
+    def test_sync_writes_differences(self):
+        runner = sp.makeDatabaseRunner(self)
+        yield runner.set_users_in_channel(
+            {b'a': b'a@host', b'b': b'b@host'}, b'#a')
+        yield runner.add_user_to_channel(b'b', b'b@host', b'#b')
+        yield runner.sync_users_in_channel(
+            b'#a', {b'c': b'c@host', b'a': b'a@elsewhere'}, [b'b'])
+        rows = yield runner.dbpool.runQuery("""
+            SELECT   channel, nick, host
+            FROM     channel_users JOIN user_hosts USING (nick)
+            ORDER BY channel, nick
+        """)
+        self.assertEqual(rows, [
+            (b'#a', b'a', b'a@elsewhere'),
+            (b'#a', b'c', b'c@host'),
+            (b'#b', b'b', b'b@host'),
+        ])
+
+
+class LolOffensesTestCase(TrialTestCase):
+    @defer.inlineCallbacks
+    def test_roll_up_into_daily_totals(self):
+        runner = sp.makeDatabaseRunner(self)
+        day = 24 * 60 * 60
+        yield runner.add_lols([
+            (b'a', 10), (b'a', 20), (b'b', 30), (b'a', day + 10),
+            (b'a', 3 * day)])
+        folded = yield runner.roll_up_lols(day + 20)
+        self.assertEqual(folded, 4)
+        # Rolling up again adds to the existing totals.
+        yield runner.add_lols([(b'a', 40)])
+        yield runner.roll_up_lols(day + 20)
+
+        daily = yield runner.dbpool.runQuery("""
+            SELECT * FROM lol_offenses_daily ORDER BY username, day
+        """)
+        self.assertEqual(daily, [(b'a', 0, 3), (b'a', 1, 1), (b'b', 0, 1)])
+        left = yield runner.dbpool.runQuery('SELECT * FROM lol_offenses')
+        self.assertEqual(left, [(b'a', 3 * day)])
+
+
+class MaintenanceTestCase(TrialTestCase):
+    @defer.inlineCallbacks
+    def setUp(self):
+        # The bans here are from 1970, far older than any edit link lasts.
+        self.runner = sp.makeDatabaseRunner(self, {
+            'maintenance': {'auth_token_days': None}})
+        yield self.runner.dbpool.runOperation(INSERT_BANS)
+
+    @defer.inlineCallbacks
+    def test_archive_in_slices(self):
+        yield self.runner.add_ban_auth(1)
+        yield self.runner.add_ban_auth(4)
+        # One row per batch, and no time for a second batch per slice.
+        slices = []
+        done = False
+        while not done:
+            handled, done = yield self.runner.archive_bans(200, 1, 0)
+            slices.append(handled)
+        self.assertEqual(slices, [1, 1, 0])
+
+        archived = yield self.runner.dbpool.runQuery(
+            'SELECT ban, mask FROM bans_archive ORDER BY ban')
+        self.assertEqual(archived, [(1, b'a1'), (5, b'b1')])
+        left = yield self.runner.dbpool.runQuery(
+            'SELECT mask FROM bans ORDER BY rowid')
+        self.assertEqual(left, [(b'a2',), (b'a2-tie',), (b'a3',), (b'b2',)])
+        auths = yield self.runner.dbpool.runQuery(
+            'SELECT ban FROM ban_authorizations')
+        self.assertEqual(auths, [(4,)])
+
+    @defer.inlineCallbacks
+    def test_archive_with_reused_rowid(self):
+        # Archiving the newest ban lets SQLite give its rowid to the next.
+        yield self.runner.dbpool.runOperation("""
+            INSERT INTO bans (channel, mask, mode, set_at, set_by, unset_at)
+            VALUES ('#c', 'first', 'b', 100, 'op', 150)
+        """)
+        yield self.runner.archive_bans(200, 500, 1)
+        yield self.runner.dbpool.runOperation("""
+            INSERT INTO bans (channel, mask, mode, set_at, set_by, unset_at)
+            VALUES ('#c', 'second', 'b', 160, 'op', 170)
+        """)
+        result = yield self.runner.archive_bans(200, 500, 1)
+        self.assertEqual(result, (1, True))
+        archived = yield self.runner.dbpool.runQuery(
+            "SELECT ban, mask FROM bans_archive WHERE channel = '#c'"
+            " ORDER BY id")
+        self.assertEqual(archived, [(7, b'first'), (7, b'second')])
+        stats = yield self.runner.get_ban_stats()
+        self.assertEqual(
+            [channel['total'] for channel in stats
+             if channel['channel'] == b'#c'], [2])
+
+    @defer.inlineCallbacks
+    def test_archive_scan_uses_index(self):
+        plan = yield self.runner.dbpool.runQuery(
+            'EXPLAIN QUERY PLAN SELECT rowid FROM bans WHERE unset_at < ?'
+            ' LIMIT ?', (200, 500))
+        self.assertIn('bans_by_unset', plan[0][-1])
+
+    @defer.inlineCallbacks
+    def test_expire_ban_authorizations(self):
+        old = yield self.runner.add_ban_auth(1)
+        active = yield self.runner.add_ban_auth(2)
+        new = yield self.runner.add_ban_auth(4)
+        yield self.runner.add_ban_auth(100)
+        result = yield self.runner.expire_ban_authorizations(250, 500, 1)
+        self.assertEqual(result, (2, True))
+        yield self.assertFailure(
+            self.runner.get_ban_with_auth(1, old), database.NoSuchBan)
+        # Set before the cutoff, but still in place.
+        ban = yield self.runner.get_ban_with_auth(2, active)
+        self.assertEqual(ban[1], b'a2')
+        ban = yield self.runner.get_ban_with_auth(4, new)
+        self.assertEqual(ban[1], b'a3')
+
+    @defer.inlineCallbacks
+    def test_old_authorizations_rejected(self):
+        runner = sp.makeDatabaseRunner(self, {
+            'maintenance': {'auth_token_days': 1}})
+        now = time.time()
+        then = now - 2 * 24 * 60 * 60
+        yield runner.dbpool.runOperation("""
+            INSERT INTO bans (channel, mask, mode, set_at, set_by, unset_at)
+            VALUES ('#a', 'old', 'b', ?, 'op', ?),
+                   ('#a', 'old-active', 'b', ?, 'op', NULL),
+                   ('#a', 'new', 'b', ?, 'op', ?)
+        """, (then, then + 60, then, now, now))
+        old = yield runner.add_ban_auth(1)
+        oldActive = yield runner.add_ban_auth(2)
+        new = yield runner.add_ban_auth(3)
+        yield self.assertFailure(
+            runner.get_ban_with_auth(1, old), database.NoSuchBan)
+        ban = yield runner.get_ban_with_auth(2, oldActive)
+        self.assertEqual(ban[1], b'old-active')
+        ban = yield runner.get_ban_with_auth(3, new)
+        self.assertEqual(ban[1], b'new')
+
+    @defer.inlineCallbacks
+    def test_prune_user_hosts(self):
+        yield self.runner.set_users_in_channel({b'a': b'a@host'}, b'#a')
+        yield self.runner.rename_nick(b'nobody', b'nobody')
+        yield self.runner.dbpool.runOperation(
+            "INSERT INTO user_hosts VALUES ('gone', 'gone@host')")
+        result = yield self.runner.prune_user_hosts(500, 1)
+        self.assertEqual(result, (1, True))
+        hosts = yield self.runner.dbpool.runQuery(
+            'SELECT nick FROM user_hosts')
+        self.assertEqual(hosts, [(b'a',)])
+
+    @defer.inlineCallbacks
+    def test_incremental_vacuum(self):
+        yield self.runner.dbpool.runOperation("""
+            INSERT INTO user_hosts
+            WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL
+                                    SELECT i + 1 FROM n WHERE i < 2000)
+            SELECT 'nick' || i, hex(randomblob(200)) FROM n
+        """)
+        yield self.runner.dbpool.runOperation('DELETE FROM user_hosts')
+        freed, done = yield self.runner.incremental_vacuum(2)
+        self.assertEqual((freed, done), (2, False))
+        freed, done = yield self.runner.incremental_vacuum(10000)
+        self.assertTrue(freed)
+        self.assertTrue(done)
+
+
+class LifecycleTestCase(TrialTestCase):
+    @defer.inlineCallbacks
+    def test_stop_drains_pending_interactions(self):
+        runner = sp.makeDatabaseRunner(self)
+        runner.startService()
+        release = threading.Event()
+        blocked = runner.runInteraction(
+            lambda runner, txn: release.wait(10))
+        expired = runner.get_expired_bans()
+
+        stopped = runner.stopService()
+        self.assertNoResult(stopped)
+        self.assertTrue(runner.dbpool.running)
+
+        release.set()
+        yield blocked
+        result = yield expired
+        yield stopped
+        self.assertEqual(result, [])
+        self.assertFalse(runner.dbpool.running)
+
+
+INSERT_BANS = """
+    INSERT INTO bans
+                (channel, mask, mode, set_at, set_by, expire_at, unset_at,
+                 unset_by, reason)
+    VALUES      ('#a', 'a1', 'b', 100, 'op', 200, 150, 'op', 'gone'),
+                ('#a', 'a2', 'b', 200, 'op', NULL, NULL, NULL, ''),
+                ('#a', 'a2-tie', 'b', 200, 'op', NULL, NULL, NULL, ''),
+                ('#a', 'a3', 'b', 300, 'op', NULL, NULL, NULL, ''),
+                ('#b', 'b1', 'b', 100, 'op', 200, 190, 'op', 'gone'),
+                ('#b', 'b2', 'b', 250, 'op', 400, 300, 'op', '')
+"""
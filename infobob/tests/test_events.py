@@ -0,0 +1,90 @@
+from twisted.internet import task
+from twisted.python import failure
+from twisted.trial.unittest import TestCase as TrialTestCase
+
+from infobob.events import BanEventHub, HEARTBEAT_FRAME, RESET_FRAME
+import infobob.tests.support as sp
+
+
+class BanEventHubTestCase(TrialTestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.hub = BanEventHub(
+            history=3, maxBuffered=100, heartbeat=15, clock=self.clock)
+        self.hub.epoch = 'e'
+
+    def subscribe(self, lastEventId=None):
+        request = sp.ProducerRequest()
+        done = self.hub.subscribe(request, lastEventId)
+        return request, done
+
+    def test_events_fan_out(self):
+        first, _ = self.subscribe()
+        second, _ = self.subscribe()
+        self.hub.publish('add', channel=b'#a', mask=b'*!*@x', mode=b'b')
+        frame = (
+            'id: e-1\nevent: add\n'
+            'data: {"channel":"#a","mask":"*!*@x","mode":"b"}\n\n')
+        self.assertEqual(first.written, [HEARTBEAT_FRAME, frame])
+        self.assertEqual(second.written, [HEARTBEAT_FRAME, frame])
+
+    def test_replay_since_last_event_id(self):
+        for mask in ['a', 'b', 'c', 'd']:
+            self.hub.publish('add', mask=mask)
+        request, _ = self.subscribe('e-2')
+        self.assertEqual(
+            [frame.split('\n')[0] for frame in request.written[1:]],
+            ['id: e-3', 'id: e-4'])
+        request, _ = self.subscribe('e-4')
+        self.assertEqual(request.written, [HEARTBEAT_FRAME])
+
+    def test_reset_when_replay_unavailable(self):
+        for mask in ['a', 'b', 'c', 'd', 'e']:
+            self.hub.publish('add', mask=mask)
+        for lastEventId in ['e-1', 'other-4', 'e-9', 'garbage']:
+            request, _ = self.subscribe(lastEventId)
+            self.assertEqual(request.written, [HEARTBEAT_FRAME, RESET_FRAME])
+
+    def test_shared_heartbeat(self):
+        self.hub.startService()
+        self.addCleanup(self.hub.stopService)
+        first, _ = self.subscribe()
+        second, _ = self.subscribe()
+        self.clock.advance(15)
+        self.assertEqual(first.written, [HEARTBEAT_FRAME] * 2)
+        self.assertEqual(second.written, [HEARTBEAT_FRAME] * 2)
+
+    def test_paused_subscriber_buffers_then_flushes(self):
+        request, _ = self.subscribe()
+        request.producer.pauseProducing()
+        self.hub.publish('add', mask='a')
+        self.hub.publish('unset', mask='a')
+        self.assertEqual(request.written, [HEARTBEAT_FRAME])
+        request.producer.resumeProducing()
+        self.assertEqual(len(request.written), 2)
+        self.assertEqual(request.written[1].count('id: '), 2)
+
+    def test_slow_subscriber_disconnected(self):
+        request, done = self.subscribe()
+        request.producer.pauseProducing()
+        for i in range(5):
+            self.hub.publish('add', mask='x' * 10)
+        self.assertEqual(request.finished, 1)
+        self.assertEqual(request.producer, None)
+        self.assertEqual(self.hub.subscribers, set())
+        self.assertTrue(done.called)
+
+    def test_client_gone(self):
+        request, done = self.subscribe()
+        request.processingFailed(failure.Failure(Exception('gone')))
+        self.assertEqual(self.hub.subscribers, set())
+        self.assertTrue(done.called)
+        self.hub.publish('add', mask='a')
+        self.assertEqual(request.written, [HEARTBEAT_FRAME])
+
+    def test_stop_closes_subscribers(self):
+        self.hub.startService()
+        request, done = self.subscribe()
+        self.hub.stopService()
+        self.assertEqual(request.finished, 1)
+        self.assertTrue(done.called)
@@ -1,19 +1,30 @@
 import os
 import os.path
-import datetime
 import tempfile
+import json
+import time
 import urllib
+import zlib
 
 from twisted.internet import reactor
 from twisted.internet import defer
 from twisted.internet import endpoints
+from twisted.internet import task
 from twisted.web import client as webclient
 from twisted.web import http_headers
 from twisted.web.iweb import IBodyProducer
 from twisted.trial.unittest import TestCase as TrialTestCase
 from zope.interface import implementer
 
-from infobob.http import makeSite, DEFAULT_TEMPLATES_DIR
+from genshi.template import TemplateLoader
+
+from infobob.database import BanRow
+from infobob.events import BanEventHub
+from infobob.http import makeSite, DEFAULT_TEMPLATES_DIR, InfobobWebUI
+from infobob.http import PresentedBan, presentBans
+from infobob.http import renderTemplate, streamTemplate
+from infobob.http import _PageProducer
+import infobob.http
 import infobob.tests.support as sp
 
 
@@ -22,8 +33,13 @@ class WebUITestCase(TrialTestCase):
         self.client = webclient.Agent(reactor)
 
     @defer.inlineCallbacks
-    def startWebUI(self, dbpool_fake):
-        self.site = makeSite(DEFAULT_TEMPLATES_DIR, dbpool_fake)
+    def startWebUI(self, dbpool_fake, lagMonitor=None, configStructure=None,
+                   banEvents=None, backupService=None):
+        conf = sp.makeConfig(configStructure or {})
+        conf.lagMonitor = lagMonitor
+        conf.banEvents = banEvents
+        conf.backupService = backupService
+        self.site = makeSite(DEFAULT_TEMPLATES_DIR, dbpool_fake, conf)
         self.endpoint = endpoints.TCP4ServerEndpoint(reactor, 8888)
         self.listeningPort = yield self.endpoint.listen(self.site)
         self.addCleanup(self.listeningPort.stopListening)
@@ -35,8 +51,9 @@ class WebUITestCase(TrialTestCase):
         content = yield webclient.readBody(res)
         defer.returnValue((res, content))
 
-    def get(self, url_path):
-        return self._request(b'GET', url_path)
+    def get(self, url_path, **headers):
+        return self._request(b'GET', url_path, http_headers.Headers(
+            dict((name, [value]) for name, value in headers.items())))
 
     def post(self, url_path, dataMapping):
         headers = http_headers.Headers()
@@ -56,11 +73,14 @@ class WebUITestCase(TrialTestCase):
                 dt('2018-03-21T15:09:26'), b'bad behavior', None, b'',
             ),
         ]
-        dbpool = sp.FakeObj()
-        dbpool.get_active_bans = sp.DeferredSequentialReturner([bans])
+        dbpool = sp.FakeDatabaseRunner()
+        dbpool.get_bans_page = sp.DeferredSequentialReturner([(bans, None)])
         yield self.startWebUI(dbpool)
 
         res, content = yield self.get(b'/bans')
+        self.assertEqual(
+            dbpool.get_bans_page.calls,
+            [sp.Call(b'active', after=None, limit=100, channels=None)])
         self.assertEqual(res.code, 200)
         self.assertIn(b'<table', content)
         self.assertIn(b'<td class="set-by">someop</td>', content)
@@ -68,6 +88,20 @@ class WebUITestCase(TrialTestCase):
         # TODO: Test that other expected bits appear.
         # TODO: Test more bans, in several channels, etc.
 
+    @defer.inlineCallbacks
+    def test_bans_index_shed_while_lagging(self):
+        dbpool = sp.FakeDatabaseRunner()
+        dbpool.get_bans_page = sp.DeferredSequentialReturner([])
+        lagMonitor = sp.FakeObj()
+        lagMonitor.lag = 2.5
+        lagMonitor.shedding = lambda feature: feature == 'web'
+        yield self.startWebUI(dbpool, lagMonitor)
+
+        res, content = yield self.get(b'/bans')
+        self.assertEqual(res.code, 503)
+        self.assertEqual(res.headers.getRawHeaders(b'Retry-After'), [b'3'])
+        self.assertEqual(dbpool.get_bans_page.calls, [])
+
     @defer.inlineCallbacks
     def test_expired_bans(self):
         bans = [
@@ -78,11 +112,14 @@ class WebUITestCase(TrialTestCase):
                 dt('2018-02-10T18:28:18'), b'forgivingop!bar',
             ),
         ]
-        dbpool = sp.FakeObj()
-        dbpool.get_recently_expired_bans = sp.DeferredSequentialReturner([bans])
+        dbpool = sp.FakeDatabaseRunner()
+        dbpool.get_bans_page = sp.DeferredSequentialReturner([(bans, None)])
         yield self.startWebUI(dbpool)
 
         res, content = yield self.get(b'/bans/expired')
+        self.assertEqual(
+            dbpool.get_bans_page.calls,
+            [sp.Call(b'expired', after=None, limit=10, channels=None)])
         self.assertEqual(res.code, 200)
         self.assertIn(b'<table', content)
         self.assertIn(b'$a:forgivenuser</td>', content)
@@ -104,8 +141,8 @@ class WebUITestCase(TrialTestCase):
                 dt('2018-02-10T18:28:18'), b'forgivingop!bar',
             ),
         ]
-        dbpool = sp.FakeObj()
-        dbpool.get_all_bans = sp.DeferredSequentialReturner([bans])
+        dbpool = sp.FakeDatabaseRunner()
+        dbpool.get_bans_page = sp.DeferredSequentialReturner([(bans, None)])
         yield self.startWebUI(dbpool)
 
         res, content = yield self.get(b'/bans/all')
@@ -113,17 +150,346 @@ class WebUITestCase(TrialTestCase):
         self.assertIn(b'<table', content)
         self.assertIn(b'$a:baduser</td>', content)
         self.assertIn(b'$a:forgivenuser</td>', content)
+        self.assertNotIn(b'next page', content)
         # TODO: Test that other expected bits appear.
         # TODO: Test more bans, in several channels, etc.
 
+    @defer.inlineCallbacks
+    def test_all_bans_paginated(self):
+        bans = [
+            (
+                b'#project', b'$a:baduser', b'b',
+                dt('2018-03-14T15:09:26'), b'someop!foo',
+                dt('2018-03-21T15:09:26'), b'bad behavior', None, b'',
+            ),
+        ]
+        dbpool = sp.FakeDatabaseRunner()
+        dbpool.get_bans_page = sp.DeferredSequentialReturner([
+            (bans, (b'#project', 1521040166.5, 7)),
+            (bans, None),
+        ])
+        yield self.startWebUI(
+            dbpool, configStructure={'web': {'max_page_size': 5}})
+
+        res, content = yield self.get(
+            b'/bans/all?channel=%23project&limit=10')
+        self.assertEqual(res.code, 200)
+        next_url = (
+            b'/bans/all?channel=%23project&amp;limit=10'
+            b'&amp;after=%23project%2C1521040166.5%2C7')
+        self.assertIn(b'<a href="%s">next page</a>' % (next_url,), content)
+
+        res, content = yield self.get(next_url.replace(b'&amp;', b'&'))
+        self.assertEqual(res.code, 200)
+        self.assertEqual(dbpool.get_bans_page.calls, [
+            sp.Call(b'all', after=None, limit=5, channels=[b'#project']),
+            sp.Call(b'all', after=(b'#project', 1521040166.5, 7), limit=5,
+                    channels=[b'#project']),
+        ])
+
+    @defer.inlineCallbacks
+    def test_all_bans_bad_cursor(self):
+        dbpool = sp.FakeDatabaseRunner()
+        dbpool.get_bans_page = sp.DeferredSequentialReturner([])
+        yield self.startWebUI(dbpool)
+
+        res, content = yield self.get(b'/bans/all?after=garbage')
+        self.assertEqual(res.code, 400)
+        self.assertEqual(dbpool.get_bans_page.calls, [])
+
+    @defer.inlineCallbacks
+    def test_ban_pages_cached_per_version(self):
+        dbpool = sp.FakeDatabaseRunner()
+        dbpool.get_bans_page = sp.DeferredSequentialReturner([
+            ([ACTIVE_BAN], None),
+            ([], None),
+        ])
+        yield self.startWebUI(dbpool)
+
+        res, first = yield self.get(b'/bans')
+        [etag] = res.headers.getRawHeaders(b'ETag')
+        res, second = yield self.get(b'/bans')
+        self.assertEqual(res.headers.getRawHeaders(b'ETag'), [etag])
+        self.assertEqual(second, first)
+        self.assertEqual(len(dbpool.get_bans_page.calls), 1)
+
+        dbpool.version += 1
+        res, content = yield self.get(b'/bans')
+        self.assertNotEqual(res.headers.getRawHeaders(b'ETag'), [etag])
+        self.assertNotIn(b'$a:baduser', content)
+        self.assertEqual(len(dbpool.get_bans_page.calls), 2)
+
+    @defer.inlineCallbacks
+    def test_ban_pages_not_modified(self):
+        dbpool = sp.FakeDatabaseRunner()
+        dbpool.get_bans_page = sp.DeferredSequentialReturner([
+            ([ACTIVE_BAN], None),
+        ])
+        yield self.startWebUI(dbpool, configStructure={
+            'web': {'cache': {'max_entries': 0}},
+        })
+
+        res, _ = yield self.get(b'/bans/all')
+        [etag] = res.headers.getRawHeaders(b'ETag')
+        # Even uncached, a current ETag means nothing needs to be rendered.
+        res, content = yield self.get(b'/bans/all', **{b'If-None-Match': etag})
+        self.assertEqual(res.code, 304)
+        self.assertEqual(content, b'')
+        self.assertEqual(len(dbpool.get_bans_page.calls), 1)
+
+    @defer.inlineCallbacks
+    def test_ban_pages_gzipped_from_cache(self):
+        dbpool = sp.FakeDatabaseRunner()
+        dbpool.get_bans_page = sp.DeferredSequentialReturner([
+            ([ACTIVE_BAN], None),
+        ])
+        yield self.startWebUI(dbpool)
+
+        _, plain = yield self.get(b'/bans', **{b'Accept-Encoding': b'gzip'})
+        res, content = yield self.get(
+            b'/bans', **{b'Accept-Encoding': b'deflate, gzip;q=0.5'})
+        self.assertEqual(
+            res.headers.getRawHeaders(b'Content-Encoding'), [b'gzip'])
+        self.assertEqual(
+            res.headers.getRawHeaders(b'Vary'), [b'Accept-Encoding'])
+        self.assertTrue(
+            res.headers.getRawHeaders(b'ETag')[0].endswith(b'-gz"'))
+        self.assertEqual(zlib.decompress(content, 16 + zlib.MAX_WBITS), plain)
+
+        res, content = yield self.get(
+            b'/bans', **{b'Accept-Encoding': b'gzip;q=0'})
+        self.assertEqual(res.headers.getRawHeaders(b'Content-Encoding'), None)
+        self.assertEqual(content, plain)
+
+    @defer.inlineCallbacks
+    def test_search_bans(self):
+        dbpool = sp.FakeDatabaseRunner()
+        dbpool.search_bans = sp.DeferredSequentialReturner([
+            ([ACTIVE_BAN], (-1.5, 7)),
+        ])
+        yield self.startWebUI(dbpool)
+
+        res, content = yield self.get(b'/bans/search?q=bad+behavior&limit=1')
+        self.assertEqual(res.code, 200)
+        self.assertEqual(dbpool.search_bans.calls, [
+            sp.Call(u'bad behavior', after=None, limit=1, channels=None)])
+        self.assertIn(b'value="bad behavior"', content)
+        self.assertIn(b'<td class="tt">#project</td>', content)
+        self.assertIn(b'<td class="set-by">someop</td>', content)
+        self.assertIn(
+            b'<a href="/bans/search?limit=1&amp;q=bad+behavior'
+            b'&amp;after=-1.5%2C7">next page</a>', content)
+
+    @defer.inlineCallbacks
+    def test_search_bans_bad_cursor(self):
+        dbpool = sp.FakeDatabaseRunner()
+        dbpool.search_bans = sp.DeferredSequentialReturner([])
+        yield self.startWebUI(dbpool)
+
+        res, content = yield self.get(b'/bans/search?q=spam&after=1,2,3')
+        self.assertEqual(res.code, 400)
+        self.assertEqual(dbpool.search_bans.calls, [])
+
+    @defer.inlineCallbacks
+    def test_ban_stats(self):
+        self.patch(infobob.http, 'current_week', lambda: 100)
+        dbpool = sp.FakeDatabaseRunner()
+        dbpool.get_ban_stats = sp.DeferredSequentialReturner([[dict(
+            channel=b'#project', active=3, total=8, account_masks=2,
+            weekly=[1, 0, 3], setters=[(b'someop', 5), (b'otherop', 3)],
+            durations=[1, 0, 0, 4, 0, 0, 0, 0, 0],
+        )]])
+        yield self.startWebUI(
+            dbpool, configStructure={'web': {'stats': {'weeks': 3}}})
+
+        res, content = yield self.get(b'/bans/stats')
+        self.assertEqual(res.code, 200)
+        self.assertEqual(dbpool.get_ban_stats.calls,
+                         [sp.Call(weeks=3, top_setters=5, week=100)])
+        for expected in [
+                b'<td class="tt">#project</td>', b'<th>$a: masks</th>',
+                b'<td class="center">1.3</td>', b'<td class="tt">1 0 3</td>',
+                b'<td class="center">1-3 days</td>',
+                b'<td class="center">25%</td>',
+                b'<td>someop (5), otherop (3)</td>']:
+            self.assertIn(expected, content)
+
+    @defer.inlineCallbacks
+    def test_ban_stats_cached_per_week(self):
+        week = [100]
+        self.patch(infobob.http, 'current_week', lambda: week[0])
+        dbpool = sp.FakeDatabaseRunner()
+        dbpool.get_ban_stats = sp.DeferredSequentialReturner([[], []])
+        yield self.startWebUI(dbpool)
+
+        res, _ = yield self.get(b'/bans/stats')
+        [etag] = res.headers.getRawHeaders(b'ETag')
+        res, _ = yield self.get(b'/bans/stats')
+        self.assertEqual(res.headers.getRawHeaders(b'ETag'), [etag])
+        self.assertEqual(len(dbpool.get_ban_stats.calls), 1)
+
+        week[0] += 1
+        res, _ = yield self.get(b'/bans/stats', **{b'If-None-Match': etag})
+        self.assertEqual(res.code, 200)
+        self.assertEqual(dbpool.get_ban_stats.calls[1].kwargs['week'], 101)
+
+    @defer.inlineCallbacks
+    def test_ban_event_stream(self):
+        hub = BanEventHub()
+        hub.publish('add', mask=b'missed')
+        hub.publish('add', mask=b'seen')
+        yield self.startWebUI(sp.FakeDatabaseRunner(), banEvents=hub)
+
+        streamed = self.get(
+            b'/bans/events', **{b'Last-Event-ID': hub.epoch + b'-1'})
+        while not hub.subscribers:
+            yield task.deferLater(reactor, 0.001, lambda: None)
+        hub.publish('unset', mask=b'live')
+        hub.stopService()
+        res, content = yield streamed
+
+        self.assertEqual(res.code, 200)
+        self.assertEqual(res.headers.getRawHeaders(b'Content-type'),
+                         [b'text/event-stream'])
+        events = [line for line in content.splitlines()
+                  if line.startswith(b'data: ')]
+        self.assertEqual(events, [
+            b'data: {"mask":"seen"}', b'data: {"mask":"live"}'])
+
+    @defer.inlineCallbacks
+    def test_ban_event_stream_unavailable(self):
+        yield self.startWebUI(sp.FakeDatabaseRunner())
+        res, _ = yield self.get(b'/bans/events')
+        self.assertEqual(res.code, 404)
+
+    @defer.inlineCallbacks
+    def test_admin_backup(self):
+        backupService = sp.FakeObj()
+        backupService.current = None
+        backupService.backup = sp.DeferredSequentialReturner(['/tmp/x'])
+        backupService.progress = lambda: {'state': 'done'}
+        yield self.startWebUI(
+            sp.FakeDatabaseRunner(), backupService=backupService,
+            configStructure={'backup': {'admin_token': 'sekrit'}})
+
+        res, content = yield self.get(
+            b'/admin/backup', authorization=b'Bearer wrong')
+        self.assertEqual(res.code, 403)
+        # Not taken from the URL.
+        res, content = yield self.get(b'/admin/backup?token=sekrit')
+        self.assertEqual(res.code, 403)
+        res, content = yield self._request(
+            b'POST', b'/admin/backup', http_headers.Headers(
+                {b'Authorization': [b'Bearer sekrit']}))
+        self.assertEqual(res.code, 202)
+        self.assertEqual(backupService.backup.calls, [sp.Call()])
+        res, content = yield self.get(
+            b'/admin/backup', authorization=b'Bearer sekrit')
+        self.assertEqual(res.code, 200)
+        self.assertEqual(json.loads(content), {'state': 'done'})
+
+    @defer.inlineCallbacks
+    def test_admin_backup_unavailable_without_token(self):
+        yield self.startWebUI(
+            sp.FakeDatabaseRunner(), backupService=sp.FakeObj())
+        res, content = yield self.get(
+            b'/admin/backup', authorization=b'Bearer ')
+        self.assertEqual(res.code, 404)
+
+    @defer.inlineCallbacks
+    def test_api_bans_filtered(self):
+        dbpool = sp.FakeDatabaseRunner()
+        dbpool.get_bans_page = sp.DeferredSequentialReturner([
+            ([RAW_BAN], (b'#project', 1521040166.5, 7)),
+        ])
+        yield self.startWebUI(dbpool)
+
+        res, content = yield self.get(
+            b'/api/bans?state=expired&channel=%23project&mask=%24a%3A*'
+            b'&set_by=someop!*&mode=b&since=1500000000&until=1600000000'
+            b'&limit=1')
+        self.assertEqual(res.code, 200)
+        self.assertEqual(
+            res.headers.getRawHeaders(b'Content-type'), [b'application/json'])
+        self.assertEqual(dbpool.get_bans_page.calls, [sp.Call(
+            b'unset', limit=1, after=None, channels=[b'#project'],
+            mode=b'b', mask=b'$a:*', set_by=b'someop!*',
+            since=1500000000.0, until=1600000000.0)])
+        self.assertEqual(json.loads(content), {
+            u'columns': [
+                u'channel', u'mask', u'mode', u'set_at', u'set_by',
+                u'expire_at', u'reason', u'unset_at', u'unset_by'],
+            u'bans': [[
+                u'#project', u'$a:baduser', u'b', 1521040166.5,
+                u'someop!foo', None, u'bad \ufffd', None, None]],
+            u'next': u'#project,1521040166.5,7',
+        })
+
+    @defer.inlineCallbacks
+    def test_api_bans_bad_filter(self):
+        dbpool = sp.FakeDatabaseRunner()
+        dbpool.get_bans_page = sp.DeferredSequentialReturner([])
+        yield self.startWebUI(dbpool)
+
+        for query in [b'state=gone', b'since=whenever', b'after=garbage']:
+            res, content = yield self.get(b'/api/bans?' + query)
+            self.assertEqual(res.code, 400)
+            self.assertIn(u'error', json.loads(content))
+        res, content = yield self.get(b'/api/bans.ndjson?state=gone')
+        self.assertEqual(res.code, 400)
+        self.assertEqual(dbpool.get_bans_page.calls, [])
+
+    @defer.inlineCallbacks
+    def test_api_bans_export_streams_every_batch(self):
+        streamed = []
+
+        @defer.inlineCallbacks
+        def stream_bans(deliver, which, **kwargs):
+            streamed.append((which, kwargs))
+            for batch in [[RAW_BAN], [RAW_BAN, RAW_BAN]]:
+                wanted = yield deliver(batch)
+                self.assertTrue(wanted)
+            defer.returnValue(3)
+
+        dbpool = sp.FakeDatabaseRunner()
+        dbpool.stream_bans = stream_bans
+        yield self.startWebUI(
+            dbpool, configStructure={'web': {'max_page_size': 2}})
+
+        res, content = yield self.get(
+            b'/api/bans.ndjson?state=active&after=%23project,1521040166.5,7')
+        self.assertEqual(res.code, 200)
+        self.assertEqual(res.headers.getRawHeaders(b'Content-type'),
+                         [b'application/x-ndjson'])
+        lines = content.splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(
+            json.loads(lines[0])[:2], [u'#project', u'$a:baduser'])
+        [(which, kwargs)] = streamed
+        self.assertEqual(which, b'active')
+        self.assertEqual(kwargs['after'], (b'#project', 1521040166.5, 7))
+        self.assertEqual(kwargs['batch_size'], 2)
+
+    @defer.inlineCallbacks
+    def test_api_bans_export_refused_while_streams_busy(self):
+        dbpool = sp.FakeDatabaseRunner()
+        dbpool.stream_bans = sp.DeferredSequentialReturner([])
+        yield dbpool.streams.acquire()
+        yield self.startWebUI(dbpool)
+
+        res, content = yield self.get(b'/api/bans.ndjson')
+        self.assertEqual(res.code, 503)
+        self.assertEqual(res.headers.getRawHeaders(b'Retry-After'), [b'10'])
+        self.assertEqual(dbpool.stream_bans.calls, [])
+
     @defer.inlineCallbacks
     def test_edit_ban(self):
-        ban = (
+        ban = BanRow(
             b'#project', b'$a:baduser', b'b',
             dt('2018-03-14T15:09:26'), b'someop!foo',
             dt('2018-03-21T15:09:26'), b'bad behavior', None, b'',
         )
-        dbpool = sp.FakeObj()
+        dbpool = sp.FakeDatabaseRunner()
         dbpool.get_ban_with_auth = sp.DeferredSequentialReturner([ban])
         yield self.startWebUI(dbpool)
 
@@ -134,6 +500,7 @@ class WebUITestCase(TrialTestCase):
         )
         self.assertEqual(res.code, 200)
         self.assertIn(b'<form', content)
+        self.assertIn(b'value="2018-03-21 15:09:26', content)
         self.assertIn(b'#project', content)
         self.assertIn(b'$a:baduser', content)
         self.assertIn(b'bad behavior', content)
@@ -141,27 +508,33 @@ class WebUITestCase(TrialTestCase):
 
     @defer.inlineCallbacks
     def test_post_edit_ban(self):
-        ban = (
+        ban = BanRow(
             b'#project', b'$a:baduser', b'b',
             dt('2018-03-14T15:09:26'), b'someop!foo',
             dt('2018-03-21T15:09:26'), b'bad behavior', None, b'',
         )
-        dbpool = sp.FakeObj()
+        dbpool = sp.FakeDatabaseRunner()
         dbpool.get_ban_with_auth = sp.DeferredSequentialReturner([ban])
-        dbpool.update_ban_by_rowid = sp.DeferredSequentialReturner([None])
-        yield self.startWebUI(dbpool)
+        dbpool.update_ban_by_rowid = sp.DeferredSequentialReturner(
+            [[b'#project']])
+        banEvents = sp.FakeObj()
+        banEvents.publish = sp.SequentialReturner([None])
+        yield self.startWebUI(dbpool, banEvents=banEvents)
 
         res, content = yield self.post(
             b'/bans/edit/5/deadbeef',
             {b'expire_at': b'never', b'reason': b'they lost their chance'},
         )
+        self.assertEqual(banEvents.publish.calls, [sp.Call(
+            'edit', channel=b'#project', mask=b'$a:baduser', mode=b'b',
+            expire_at=None, reason=b'they lost their chance')])
         self.assertEqual(
             dbpool.get_ban_with_auth.calls,
             [sp.Call(b'5', b'deadbeef')],
         )
         self.assertEqual(
             dbpool.update_ban_by_rowid.calls,
-            [sp.Call(b'5', None, b'they lost their chance')],
+            [sp.Call(b'5', None, b'they lost their chance', [])],
         )
         self.assertEqual(res.code, 200)
         self.assertIn(b'<form', content)
@@ -171,14 +544,36 @@ class WebUITestCase(TrialTestCase):
         self.assertIn(b'they lost their chance', content)
         # TODO: Test that other expected bits appear.
 
+    @defer.inlineCallbacks
+    def test_post_edit_ban_publishes_changed_channels(self):
+        dbpool = sp.FakeDatabaseRunner()
+        dbpool.get_ban_with_auth = sp.DeferredSequentialReturner(
+            [BanRow(*ACTIVE_BAN)])
+        # #project's copy in #other was changed; the one in #third wasn't
+        # there, and the ban itself already had this reason.
+        dbpool.update_ban_by_rowid = sp.DeferredSequentialReturner(
+            [[b'#other']])
+        banEvents = sp.FakeObj()
+        banEvents.publish = sp.SequentialReturner([None])
+        yield self.startWebUI(dbpool, banEvents=banEvents, configStructure={
+            'channel_groups': {'g': ['#project', '#other', '#third']}})
+
+        yield self.post(b'/bans/edit/5/deadbeef', {b'reason': b'spam'})
+        self.assertEqual(
+            dbpool.update_ban_by_rowid.calls[0].args[3],
+            [u'#other', u'#third'])
+        self.assertEqual(banEvents.publish.calls, [sp.Call(
+            'edit', channel=b'#other', mask=b'$a:baduser', mode=b'b',
+            expire_at=ACTIVE_BAN[5], reason=b'spam')])
+
     @defer.inlineCallbacks
     def test_post_edit_ban_errors_sanely_on_bad_expiry(self):
-        ban = (
+        ban = BanRow(
             b'#project', b'$a:baduser', b'b',
             dt('2018-03-14T15:09:26'), b'someop!foo',
             dt('2018-03-21T15:09:26'), b'bad behavior', None, b'',
         )
-        dbpool = sp.FakeObj()
+        dbpool = sp.FakeDatabaseRunner()
         dbpool.get_ban_with_auth = sp.DeferredSequentialReturner([ban])
         dbpool.update_ban_by_rowid = sp.DeferredSequentialReturner([None])
         yield self.startWebUI(dbpool)
@@ -203,6 +598,182 @@ class WebUITestCase(TrialTestCase):
         # TODO: Test that other expected bits appear.
 
 
+class StreamTemplateTestCase(TrialTestCase):
+    def setUp(self):
+        loader = TemplateLoader(DEFAULT_TEMPLATES_DIR)
+        self.tmpl = loader.load('bans.html')
+        bans = [
+            (
+                b'#project', b'$a:user%d' % (i,), b'b',
+                dt('2018-03-14T15:09:26'), b'someop!foo',
+                dt('2018-03-21T15:09:26'), b'bad behavior', None, b'',
+            )
+            for i in range(50)
+        ]
+        self.kwargs = dict(
+            show_unset=True, show_recent_expiration=False, next_url=None)
+        self.bans = [
+            (channel, list(rows)) for channel, rows in presentBans(bans)]
+
+    def test_streamed_matches_rendered(self):
+        rendered = sp.ProducerRequest()
+        renderTemplate(rendered, self.tmpl, bans=self.bans, **self.kwargs)
+
+        streamed = sp.ProducerRequest()
+        d = streamTemplate(
+            streamed, self.tmpl, chunkSize=512, bans=self.bans, **self.kwargs)
+
+        def check(complete):
+            self.assertIs(complete, True)
+            self.assertEqual(streamed.finished, 1)
+            self.assertIs(streamed.producer, None)
+            self.assertTrue(len(streamed.written) > 1)
+            self.assertEqual(b''.join(streamed.written), rendered.written[0])
+            self.assertIn(b'+b $a:user49</td>', rendered.written[0])
+        return d.addCallback(check)
+
+    def test_paused_while_client_is_slow(self):
+        request = sp.ProducerRequest()
+        d = streamTemplate(
+            request, self.tmpl, chunkSize=512, bans=self.bans, **self.kwargs)
+        request.producer.pauseProducing()
+        written = len(request.written)
+        paused = defer.Deferred()
+        reactor.callLater(0.05, paused.callback, None)
+
+        def check(ignored):
+            self.assertEqual(len(request.written), written)
+            self.assertEqual(request.finished, 0)
+            request.producer.resumeProducing()
+            return d
+        paused.addCallback(check)
+        paused.addCallback(lambda ign: self.assertEqual(request.finished, 1))
+        return paused
+
+    def test_client_gone_before_streaming(self):
+        request = sp.ProducerRequest()
+        # As a transport that's already disconnected does.
+        request.registerProducer = (
+            lambda producer, streaming: producer.stopProducing())
+        d = streamTemplate(
+            request, self.tmpl, chunkSize=512, bans=self.bans, **self.kwargs)
+        self.assertIs(self.successResultOf(d), False)
+        self.assertEqual(request.written, [])
+        self.assertEqual(request.finished, 0)
+
+
+class DisconnectingRequest(sp.ProducerRequest):
+    """
+    A request whose client goes away after the first chunk is written.
+    """
+    code = 200
+
+    def write(self, data):
+        sp.ProducerRequest.write(self, data)
+        self.producer.stopProducing()
+
+
+class CachedStreamTestCase(TrialTestCase):
+    def test_page_cut_short_not_cached(self):
+        conf = sp.makeConfig({'web': {'stream_templates': True}})
+        conf.lagMonitor = None
+        dbpool = sp.FakeDatabaseRunner()
+        dbpool.get_bans_page = sp.DeferredSequentialReturner([
+            ([ACTIVE_BAN[:1] + (b'$a:user%d' % (i,),) + ACTIVE_BAN[2:]
+              for i in range(500)], None),
+        ])
+        webui = InfobobWebUI(
+            TemplateLoader(DEFAULT_TEMPLATES_DIR), dbpool, conf)
+        request = DisconnectingRequest()
+        request.uri = b'/bans'
+        d = webui.renderBanList(
+            request, 'active', show_unset=False,
+            show_recent_expiration=False)
+
+        def check(ignored):
+            self.assertEqual(len(request.written), 1)
+            self.assertEqual(request.finished, 0)
+            self.assertIs(webui.cache.get(b'/bans', 0), None)
+        return d.addCallback(check)
+
+
+class PageProducerTestCase(TrialTestCase):
+    def test_paused_client_times_out(self):
+        clock = task.Clock()
+        request = sp.ProducerRequest()
+        producer = _PageProducer(request, timeout=30, clock=clock)
+        self.assertIs(request.producer, producer)
+        producer.pauseProducing()
+        resumed = producer.whenResumed()
+        clock.advance(29)
+        self.assertNoResult(resumed)
+        producer.resumeProducing()
+        self.successResultOf(resumed)
+        # The timeout counts from the latest pause.
+        producer.pauseProducing()
+        resumed = producer.whenResumed()
+        clock.advance(29)
+        self.assertNoResult(resumed)
+        clock.advance(1)
+        self.successResultOf(resumed)
+        self.assertTrue(producer.stopped)
+        self.assertTrue(producer.timedOut)
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+
+class PresentBansTestCase(TrialTestCase):
+    def test_rows_are_escaped(self):
+        bans = [
+            (
+                b'#project', b'<b>!*@*', b'b',
+                dt('2018-03-14T15:09:26'), b'someop!foo',
+                None, b'caf\xc3\xa9 & <stuff>', None, None,
+            ),
+        ]
+        [(channel, rows)] = presentBans(bans, show_unset=True)
+        [row] = list(rows)
+        self.assertEqual(channel, b'#project')
+        self.assertEqual(row, PresentedBan(
+            channel=u'#project', set_by=u'someop', what=u'+b <b>!*@*',
+            set_at='Wednesday, 14 March 2018 at 15:09 PM %s' % (
+                time.strftime('%Z', time.localtime(bans[0][3])),),
+            expire_at=None, reason=u'caf\xe9 & <stuff>', unset_by=None,
+            unset_at=None))
+
+        tmpl = TemplateLoader(DEFAULT_TEMPLATES_DIR).load('bans.html')
+        content = tmpl.generate(
+            bans=presentBans(bans), show_unset=True,
+            show_recent_expiration=False, next_url=None,
+        ).render('html', doctype='html5', encoding='utf-8')
+        for expected in [
+                b'<td class="tt">+b &lt;b&gt;!*@*</td>',
+                b'<td class="center">never</td>',
+                b'<td class="reason">caf\xc3\xa9 &amp; &lt;stuff&gt;</td>',
+                b'<td colspan="2" class="center">not ever</td>']:
+            self.assertIn(expected, content)
+
+
+class TemplateLoadingTestCase(TrialTestCase):
+    def makeWebUI(self, auto_reload):
+        self.loader = TemplateLoader(
+            DEFAULT_TEMPLATES_DIR, auto_reload=auto_reload)
+        return InfobobWebUI(self.loader, None, sp.makeConfig({}))
+
+    def test_precompiled_without_auto_reload(self):
+        webui = self.makeWebUI(auto_reload=False)
+        self.loader.load = None
+        tmpl = webui.template('bans.html')
+        self.assertIs(webui.template('bans.html'), tmpl)
+        self.assertIn('edit_ban.html', webui._templates)
+
+    def test_loaded_per_request_with_auto_reload(self):
+        webui = self.makeWebUI(auto_reload=True)
+        self.assertIs(webui._templates, None)
+        self.loader.load = sp.SequentialReturner(['loaded'])
+        self.assertEqual(webui.template('bans.html'), 'loaded')
+        self.assertEqual(self.loader.load.calls, [sp.Call('bans.html')])
+
+
 @implementer(IBodyProducer)
 class XWWWFormUrlencodedProducer(object):
     def __init__(self, mapping):
@@ -221,4 +792,16 @@ class XWWWFormUrlencodedProducer(object):
 
 
 def dt(isoformatted):
-    return datetime.datetime.strptime(isoformatted, '%Y-%m-%dT%H:%M:%S')
+    return time.mktime(time.strptime(isoformatted, '%Y-%m-%dT%H:%M:%S'))
+
+
+ACTIVE_BAN = (
+    b'#project', b'$a:baduser', b'b',
+    dt('2018-03-14T15:09:26'), b'someop!foo',
+    dt('2018-03-21T15:09:26'), b'bad behavior', None, b'',
+)
+
+RAW_BAN = (
+    b'#project', b'$a:baduser', b'b', 1521040166.5, b'someop!foo', None,
+    b'bad \xff', None, None,
+)
@@ -1,12 +1,14 @@
 import json
 import io
 
-from twisted.internet import defer
+from twisted.internet import defer, error, task
 from twisted.trial.unittest import TestCase as TrialTestCase
 from twisted.test.proto_helpers import StringTransport
 
-from infobob.irc import Infobob
+from infobob.irc import ChannelSnapshots, Infobob, InfobobFactory
 from infobob.config import InfobobConfig
+from infobob.lag import RoundTripTracker
+import infobob.tests.support as sp
 
 
 
@@ -16,11 +18,11 @@ class InfobobProtocolTestCase(TrialTestCase):
         self.factory = FakeInfobobFactory()
         self.transport = StringTransport()
 
-    def initProto(self, configStructure, stubTimer=True):
+    def initProto(self, configStructure, stubTimer=True, snapshots=None):
         conf = InfobobConfig()
         conf.load(io.BytesIO(json.dumps(configStructure)))
         conf.dbpool = None
-        self.proto = Infobob(conf)
+        self.proto = Infobob(conf, snapshots=snapshots)
         self.proto.factory = self.factory
         self.proto.makeConnection(self.transport)
         if stubTimer:
@@ -58,7 +60,7 @@ class InfobobProtocolTestCase(TrialTestCase):
             b'testnick',
             b'You are now identified as "testnick"',
         )
-        self.assertWritten(b'JOIN #project\r\nJOIN ##offtopic\r\n')
+        self.assertWritten(b'JOIN #project,##offtopic\r\n')
         self.assertIs(p.identified, True)
 
     def test_autojoin_no_nickserv_pw(self):
@@ -76,9 +78,640 @@ class InfobobProtocolTestCase(TrialTestCase):
         self.clearWritten()
 
         p.signedOn()
-        self.assertWritten(b'JOIN #project\r\nJOIN ##offtopic\r\n')
+        self.assertWritten(b'JOIN #project,##offtopic\r\n')
         self.assertIs(p.identified, False)
 
+    def test_autojoin_batches_by_targmax(self):
+        self.initProto({
+            'irc': {
+                'nickname': 'testnick',
+                'nickserv_pw': None,
+                'autojoin': ['#a', '#b', '#c', '#keyed'],
+            },
+            'channels': {'#keyed': {'key': 'sekrit'}},
+        })
+        p = self.proto
+        p.connectionMade()
+        p.irc_RPL_ISUPPORT(b'irc.example.net', [
+            b'testnick', b'TARGMAX=JOIN:2,PRIVMSG:4', b'are supported',
+        ])
+        self.clearWritten()
+
+        p.signedOn()
+        self.assertWritten(b'JOIN #keyed,#a sekrit\r\nJOIN #b,#c\r\n')
+
+    def test_config_reload_joins_and_parts_changes(self):
+        self.initProto({
+            'irc': {
+                'nickname': 'testnick',
+                'nickserv_pw': None,
+                'autojoin': ['#a', '#b'],
+            },
+        })
+        p = self.proto
+        p.connectionMade()
+        old = p._conf.reload(io.BytesIO(json.dumps({
+            'irc': {
+                'nickname': 'testnick',
+                'nickserv_pw': None,
+                'autojoin': ['#b', '#c', '#d'],
+            },
+            'channels': {'#d': {'key': 'sekrit'}},
+        })))
+        self.clearWritten()
+        # Before autojoining, the new list will be used when it happens.
+        p.configReloaded(old)
+        self.assertWritten(b'')
+        p.signedOn()
+        self.assertWritten(b'JOIN #d,#b,#c sekrit\r\n')
+
+        old = p._conf.reload(io.BytesIO(json.dumps({
+            'irc': {'nickname': 'testnick', 'autojoin': ['#e', '#b']},
+        })))
+        p.configReloaded(old)
+        self.assertWritten(b'JOIN #e\r\nPART #c\r\nPART #d\r\n')
+
+    def test_parted_channel_state_forgotten(self):
+        self.initProto({'irc': {'nickname': 'testnick', 'autojoin': []}},
+                       snapshots=ChannelSnapshots())
+        p = self.proto
+        p.dbpool = sp.FakeObj()
+        p.dbpool.set_users_in_channel = sp.DeferredSequentialReturner([None])
+        p.connectionMade()
+        p.channel_members[b'#a'][b'nick'] = b'user@host'
+        p.channel_members[b'#b'][b'nick'] = b'user@host'
+        p.snapshots.filled.update([b'#a', b'#b'])
+        p.snapshots.banlists[(b'#a', b'b')] = set([b'x!*@*'])
+        p.snapshots.banlists[(b'#a', b'q')] = set([b'y!*@*'])
+        p.channelSyncState[b'#a'] = 'syncing'
+        p.channel_collation[b'#a'][b'nick'] = b'user@host'
+        waiter = p.channelSynced(b'#a')
+
+        p.irc_PART(b'testnick!bot@host', [b'#a'])
+        self.assertEqual(dict(p.channel_members),
+                         {b'#b': {b'nick': b'user@host'}})
+        self.assertEqual(p.snapshots.filled, set([b'#b']))
+        self.assertEqual(p.snapshots.banlists, {})
+        self.assertEqual(p.channelSyncState, {})
+        self.assertEqual(dict(p.channel_collation), {})
+        self.failureResultOf(waiter, error.ConnectionLost)
+        self.assertEqual(p.dbpool.set_users_in_channel.calls,
+                         [sp.Call({}, b'#a')])
+
+    def test_commands_dispatched_by_channel_policy(self):
+        self.initProto({
+            'irc': {'nickname': 'test[bot]', 'autojoin': []},
+            'channels': {
+                'defaults': {'commands': [['allow', 'all']]},
+                '#strict': {'commands': [['deny', 'all']]},
+            },
+        })
+        p = self.proto
+        p._shedding = lambda feature: True
+        calls = []
+        p.infobob_ping = lambda target, channel, *args: calls.append(
+            (target, channel.name, args))
+
+        p.privmsg(b'user!u@host', b'#a', b'  test[bot]: ping one two!')
+        p.privmsg(b'user!u@host', b'#a', b'testxbot]: ping')
+        p.privmsg(b'user!u@host', b'#a', b'sss test[bot]: ping')
+        p.privmsg(b'user!u@host', b'#strict', b'test[bot], ping')
+        p.privmsg(b'user!u@host', b'#a', b'test[bot]: pong')
+        self.assertEqual(calls, [(b'#a', '#a', (b'one', b'two'))])
+
+        del calls[:]
+        p.irc_NICK(b'test[bot]!u@host', [b'newnick'])
+        p.privmsg(b'user!u@host', b'#a', b'test[bot]: ping')
+        p.privmsg(b'user!u@host', b'#a', b'NewNick> ping')
+        self.assertEqual(calls, [(b'#a', '#a', ())])
+
+    def test_channel_policy_rebuilt_on_reload(self):
+        self.initProto({
+            'irc': {'nickname': 'testnick', 'autojoin': []},
+            'channels': {'defaults': {'commands': [['allow', 'all']]}},
+        })
+        p = self.proto
+        p._shedding = lambda feature: True
+        calls = []
+        p.infobob_ping = lambda target, channel: calls.append(target)
+        p.privmsg(b'user!u@host', b'#a', b'testnick: ping')
+        old = p._conf.reload(io.BytesIO(json.dumps({
+            'irc': {'nickname': 'testnick', 'autojoin': []},
+            'channels': {'#a': {'commands': [['deny', 'ping']]}},
+        })))
+        p.configReloaded(old)
+        p.privmsg(b'user!u@host', b'#a', b'testnick: ping')
+        self.assertEqual(calls, [b'#a'])
+
+    def test_channel_sync_is_paced(self):
+        self.initProto({
+            'irc': {
+                'nickname': 'testnick',
+                'autojoin': [],
+                'sync': {'interval': 2},
+            },
+            'channels': {'#b': {'have_ops': True}},
+        })
+        clock = task.Clock()
+        p = self.proto
+        p.clock = clock
+        p.dbpool = sp.FakeObj()
+        p.dbpool.set_users_in_channel = sp.DeferredSequentialReturner(
+            [None, None])
+        p.connectionMade()
+        self.clearWritten()
+
+        p.joined(b'#a')
+        p.joined(b'#b')
+        self.assertWritten(b'WHO #a\r\n')
+        self.assertEqual(
+            p.channelSyncState, {b'#a': 'syncing', b'#b': 'queued'})
+        synced_a, synced_b = p.channelSynced(b'#a'), p.channelSynced(b'#b')
+
+        p.irc_RPL_WHOREPLY(b'irc.example.net', [
+            b'testnick', b'#a', b'user', b'host', b'irc.example.net',
+            b'somenick', b'H', b'0 Real Name',
+        ])
+        p.irc_RPL_ENDOFWHO(b'irc.example.net', [
+            b'testnick', b'#a', b'End of /WHO list.'])
+        self.assertEqual(
+            p.dbpool.set_users_in_channel.calls,
+            [sp.Call({b'somenick': b'user@host'}, b'#a')])
+        self.successResultOf(synced_a)
+        self.assertNoResult(synced_b)
+        self.assertWritten(b'')
+
+        clock.advance(2)
+        self.assertWritten(b'WHO #b\r\nMODE #b +b\r\nMODE #b +q\r\n')
+        p.irc_RPL_WHOREPLY(b'irc.example.net', [
+            b'testnick', b'#b', b'bot', b'host', b'irc.example.net',
+            b'testnick', b'H', b'0 Real Name',
+        ])
+        p.irc_RPL_ENDOFWHO(b'irc.example.net', [
+            b'testnick', b'#b', b'End of /WHO list.'])
+        self.successResultOf(synced_b)
+        self.assertEqual(
+            p.channelSyncState, {b'#a': 'synced', b'#b': 'synced'})
+        clock.advance(2)
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    def test_end_of_who_without_replies_ignored(self):
+        self.initProto({'irc': {'nickname': 'testnick', 'autojoin': []}})
+        p = self.proto
+        p.clock = task.Clock()
+        p.dbpool = sp.FakeObj()
+        p.dbpool.set_users_in_channel = sp.DeferredSequentialReturner([])
+        p.connectionMade()
+
+        p.joined(b'#a')
+        synced = p.channelSynced(b'#a')
+        p.irc_RPL_ENDOFWHO(b'irc.example.net', [
+            b'testnick', b'#a', b'End of /WHO list.'])
+        self.assertEqual(p.dbpool.set_users_in_channel.calls, [])
+        self.assertNoResult(synced)
+        self.assertEqual(p.channelSyncState, {b'#a': 'syncing'})
+
+    def test_sync_waiters_fail_on_connection_lost(self):
+        self.initProto({
+            'irc': {'nickname': 'testnick', 'autojoin': []},
+            'channels': {'#a': {'have_ops': True}},
+        })
+        p = self.proto
+        p.clock = task.Clock()
+        p.dbpool = sp.FakeObj()
+        p.dbpool.add_ban = sp.DeferredSequentialReturner([])
+        p.connectionMade()
+
+        p.joined(b'#a')
+        synced = p.channelSynced(b'#a')
+        updated = p.updateBan(b'op!op@host', b'#a', True, b'b', b'bad!*@*')
+        p.connectionLost(None)
+        self.failureResultOf(synced, error.ConnectionLost)
+        self.successResultOf(updated)
+        self.assertEqual(p.dbpool.add_ban.calls, [])
+        self.assertEqual(p._syncWaiters, {})
+
+    def test_resync_writes_only_differences(self):
+        self.initProto({'irc': {'nickname': 'testnick', 'autojoin': []}})
+        p = self.proto
+        p.dbpool = sp.FakeObj()
+        p.dbpool.set_users_in_channel = sp.DeferredSequentialReturner([None])
+        p.dbpool.sync_users_in_channel = sp.DeferredSequentialReturner(
+            [None])
+        self.successResultOf(p.fillChannel(
+            {b'a': b'a@host', b'b': b'b@host', b'c': b'c@host'}, b'#a'))
+        self.assertEqual(len(p.dbpool.set_users_in_channel.calls), 1)
+
+        # Reconnected: a new connection, with the factory's snapshots.
+        self.initProto({'irc': {'nickname': 'testnick', 'autojoin': []}},
+                       snapshots=p.snapshots)
+        self.proto.dbpool, p = p.dbpool, self.proto
+        self.successResultOf(p.fillChannel(
+            {b'a': b'a@host', b'b': b'b@elsewhere', b'd': b'd@host'}, b'#a'))
+        self.assertEqual(
+            p.dbpool.sync_users_in_channel.calls,
+            [sp.Call(b'#a', {b'b': b'b@elsewhere', b'd': b'd@host'},
+                     [b'c'])])
+        self.assertEqual(
+            p.channel_members[b'#a'],
+            {b'a': b'a@host', b'b': b'b@elsewhere', b'd': b'd@host'})
+
+        # Nothing changed, so nothing is written.
+        self.successResultOf(p.fillChannel(dict(p.channel_members[b'#a']),
+                                           b'#a'))
+        self.assertEqual(len(p.dbpool.sync_users_in_channel.calls), 1)
+
+    def test_failed_fill_is_rewritten_in_full(self):
+        self.initProto({'irc': {'nickname': 'testnick', 'autojoin': []}})
+        p = self.proto
+        p.dbpool = sp.FakeObj()
+        p.dbpool.set_users_in_channel = lambda users, channel: defer.fail(
+            ValueError())
+        self.failureResultOf(
+            p.fillChannel({b'a': b'a@host'}, b'#a'), ValueError)
+        self.assertNotIn(b'#a', p.snapshots.filled)
+
+    def test_banlist_resync_stores_new_masks(self):
+        self.initProto({
+            'irc': {'nickname': 'testnick', 'autojoin': []},
+            'channels': {'#a': {'have_ops': True}},
+        })
+        p = self.proto
+        p.dbpool = sp.FakeObj()
+        p.dbpool.ensure_active_bans = sp.DeferredSequentialReturner(
+            [None, None])
+        p.dbpool.remove_ban = sp.DeferredSequentialReturner([[]])
+
+        def banlist(*masks):
+            for mask in masks:
+                p.irc_RPL_BANLIST(b'irc.example.net', [
+                    b'testnick', b'#a', mask, b'op!op@host', b'100'])
+            p.irc_RPL_ENDOFBANLIST(b'irc.example.net', [
+                b'testnick', b'#a', b'End of Channel Ban List'])
+
+        banlist(b'a!*@*', b'b!*@*')
+        banlist(b'a!*@*', b'b!*@*')
+        p.updateBan(b'op!op@host', b'#a', False, b'b', b'b!*@*')
+        banlist(b'a!*@*', b'b!*@*', b'c!*@*')
+        self.assertEqual(p.dbpool.ensure_active_bans.calls, [
+            sp.Call(b'#a', 'b', [(b'a!*@*', b'op!op@host', b'100'),
+                                 (b'b!*@*', b'op!op@host', b'100')]),
+            sp.Call(b'#a', 'b', [(b'b!*@*', b'op!op@host', b'100'),
+                                 (b'c!*@*', b'op!op@host', b'100')]),
+        ])
+
+    def test_lol_escalates_to_kick(self):
+        self.initProto({
+            'irc': {'nickname': 'testnick', 'autojoin': []},
+            'channels': {'#a': {'have_ops': True, 'lol_kick_after': 2}},
+        })
+        p = self.proto
+        p.lols = sp.FakeObj()
+        p.lols.record = sp.SequentialReturner([1, 2])
+        p._op_deferreds[b'#a'] = defer.succeed(None)
+        p.connectionMade()
+        self.clearWritten()
+
+        _ = lambda message: message
+        p.do_lol(b'someone', b'#a', _)
+        self.assertWritten(
+            b'PRIVMSG someone :#a is a no-LOL zone.\r\n')
+        p.do_lol(b'someone', b'#a', _)
+        self.assertWritten(
+            b'KICK #a someone :#a is a no-LOL zone.\r\n')
+        self.assertEqual(p.lols.record.calls,
+                         [sp.Call(b'someone'), sp.Call(b'someone')])
+
+    def test_ban_check_only_holds_its_own_channel(self):
+        self.initProto({
+            'irc': {'nickname': 'testnick', 'autojoin': []},
+            'channels': {'#a': {'have_ops': True}},
+        })
+        p = self.proto
+        p.dbpool = sp.FakeObj()
+        checking = defer.Deferred()
+        p.dbpool.add_ban = sp.DeferredSequentialReturner([1])
+        p.dbpool.check_mask = lambda channel, mask: checking
+        p.dbpool.add_user_to_channel = sp.DeferredSequentialReturner(
+            [None, None])
+        p.connectionMade()
+
+        p.updateBan(b'op!op@host', b'#a', True, b'b', b'bad!*@*')
+        p.userJoined(b'someone!user@host', b'#b')
+        self.assertEqual(
+            p.dbpool.add_user_to_channel.calls,
+            [sp.Call(b'someone', b'user@host', b'#b')])
+
+        p.userJoined(b'other!user@host', b'#a')
+        self.assertEqual(len(p.dbpool.add_user_to_channel.calls), 1)
+        checking.callback([b'bad'])
+        self.assertEqual(
+            p.dbpool.add_user_to_channel.calls[1],
+            sp.Call(b'other', b'user@host', b'#a'))
+        self.assertEqual(
+            p.channel_members,
+            {b'#a': {b'other': b'user@host'},
+             b'#b': {b'someone': b'user@host'}})
+
+    def test_ban_changes_published(self):
+        self.initProto({
+            'irc': {'nickname': 'testnick', 'autojoin': []},
+            'web': {'url': 'http://infobob.example/'},
+            'channels': {'#a': {'have_ops': True}},
+        })
+        p = self.proto
+        p.banEvents = sp.FakeObj()
+        p.banEvents.publish = sp.SequentialReturner([None] * 3)
+        p.dbpool = sp.FakeObj()
+        p.dbpool.add_ban = sp.DeferredSequentialReturner([1])
+        p.dbpool.add_ban_auth = sp.DeferredSequentialReturner([b'auth'])
+        p.dbpool.remove_ban = sp.DeferredSequentialReturner([[], []])
+        p.dbpool.get_expired_bans = sp.DeferredSequentialReturner(
+            [[(b'#a', b'$a:old', b'q')]])
+        p._op_deferreds[b'#a'] = defer.succeed(None)
+        p.connectionMade()
+
+        p.updateBan(b'op!op@host', b'#a', True, b'b', b'$a:bad')
+        p.updateBan(b'op!op@host', b'#a', False, b'b', b'$a:bad')
+        p._expireBans()
+        self.assertEqual(len(p.banEvents.publish.calls), 2)
+        # Published once, when the server echoes our unset.
+        p.updateBan(b'testnick!bot@host', b'#a', False, b'q', b'$a:old')
+        self.assertEqual(p.banEvents.publish.calls, [
+            sp.Call('add', channel=b'#a', mask=b'$a:bad', mode=b'b',
+                    by=b'op!op@host'),
+            sp.Call('unset', channel=b'#a', mask=b'$a:bad', mode=b'b',
+                    by=b'op!op@host'),
+            sp.Call('expire', channel=b'#a', mask=b'$a:old', mode=b'q'),
+        ])
+
+    def test_account_mask_conversion_published(self):
+        self.initProto({
+            'irc': {'nickname': 'testnick', 'autojoin': []},
+            'web': {'url': 'http://infobob.example/'},
+            'channels': {'#a': {'have_ops': True}},
+        })
+        p = self.proto
+        p.banEvents = sp.FakeObj()
+        p.banEvents.publish = sp.SequentialReturner([None] * 2)
+        p.dbpool = sp.FakeObj()
+        p.dbpool.add_ban = sp.DeferredSequentialReturner([1, 2])
+        p.dbpool.check_mask = sp.DeferredSequentialReturner([[b'victim']])
+        p.dbpool.add_ban_auth = sp.DeferredSequentialReturner([b'auth'])
+        p.whois = lambda nick: defer.succeed(
+            {'nick': nick, 'accountname': b'acct'})
+        p.waitForPrivmsgFrom = lambda nick: defer.succeed(
+            (defer.succeed(u'yes'),))
+        p._op_deferreds[b'#a'] = defer.succeed(None)
+        p.connectionMade()
+
+        self.successResultOf(
+            p.updateBan(b'op!op@host', b'#a', True, b'b', b'victim!*@*'))
+        self.assertEqual(p.banEvents.publish.calls, [
+            sp.Call('add', channel=b'#a', mask=b'victim!*@*', mode=b'b',
+                    by=b'op!op@host'),
+            sp.Call('add', channel=b'#a', mask=b'$a:acct', mode=b'b',
+                    by=b'op!op@host'),
+        ])
+        self.assertEqual(p.dbpool.add_ban_auth.calls, [sp.Call(2)])
+
+    def test_set_modes_batched_by_isupport(self):
+        self.initProto({'irc': {'nickname': 'testnick', 'autojoin': []}})
+        p = self.proto
+        p.connectionMade()
+        p.supported.parse([b'MODES=2'])
+        self.clearWritten()
+        p.setModes(b'#a', [(True, b'b', b'x!*@*'), (False, b'q', b'y!*@*'),
+                           (False, b'b', b'z!*@*')])
+        self.assertWritten(
+            b'MODE #a +b-q x!*@* y!*@*\r\n'
+            b'MODE #a -b z!*@*\r\n')
+
+    def initGroupProto(self):
+        self.initProto({
+            'irc': {'nickname': 'testnick', 'autojoin': [], 'ops_timeout': 30},
+            'web': {'url': 'http://infobob.example/'},
+            'channels': {
+                '#a': {'have_ops': True},
+                '#b': {'have_ops': True},
+                '#c': {'have_ops': True},
+                '#d': {'have_ops': True},
+                u'#caf\xe9': {'have_ops': True},
+                '#noops': {},
+            },
+            'channel_groups': {
+                'g': ['#a', '#b', '#c', '#noops'],
+                'h': ['#d', u'#caf\xe9'],
+            },
+        }, snapshots=ChannelSnapshots())
+        p = self.proto
+        p.clock = task.Clock()
+        p.dbpool = sp.FakeObj()
+        p.dbpool.add_ban_auth = sp.DeferredSequentialReturner(
+            [b'auth', b'auth'])
+        p.dbpool.add_ban_copy = sp.DeferredSequentialReturner([10, 11, 12])
+        p.connectionMade()
+        self.clearWritten()
+        return p
+
+    def test_ban_propagated_to_channel_group(self):
+        p = self.initGroupProto()
+        p.snapshots.banlists[(b'#c', b'b')] = set([b'$a:second'])
+        p.dbpool.add_ban = sp.DeferredSequentialReturner([1, 2])
+        for channel in [b'#a', b'#b', b'#c']:
+            p._op_deferreds[channel] = defer.succeed(None)
+
+        p.modeChanged(b'op!op@host', b'#a', True, b'bb',
+                      (b'$a:first', b'$a:second'))
+        self.assertEqual(p.dbpool.add_ban.calls, [
+            sp.Call(b'#a', b'op!op@host', b'$a:first', b'b'),
+            sp.Call(b'#a', b'op!op@host', b'$a:second', b'b'),
+        ])
+        self.clearWritten()
+        p.clock.advance(0)
+        self.assertWritten(
+            b'MODE #b +bb $a:first $a:second\r\n'
+            b'MODE #c +b $a:first\r\n')
+        # Nothing is stored for the copies until the server echoes them.
+        self.assertEqual(p.dbpool.add_ban_copy.calls, [])
+
+        p.modeChanged(b'testnick!bot@host', b'#b', True, b'bb',
+                      (b'$a:first', b'$a:second'))
+        p.modeChanged(b'testnick!bot@host', b'#c', True, b'b', (b'$a:first',))
+        self.assertEqual(p.dbpool.add_ban_copy.calls, [
+            sp.Call(1, b'#b'), sp.Call(2, b'#b'), sp.Call(1, b'#c')])
+        self.assertEqual(p._propagating, {})
+
+    def test_ban_propagation_dropped_without_ops(self):
+        p = self.initGroupProto()
+        p.dbpool.add_ban = sp.DeferredSequentialReturner([1, 2])
+        p._op_deferreds[b'#b'] = defer.succeed(None)
+
+        p.modeChanged(b'op!op@host', b'#a', True, b'b', (b'$a:first',))
+        self.assertTrue(
+            self.transport.value().startswith(b'PRIVMSG ChanServ :op #c\r\n'))
+        self.clearWritten()
+        p.clock.advance(30)
+        self.assertWritten(b'MODE #b +b $a:first\r\n')
+        self.assertEqual(p._pendingModes, {})
+        self.assertEqual(list(p._propagating), [(b'#b', b'b', b'$a:first')])
+        # An unasked-for echo in #c (from ops arriving late, say) isn't
+        # taken as a copy.
+        p.modeChanged(b'testnick!bot@host', b'#c', True, b'b', (b'$a:first',))
+        self.assertEqual(p.dbpool.add_ban_copy.calls, [])
+
+        p.modeChanged(b'op!op@host', b'#a', True, b'b', (b'$a:second',))
+        p.connectionLost(None)
+        self.assertEqual(p._pendingModes, {})
+        self.assertEqual(p._propagating, {})
+        self.assertEqual(p.clock.getDelayedCalls(), [])
+
+    def test_ban_propagated_to_non_ascii_channel(self):
+        p = self.initGroupProto()
+        p.dbpool.add_ban = sp.DeferredSequentialReturner([1])
+        p._op_deferreds[b'#caf\xc3\xa9'] = defer.succeed(None)
+        p.modeChanged(b'op!op@host', b'#d', True, b'b', (b'$a:first',))
+        self.clearWritten()
+        p.clock.advance(0)
+        self.assertWritten(b'MODE #caf\xc3\xa9 +b $a:first\r\n')
+        self.assertEqual(
+            list(p._propagating), [(b'#caf\xc3\xa9', b'b', b'$a:first')])
+
+    def test_ban_propagation_echo_casefolded(self):
+        p = self.initGroupProto()
+        p.dbpool.add_ban = sp.DeferredSequentialReturner([1, 2])
+        p._op_deferreds[b'#b'] = p._op_deferreds[b'#c'] = defer.succeed(None)
+        p.modeChanged(b'op!op@host', b'#a', True, b'b', (b'$a:first',))
+        p.clock.advance(0)
+        # The server echoes the channel under its own spelling.
+        p.modeChanged(b'testnick!bot@host', b'#B', True, b'b', (b'$a:first',))
+        self.assertEqual(p.dbpool.add_ban_copy.calls, [sp.Call(1, b'#B')])
+        self.assertEqual(list(p._propagating), [(b'#c', b'b', b'$a:first')])
+
+    def test_propagation_key_follows_casemapping(self):
+        p = self.initGroupProto()
+        self.assertEqual(p._propagationKey(b'#A[~]', b'b', b'X!*@*'),
+                         (b'#a{^}', b'b', b'X!*@*'))
+        p.supported.parse([b'CASEMAPPING=strict-rfc1459'])
+        self.assertEqual(p._propagationKey(b'#A[~]', b'b', b'X!*@*'),
+                         (b'#a{~}', b'b', b'X!*@*'))
+        p.supported.parse([b'CASEMAPPING=ascii'])
+        self.assertEqual(p._propagationKey(b'#A[~]', b'b', b'X!*@*'),
+                         (b'#a[~]', b'b', b'X!*@*'))
+
+    def test_unechoed_ban_propagation_expires(self):
+        p = self.initGroupProto()
+        p.dbpool.add_ban = sp.DeferredSequentialReturner([1, 2])
+        p._op_deferreds[b'#b'] = p._op_deferreds[b'#c'] = defer.succeed(None)
+        p.modeChanged(b'op!op@host', b'#a', True, b'b', (b'$a:first',))
+        p.clock.advance(0)
+        # The server doesn't echo a ban that's already set in #b and #c, so
+        # the entries waiting on the echoes are given up on later.
+        p.clock.advance(30)
+        p.modeChanged(b'op!op@host', b'#a', True, b'b', (b'$a:second',))
+        self.assertEqual(sorted(p._propagating), [
+            (b'#b', b'b', b'$a:second'), (b'#c', b'b', b'$a:second')])
+
+    def test_mask_conversion_propagated_to_channel_group(self):
+        p = self.initGroupProto()
+        p.snapshots.banlists[(b'#b', b'b')] = set([b'victim!*@*'])
+        p.dbpool.add_ban = sp.DeferredSequentialReturner([1, 2])
+        p.dbpool.check_mask = sp.DeferredSequentialReturner([[b'victim']])
+        p.whois = lambda nick: defer.succeed(
+            {'nick': nick, 'accountname': b'acct'})
+        p.waitForPrivmsgFrom = lambda nick: defer.succeed(
+            (defer.succeed(u'yes'),))
+        for channel in [b'#a', b'#b', b'#c']:
+            p._op_deferreds[channel] = defer.succeed(None)
+
+        self.successResultOf(
+            p.updateBan(b'op!op@host', b'#a', True, b'b', b'victim!*@*'))
+        self.clearWritten()
+        p.clock.advance(0)
+        self.assertWritten(
+            b'MODE #c +b $a:acct\r\n'
+            b'MODE #b +b-b $a:acct victim!*@*\r\n')
+        self.assertEqual(sorted(p._propagating), [
+            (b'#b', b'b', b'$a:acct'), (b'#c', b'b', b'$a:acct')])
+        p.modeChanged(b'testnick!bot@host', b'#c', True, b'b', (b'$a:acct',))
+        self.assertEqual(p.dbpool.add_ban_copy.calls, [sp.Call(2, b'#c')])
+
+    def test_server_ping_measures_round_trip(self):
+        self.initProto({
+            'irc': {
+                'nickname': 'testnick',
+                'autojoin': [],
+                'ping': {'min_timeout': 10},
+            },
+        })
+        clock = task.Clock()
+        p = self.proto
+        p.serverLag = RoundTripTracker(clock=clock)
+        p.connectionMade()
+        self.clearWritten()
+
+        p._serverPing()
+        self.assertWritten(b'PING infobob-0\r\n')
+        clock.advance(0.5)
+        p.irc_PONG(b'irc.example.net', [b'irc.example.net', b'infobob-0'])
+        self.assertEqual(list(p.serverLag.recent), [0.5])
+
+        # The last PING was answered, so the next one goes out; while that
+        # one is outstanding, no other is sent.
+        p._serverPing()
+        self.assertWritten(b'PING infobob-1\r\n')
+        clock.advance(5)
+        p._serverPing()
+        self.assertWritten(b'')
+        self.assertFalse(self.transport.disconnecting)
+
+        # 20 times the recent round trip, but no less than min_timeout.
+        clock.advance(6)
+        p._serverPing()
+        self.assertWritten(b'')
+        self.assertTrue(self.transport.disconnecting)
+
+    def test_connection_lost_keeps_database(self):
+        self.initProto({'irc': {'nickname': 'testnick', 'autojoin': []}},
+                       stubTimer=False)
+        p = self.proto
+        p.dbpool = sp.FakeDatabaseRunner()
+        p.dbpool.close = sp.SequentialReturner([])
+        p.startTimer('tick', 60, lambda: None)
+        looper = p._loopers['tick']
+
+        p.connectionLost(None)
+        self.assertFalse(looper.running)
+        self.assertEqual(p._loopers, {})
+        self.assertEqual(p.dbpool.close.calls, [])
+
+
+class InfobobFactoryTestCase(TrialTestCase):
+    def test_pasters_shared_across_connections(self):
+        conf = sp.makeConfig({'irc': {'nickname': 'testnick'}})
+        conf.dbpool = None
+        factory = InfobobFactory(conf)
+        first = factory.buildProtocol(None)
+        second = factory.buildProtocol(None)
+        self.assertIs(factory.lastProtocol, second)
+        self.assertIs(first._paster, second._paster)
+        self.assertIs(first._repaster, second._repaster)
+
+    def test_server_lag_kept_across_connections(self):
+        conf = sp.makeConfig({'irc': {'nickname': 'testnick'}})
+        conf.dbpool = None
+        factory = InfobobFactory(conf)
+        first = factory.buildProtocol(None)
+        first.serverLag.pong(first.serverLag.ping())
+        first.serverLag.ping()
+        first.connectionLost(None)
+
+        second = factory.buildProtocol(None)
+        self.assertIs(second.serverLag, first.serverLag)
+        self.assertEqual(len(second.serverLag.recent), 1)
+        # The PING the lost connection never got back doesn't count.
+        self.assertEqual(second.serverLag.outstanding, 0)
+
 
 class FakeInfobobFactory:
     def resetDelay(self):
@@ -0,0 +1,83 @@
+from twisted.internet import task
+from twisted.trial.unittest import TestCase as TrialTestCase
+
+from infobob.lag import LagMonitor, RoundTripTracker
+
+
+class LagMonitorTestCase(TrialTestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.monitor = LagMonitor(
+            {'lol': 1, 'web': 3, 'bans': None},
+            interval=1, window=3, clock=self.clock)
+        self.monitor.startService()
+        self.addCleanup(self.monitor.stopService)
+
+    def test_measures_scheduling_delay(self):
+        self.clock.advance(1)
+        self.assertEqual(self.monitor.lag, 0)
+        # The reactor was blocked for two seconds past the due time.
+        self.clock.advance(3)
+        self.assertEqual(self.monitor.lag, 2)
+        self.assertEqual(self.monitor.histogram.count, 2)
+        self.assertEqual(self.monitor.histogram.max, 2)
+
+    def test_sheds_features_past_threshold(self):
+        self.clock.advance(2.5)
+        self.assertTrue(self.monitor.shedding('lol'))
+        self.assertFalse(self.monitor.shedding('web'))
+        self.assertFalse(self.monitor.shedding('bans'))
+        self.assertFalse(self.monitor.shedding('unknown'))
+
+    def test_resumes_once_lag_leaves_window(self):
+        self.clock.advance(2.5)
+        self.assertTrue(self.monitor.shedding('lol'))
+        for _ in range(3):
+            self.clock.advance(1)
+        self.assertEqual(self.monitor.lag, 0)
+        self.assertFalse(self.monitor.shedding('lol'))
+
+    def test_stop_cancels_pending_call(self):
+        self.monitor.stopService()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+class RoundTripTrackerTestCase(TrialTestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.tracker = RoundTripTracker(history=3, clock=self.clock)
+
+    def test_round_trip(self):
+        token = self.tracker.ping()
+        self.assertEqual(self.tracker.outstanding, 1)
+        self.clock.advance(0.25)
+        self.assertEqual(self.tracker.oldestOutstanding(), 0.25)
+        self.assertEqual(self.tracker.pong(token), 0.25)
+        self.assertEqual(self.tracker.outstanding, 0)
+        self.assertEqual(list(self.tracker.recent), [0.25])
+        self.assertEqual(self.tracker.oldestOutstanding(), 0)
+
+    def test_forget_outstanding(self):
+        self.tracker.pong(self.tracker.ping())
+        self.tracker.ping()
+        self.clock.advance(1)
+        self.tracker.forgetOutstanding()
+        self.assertEqual(self.tracker.outstanding, 0)
+        self.assertEqual(self.tracker.oldestOutstanding(), 0)
+        self.assertEqual(list(self.tracker.recent), [0])
+
+    def test_unknown_token_ignored(self):
+        self.tracker.ping()
+        self.assertIs(self.tracker.pong('irc.example.net'), None)
+        self.assertEqual(self.tracker.outstanding, 1)
+
+    def test_timeout_follows_recent_round_trips(self):
+        self.assertEqual(self.tracker.timeout(10, 5, 300), 300)
+        for rtt in [0.125, 0.25, 2]:
+            token = self.tracker.ping()
+            self.clock.advance(rtt)
+            self.tracker.pong(token)
+        self.assertEqual(self.tracker.estimate(), 2)
+        self.assertEqual(self.tracker.timeout(10, 5, 300), 20)
+        self.assertEqual(self.tracker.timeout(10, 30, 300), 30)
+        self.assertEqual(self.tracker.timeout(10, 5, 15), 15)
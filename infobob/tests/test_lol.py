@@ -0,0 +1,67 @@
+from twisted.internet import defer, task
+from twisted.trial.unittest import TestCase as TrialTestCase
+
+from infobob.lol import LolTracker, OffenseWindow
+import infobob.tests.support as sp
+
+
+class OffenseWindowTestCase(TrialTestCase):
+    def test_counts_within_window(self):
+        window = OffenseWindow(window=60, buckets=6)
+        self.assertEqual(window.record(b'a', 0), 1)
+        self.assertEqual(window.record(b'a', 5), 2)
+        self.assertEqual(window.record(b'b', 5), 1)
+        self.assertEqual(window.record(b'a', 30), 3)
+        self.assertEqual(window.count(b'a', 65), 3)
+        self.assertEqual(window.count(b'a', 71), 1)
+        self.assertEqual(window.count(b'a', 100), 0)
+        self.assertEqual(window.count(b'nobody', 100), 0)
+
+    def test_prune_forgets_idle_nicks(self):
+        window = OffenseWindow(window=60, buckets=6)
+        window.record(b'a', 0)
+        window.record(b'b', 50)
+        window.prune(75)
+        self.assertEqual(len(window), 1)
+        self.assertEqual(window.count(b'b', 75), 1)
+
+
+class LolTrackerTestCase(TrialTestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.dbpool = sp.FakeObj()
+        self.dbpool.add_lols = sp.DeferredSequentialReturner([None, None])
+        self.dbpool.roll_up_lols = sp.DeferredSequentialReturner([0, 0])
+        self.tracker = LolTracker(
+            self.dbpool, window=60, buckets=6, flushInterval=10,
+            retentionDays=1, clock=self.clock)
+
+    def test_flushes_in_batches(self):
+        self.tracker.startService()
+        self.assertEqual(self.dbpool.roll_up_lols.calls,
+                         [sp.Call(-24 * 60 * 60)])
+        self.assertEqual(self.tracker.record(b'a'), 1)
+        self.clock.advance(1)
+        self.assertEqual(self.tracker.record(b'a'), 2)
+        self.assertEqual(self.dbpool.add_lols.calls, [])
+
+        self.clock.advance(9)
+        self.assertEqual(self.dbpool.add_lols.calls,
+                         [sp.Call([(b'a', 0), (b'a', 1)])])
+        self.assertEqual(self.tracker.pending, [])
+        self.clock.advance(10)
+        self.assertEqual(len(self.dbpool.add_lols.calls), 1)
+
+        self.tracker.record(b'b')
+        self.successResultOf(self.tracker.stopService())
+        self.assertEqual(self.dbpool.add_lols.calls[1],
+                         sp.Call([(b'b', 20)]))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_failed_batch_kept(self):
+        self.dbpool.add_lols = lambda offenses: defer.fail(ValueError())
+        self.tracker.record(b'a')
+        self.successResultOf(self.tracker.flush())
+        self.tracker.record(b'b')
+        self.assertEqual(self.tracker.pending, [(b'a', 0), (b'b', 0)])
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
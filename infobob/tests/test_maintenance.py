@@ -0,0 +1,72 @@
+from twisted.internet import defer, task
+from twisted.trial.unittest import TestCase as TrialTestCase
+
+from infobob.maintenance import MaintenanceService
+import infobob.tests.support as sp
+
+
+DAY = 24 * 60 * 60
+
+
+class MaintenanceServiceTestCase(TrialTestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(400 * DAY)
+        self.dbpool = sp.FakeObj()
+        self.dbpool.archive_bans = sp.DeferredSequentialReturner(
+            [(500, False), (20, True)])
+        self.dbpool.expire_ban_authorizations = (
+            sp.DeferredSequentialReturner([(3, True)]))
+        self.dbpool.prune_user_hosts = sp.DeferredSequentialReturner(
+            [(0, True)])
+        self.dbpool.incremental_vacuum = sp.DeferredSequentialReturner(
+            [(100, True)])
+        self.service = MaintenanceService(
+            self.dbpool, interval=600, sliceSeconds=0.5, batchSize=500,
+            archiveAfterDays=365, authTokenDays=30, vacuumPages=100,
+            clock=self.clock)
+
+    def test_runs_tasks_in_slices(self):
+        self.service.startService()
+        self.clock.advance(600)
+        self.assertEqual(self.dbpool.archive_bans.calls,
+                         [sp.Call(35 * DAY + 600, 500, 0.5)])
+        self.assertEqual(self.dbpool.expire_ban_authorizations.calls, [])
+
+        # The next slice waits for the pause after the last one. Cutoffs
+        # are all from the start of the run.
+        self.clock.advance(0.5)
+        self.assertEqual(len(self.dbpool.archive_bans.calls), 2)
+        self.assertEqual(self.dbpool.expire_ban_authorizations.calls,
+                         [sp.Call(370 * DAY + 600, 500, 0.5)])
+        self.assertEqual(self.dbpool.prune_user_hosts.calls,
+                         [sp.Call(500, 0.5)])
+        self.assertEqual(self.dbpool.incremental_vacuum.calls,
+                         [sp.Call(100)])
+        self.service.stopService()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_stop_ends_run_after_current_slice(self):
+        self.service.startService()
+        self.clock.advance(600)
+        self.service.stopService()
+        self.clock.advance(0.5)
+        self.assertEqual(len(self.dbpool.archive_bans.calls), 1)
+        self.assertEqual(self.dbpool.incremental_vacuum.calls, [])
+
+    def test_error_ends_only_its_task(self):
+        self.dbpool.archive_bans = lambda *a: defer.fail(ValueError())
+        self.service.archiveAfterDays = None
+        self.service.authTokenDays = None
+        self.service.startService()
+        self.successResultOf(self.service.runOnce())
+        self.assertEqual(self.dbpool.incremental_vacuum.calls,
+                         [sp.Call(100)])
+
+        self.service.archiveAfterDays = 365
+        self.dbpool.prune_user_hosts.reset([(0, True)])
+        self.dbpool.incremental_vacuum.reset([(0, True)])
+        self.successResultOf(self.service.runOnce())
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        self.assertEqual(len(self.dbpool.incremental_vacuum.calls), 1)
+        self.service.stopService()
@@ -0,0 +1,30 @@
+from twisted.test.proto_helpers import MemoryReactorClock
+from twisted.trial.unittest import TestCase as TrialTestCase
+
+from infobob.service import WebUIService
+import infobob.tests.support as sp
+
+
+class WebUIServiceTestCase(TrialTestCase):
+    def setUp(self):
+        self.conf = sp.makeConfig({'web': {'port': 8080}})
+        self.conf.dbpool = sp.FakeDatabaseRunner()
+        self.conf.banEvents = None
+        self.reactor = MemoryReactorClock()
+        self.service = WebUIService(self.conf, clock=self.reactor)
+
+    def test_listens_once_reactor_runs(self):
+        self.service.startService()
+        self.assertEqual(self.reactor.tcpServers, [])
+        self.reactor.advance(0)
+        [(port, site, _, _)] = self.reactor.tcpServers
+        self.assertEqual(port, 8080)
+        self.assertIsNot(self.service.port, None)
+        self.service.stopService()
+        self.assertIs(self.service.port, None)
+
+    def test_stopped_before_listening(self):
+        self.service.startService()
+        self.service.stopService()
+        self.reactor.advance(0)
+        self.assertEqual(self.reactor.tcpServers, [])
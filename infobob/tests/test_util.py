@@ -1,6 +1,8 @@
 import unittest
 import datetime
 
+from twisted.internet import defer
+
 from infobob import util
 
 
@@ -81,3 +83,91 @@ class TestParseRelativeTimeString(unittest.TestCase):
         """Fuck m. It could mean minutes or months."""
         with self.assertRaises(ValueError):
             util.parse_relative_time_string("+3m")
+
+
+class TestHistogram(unittest.TestCase):
+    """Test infobob.util.Histogram ."""
+
+    def test_empty(self):
+        hist = util.Histogram()
+        self.assertEqual(hist.count, 0)
+        self.assertIs(hist.percentile(50), None)
+
+    def test_percentiles(self):
+        hist = util.Histogram(smallest=1, buckets=4)
+        for value in [0.5, 1.5, 1.5, 3, 100]:
+            hist.record(value)
+        self.assertEqual(hist.count, 5)
+        self.assertEqual(hist.max, 100)
+        self.assertEqual(hist.percentile(20), 1)
+        self.assertEqual(hist.percentile(60), 2)
+        self.assertEqual(hist.percentile(80), 4)
+        # Samples past the largest bound are reported as the maximum.
+        self.assertEqual(hist.percentile(100), 100)
+
+
+class TestKeyedSequencer(unittest.TestCase):
+    """Test infobob.util.KeyedSequencer ."""
+
+    def setUp(self):
+        self.sequencer = util.KeyedSequencer()
+        self.calls = []
+
+    def call(self, name, result=None):
+        self.calls.append(name)
+        return result
+
+    def test_same_key_waits(self):
+        blocker = defer.Deferred()
+        first = self.sequencer.run(['#a'], self.call, 'first', blocker)
+        second = self.sequencer.run(['#a'], self.call, 'second', 2)
+        self.assertEqual(self.calls, ['first'])
+        self.assertTrue(self.sequencer.busy('#a'))
+        blocker.callback(1)
+        self.assertEqual(self.calls, ['first', 'second'])
+        self.assertEqual(self.successes(first, second), [1, 2])
+        self.assertFalse(self.sequencer.busy('#a'))
+
+    def test_other_keys_dont_wait(self):
+        self.sequencer.run(['#a'], self.call, 'a', defer.Deferred())
+        d = self.sequencer.run(['#b'], self.call, 'b', 'done')
+        self.assertEqual(self.calls, ['a', 'b'])
+        self.assertEqual(self.successes(d), ['done'])
+
+    def test_multiple_keys_wait_for_each(self):
+        blockA, blockB = defer.Deferred(), defer.Deferred()
+        self.sequencer.run(['#a'], self.call, 'a', blockA)
+        self.sequencer.run(['#b'], self.call, 'b', blockB)
+        self.sequencer.run(['#a', '#b'], self.call, 'both')
+        blockA.callback(None)
+        self.assertEqual(self.calls, ['a', 'b'])
+        blockB.callback(None)
+        self.assertEqual(self.calls, ['a', 'b', 'both'])
+
+    def test_failure_releases_key(self):
+        blocker = defer.Deferred()
+        first = self.sequencer.run(['#a'], self.call, 'first', blocker)
+        self.sequencer.run(['#a'], self.call, 'second')
+        blocker.errback(ValueError())
+        self.assertEqual(self.calls, ['first', 'second'])
+        failures = []
+        first.addErrback(failures.append)
+        failures[0].trap(ValueError)
+
+    def successes(self, *ds):
+        results = []
+        for d in ds:
+            d.addCallback(results.append)
+        return results
+
+
+class TestDecodeText(unittest.TestCase):
+    """Test infobob.util.decode_text ."""
+
+    def test_bytes_decoded(self):
+        self.assertEqual(util.decode_text(b'caf\xc3\xa9'), u'caf\xe9')
+        self.assertEqual(util.decode_text(b'caf\xe9'), u'caf\ufffd')
+
+    def test_others_unchanged(self):
+        for value in [u'caf\xe9', 3, None]:
+            self.assertEqual(util.decode_text(value), value)
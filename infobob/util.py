@@ -1,4 +1,5 @@
 from datetime import datetime
+import bisect
 import time
 import re
 
@@ -22,6 +23,102 @@ def time_deferred(d):
     now = time.time()
     return d
 
+class Histogram(object):
+    """
+    A log-bucketed histogram of durations, in seconds.
+
+    Bucket ``i`` counts samples no larger than ``smallest * 2 ** i``; the
+    final bucket catches everything past the largest bound. Percentiles
+    are reported as the upper bound of the bucket they fall in.
+    """
+    def __init__(self, smallest=0.0005, buckets=20):
+        self.bounds = [smallest * 2 ** i for i in xrange(buckets)]
+        self.counts = [0] * (buckets + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, pct):
+        if not self.count:
+            return None
+        wanted = self.count * pct / 100.0
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= wanted:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return dict(
+            count=self.count,
+            mean=self.total / self.count if self.count else None,
+            max=self.max,
+            p50=self.percentile(50),
+            p90=self.percentile(90),
+            p99=self.percentile(99),
+        )
+
+    def __repr__(self):
+        return '<Histogram count=%(count)r p50=%(p50)r p99=%(p99)r>' % (
+            self.summary())
+
+class KeyedSequencer(object):
+    """
+    Run calls in order, per key.
+
+    A call made through :meth:`run` starts once every earlier call sharing
+    any of its keys has finished; calls with no keys in common don't wait
+    for each other at all.
+    """
+    def __init__(self):
+        self._tails = {}
+
+    def busy(self, key):
+        return key in self._tails
+
+    def run(self, keys, f, *a, **kw):
+        """
+        Call ``f(*a, **kw)`` after the earlier calls on ``keys``, returning
+        a Deferred that fires with its result.
+        """
+        keys = frozenset(keys)
+        previous = set(self._tails[key] for key in keys if key in self._tails)
+        done = defer.Deferred()
+        for key in keys:
+            self._tails[key] = done
+
+        def _release(result):
+            for key in keys:
+                if self._tails.get(key) is done:
+                    del self._tails[key]
+            done.callback(None)
+            return result
+
+        d = defer.gatherResults([_observe(p) for p in previous])
+        d.addCallback(lambda ign: f(*a, **kw))
+        d.addBoth(_release)
+        return d
+
+def _observe(d):
+    """
+    Return a new Deferred that fires when ``d`` does, without disturbing
+    ``d``'s own result.
+    """
+    observer = defer.Deferred()
+    def _fire(result):
+        observer.callback(None)
+        return result
+    d.addBoth(_fire)
+    return observer
+
 def delta_to_string(_, delta):
     timestr = []
     if delta.days:
@@ -87,6 +184,15 @@ def parse_relative_time_string(s):
       raise ValueError('invalid relative date: %r' % (s,))
   return parsed
 
+def decode_text(value):
+    """
+    Decode a byte string from the database or IRC as UTF-8, replacing
+    anything undecodable; anything else is returned as it is.
+    """
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
 def ctime(_, i):
     if i is None:
         when = _(u'never')
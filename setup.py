@@ -3,7 +3,6 @@ from setuptools import setup
 install_requires = [
     # Pin deps for now, to be upgraded after tests are much expanded.
     'Genshi==0.7',
-    'lxml==3.6.0',
     'Pygments==1.4',
     'python-dateutil==2.5.3',
     'Twisted[tls]==16.4.0',
@@ -30,4 +29,9 @@ setup(
     include_package_data=True,
     install_requires=install_requires,
     extras_require=extras_require,
+    entry_points={
+        'console_scripts': [
+            'infobob-bantool = infobob.bantool:main',
+        ],
+    },
 )